@@ -0,0 +1,435 @@
+#  Restricted Scheme-like Language using Template Metaprogramming
+#
+#  Copyright Thomas D Peters 2018-present
+#
+#  Use, modification and distribution is subject to the
+#  Boost Software License, Version 1.0. (See accompanying
+#  file LICENSE or copy at
+#  http://www.boost.org/LICENSE_1_0.txt)
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+HEADER_DIR = os.path.dirname(os.path.realpath(__file__))
+HEADER_PATH = os.path.join(HEADER_DIR, "tmp_lisp.hpp")
+
+DEFAULT_FLAGS = ("-std=c++1z",)
+PCH_PREFIX_NAME = "tmp_lisp_prefix.hpp"
+DEFAULT_CACHE_BYTES = 256 << 20
+
+
+def default_cache_dir():
+    if "TMP_LISP_CACHE_DIR" in os.environ:
+        return os.environ["TMP_LISP_CACHE_DIR"]
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "tmp_lisp")
+
+
+def available_cores():
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def sha256(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        # length-prefix each part so that ("ab", "c") and ("a", "bc") differ
+        h.update(len(part).to_bytes(8, "little"))
+        h.update(part)
+    return h.hexdigest()
+
+
+def header_digest():
+    with open(HEADER_PATH, "rb") as f:
+        return sha256(f.read())
+
+
+# peak_bytes: largest resident size of the compiler process, None if cached
+CompileResult = namedtuple(
+    "CompileResult", ["returncode", "stderr", "result", "peak_bytes"], defaults=[None]
+)
+
+
+def run_measured(cmd, stdin_text, env=None):
+    """
+    Run cmd with stdin_text on its stdin, returning (returncode, stderr, peak
+    bytes): its stderr text, and the largest resident size of that process
+    alone, unlike the RUSAGE_CHILDREN maximum over every child so far.
+    """
+    proc = subprocess.Popen(
+        cmd,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        env=env,
+    )
+
+    def feed():
+        try:
+            proc.stdin.write(stdin_text)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass  # it stopped reading, say on a fatal error
+
+    writer = threading.Thread(target=feed)
+    writer.start()
+    stderr = proc.stderr.read()
+    proc.stderr.close()
+    writer.join()
+    # reaped here rather than by proc.wait(), to get its resource usage
+    _, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    peak = rusage.ru_maxrss  # bytes on macOS, KiB elsewhere
+    return proc.returncode, stderr, peak if sys.platform == "darwin" else peak * 1024
+
+
+class CompileCache:
+    """
+    On-disk, content-addressed store of compile results: one small JSON file
+    per key. Reading an entry bumps its mtime, and once the store grows past
+    max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, directory=None, max_bytes=DEFAULT_CACHE_BYTES):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = None
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "r") as f:
+                value = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        try:
+            replaced = os.path.getsize(path)
+        except OSError:
+            replaced = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(value, f)
+        os.replace(tmp_path, path)
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += os.path.getsize(path) - replaced
+        if self._size > self.max_bytes:
+            self._evict()
+
+    def _entries(self):
+        for dirpath, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(".json"):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        self._size = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+            self.evictions += 1
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self._size = None
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "directory": self.directory,
+        }
+
+
+class Compiler:
+    """
+    Runs a C++ compiler over generated code. With a cache, results are keyed
+    by the code, the contents of tmp_lisp.hpp, the compiler's identity and
+    the flags, so repeated evaluations of the same program are free.
+
+    prelude is code compiled ahead of every translation unit: part of the
+    precompiled header with pch, otherwise prepended to the code.
+    """
+
+    class Error(Exception):
+        pass
+
+    # gcc: ... {aka 'struct Int<3>'} does not name a type
+    # clang: no type named 'force_compiler_error' in 'Int<3>'
+    result_regexes = [
+        re.compile(r"force_compiler_error['’] in ['‘].*?['’] \{aka ['‘](.*)['’]\}"),
+        re.compile(r"no type named ['‘]force_compiler_error['’] in ['‘](.*)['’]"),
+    ]
+    serialized_regex = re.compile(rb"tmp_lisp_json:([^\0]+)\0")
+
+    def __init__(
+        self,
+        executable="c++",
+        flags=DEFAULT_FLAGS,
+        cache=None,
+        pch=False,
+        pch_dir=None,
+        prelude="",
+    ):
+        self.executable = executable
+        self.flags = list(flags)
+        self.cache = cache
+        self.pch = pch
+        self.prelude = prelude
+        self.pch_dir = pch_dir or os.path.join(default_cache_dir(), "pch")
+        self._identity = None
+
+    @property
+    def identity(self):
+        if self._identity is None:
+            version = subprocess.run(
+                [self.executable, "--version"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+            ).stdout
+            path = shutil.which(self.executable) or self.executable
+            self._identity = f"{os.path.realpath(path)}\n{version}"
+        return self._identity
+
+    @property
+    def is_clang(self):
+        return "clang" in self.identity.lower()
+
+    def precompiled_header(self):
+        """
+        Returns (prefix, pch): a prefix header holding <type_traits>,
+        tmp_lisp.hpp and the prelude, and its precompiled form for this
+        compiler. The PCH lives in a directory named after the header's
+        digest, the prelude, the compiler and the flags, so an edited header
+        or a different compiler simply gets a fresh one, built on first use.
+        """
+        key = sha256(
+            header_digest(), self.prelude, self.identity, "\0".join(self.flags)
+        )[:24]
+        directory = os.path.join(self.pch_dir, key)
+        prefix = os.path.join(directory, PCH_PREFIX_NAME)
+        pch = prefix + (".pch" if self.is_clang else ".gch")
+        if not os.path.exists(pch):
+            self._build_pch(prefix, pch)
+        return prefix, pch
+
+    def _build_pch(self, prefix, pch):
+        directory = os.path.dirname(prefix)
+        os.makedirs(directory, exist_ok=True)
+        with open(HEADER_PATH, "r") as f:
+            header = f.read().replace("#pragma once", "")
+        fd, tmp_prefix = tempfile.mkstemp(dir=directory, suffix=".hpp")
+        with os.fdopen(fd, "w") as f:
+            f.write("#include <type_traits>\n")
+            f.write(header)
+            f.write(self.prelude)
+        os.replace(tmp_prefix, prefix)
+
+        fd, tmp_pch = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        os.close(fd)
+        proc = subprocess.run(
+            [
+                self.executable,
+                "-xc++-header",
+                *self.flags,
+                "-I",
+                HEADER_DIR,
+                prefix,
+                "-o",
+                tmp_pch,
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            env=self.env(),
+        )
+        if proc.returncode != 0:
+            if os.path.exists(tmp_pch):
+                os.remove(tmp_pch)
+            raise self.Error(proc.stderr)
+        os.replace(tmp_pch, pch)
+
+    @staticmethod
+    def env():
+        # plain ASCII quotes in diagnostics, whatever the user's locale
+        return dict(os.environ, LC_ALL="C")
+
+    def command(self, output=None):
+        """
+        The compiler invocation reading code from stdin: only checking it, or,
+        given an output path, compiling it to an object file there.
+        """
+        pch_flags = []
+        if self.pch:
+            prefix, pch = self.precompiled_header()
+            if self.is_clang:
+                pch_flags = ["-include-pch", pch]
+            else:
+                pch_flags = ["-include", prefix, "-Winvalid-pch"]
+        return [
+            self.executable,
+            "-xc++",
+            *self.flags,
+            *pch_flags,
+            "-I",
+            HEADER_DIR,
+            *(["-c", "-o", output] if output else ["-fsyntax-only"]),
+            "-",
+        ]
+
+    def cache_key(self, code):
+        return sha256(
+            code,
+            self.prelude,
+            header_digest(),
+            self.identity,
+            "\0".join(self.flags),
+            "pch" if self.pch else "",
+        )
+
+    def compile(self, code, serialized=False):
+        """
+        Compile code and return a CompileResult. result holds the type Result
+        was evaluated to, when the code asked for it with force_compiler_error.
+
+        With serialized, the code is compiled to an object file instead, and
+        result holds the JSON text of the Serialized<Result> defined in it
+        (see Lisp2Cpp.emit).
+        """
+        key = None
+        if self.cache is not None:
+            key = self.cache_key(code)
+            if serialized:
+                key = sha256(key, "serialized")
+            cached = self.cache.get(key)
+            if cached is not None:
+                return CompileResult(**cached)
+
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "result.o") if serialized else None
+            returncode, stderr, peak_bytes = run_measured(
+                self.command(output),
+                code if self.pch else self.prelude + code,
+                env=self.env(),
+            )
+            if not serialized:
+                result = self.parse_result(stderr)
+            elif returncode == 0:
+                with open(output, "rb") as f:
+                    result = self.parse_serialized(f.read())
+            else:
+                result = None
+        res = CompileResult(
+            returncode=returncode, stderr=stderr, result=result, peak_bytes=peak_bytes
+        )
+
+        if key is not None and self.cacheable(res):
+            # a hit doesn't run the compiler, so it has no peak of its own
+            self.cache.put(key, res._replace(peak_bytes=None)._asdict())
+        return res
+
+    @staticmethod
+    def cacheable(res):
+        # a compiler killed by a signal, or failing without saying why, may
+        # well succeed next time, so only failures the code explains are kept
+        return res.returncode == 0 or (res.returncode > 0 and "error:" in res.stderr)
+
+    def compile_many(self, codes, jobs=None):
+        """
+        compile every translation unit in codes, running up to jobs compilers
+        at once (by default one per available core). Each compile is its own
+        process; the threads here only wait on them.
+        """
+        codes = list(codes)
+        jobs = jobs or available_cores()
+        if self.pch:
+            self.precompiled_header()  # build it once, not in every worker
+        if jobs == 1 or len(codes) <= 1:
+            return [self.compile(code) for code in codes]
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(self.compile, codes))
+
+    def evaluate(self, code):
+        """
+        Compile code generated with evaluate=True and return the type Result
+        names, as spelled by the compiler (e.g. 'Int<3>').
+        """
+        res = self.compile(code)
+        if res.result is None:
+            raise self.Error(res.stderr)
+        return res.result
+
+    def value(self, code):
+        """
+        Compile code generated with serialize=True and return what Result
+        names as a Python value: ints, bools, lists for proper lists, dicts
+        {"car": ..., "cdr": ...} for other pairs, {"op": name} for operators
+        and {"closure": arity} for closures. No type spelling is parsed, so
+        this is much cheaper than evaluate for large results.
+        """
+        res = self.compile(code, serialized=True)
+        if res.result is None:
+            raise self.Error(res.stderr or "no serialized Result in object file")
+        return json.loads(res.result)
+
+    @classmethod
+    def parse_serialized(cls, obj):
+        # the text is a NUL terminated char array, behind its marker
+        m = cls.serialized_regex.search(obj)
+        return m.group(1).decode() if m else None
+
+    @classmethod
+    def parse_result(cls, stderr):
+        for regex in cls.result_regexes:
+            m = regex.search(stderr)
+            if m:
+                return cls.normalize_type(m.group(1))
+        return None
+
+    @staticmethod
+    def normalize_type(spelling):
+        spelling = re.sub(r"\b(?:struct|class) ", "", spelling)
+        return re.sub(r"\s+>", ">", spelling)
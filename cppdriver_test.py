@@ -0,0 +1,172 @@
+import os
+import unittest
+from tempfile import TemporaryDirectory
+from unittest import mock
+
+import cppdriver
+from cppdriver import CompileCache, Compiler, CompileResult
+from lisp2cpp import Lisp2Cpp
+
+
+class CompileCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.cache = CompileCache(self.temp_dir.name)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get("ab12"))
+
+        self.cache.put("ab12", {"result": "Int<1>"})
+
+        self.assertEqual(self.cache.get("ab12"), {"result": "Int<1>"})
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_overwrite_keeps_size(self):
+        self.cache.max_bytes = 100
+        payload = {"stderr": "x" * 30}
+
+        for _ in range(5):
+            self.cache.put("aa", payload)
+        self.cache.put("bb", payload)
+
+        self.assertEqual(self.cache.evictions, 0)
+        self.assertEqual(
+            self.cache._size, sum(size for _, size, _ in self.cache._entries())
+        )
+
+    def test_lru_eviction(self):
+        self.cache.max_bytes = 100
+        payload = {"stderr": "x" * 30}
+
+        self.cache.put("aa", payload)
+        self.cache.put("bb", payload)
+        for ix, key in enumerate(["aa", "bb"]):
+            os.utime(self.cache._path(key), (ix, ix))
+        self.cache.get("aa")
+        self.cache.put("cc", payload)
+
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertIsNone(self.cache.get("bb"))
+        self.assertIsNotNone(self.cache.get("aa"))
+        self.assertIsNotNone(self.cache.get("cc"))
+
+
+class CompilerTest(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = TemporaryDirectory()
+        self.cache = CompileCache(self.temp_dir.name)
+        self.compiler = Compiler(cache=self.cache)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_evaluate(self):
+        code = Lisp2Cpp("(cons (+ 1 2) '(4))").codegen(evaluate=True)
+
+        self.assertEqual(self.compiler.evaluate(code), "IntList<3, 4>")
+
+    def test_cache_hit(self):
+        code = Lisp2Cpp("(* 6 7)").codegen(evaluate=True)
+
+        first = self.compiler.evaluate(code)
+        second = self.compiler.evaluate(code)
+
+        self.assertEqual(first, "Int<42>")
+        self.assertEqual(second, first)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_peak_bytes(self):
+        code = Lisp2Cpp("(* 6 7)").codegen(evaluate=True)
+
+        first = self.compiler.compile(code)
+        second = self.compiler.compile(code)
+
+        self.assertGreater(first.peak_bytes, 1 << 20)
+        self.assertIsNone(second.peak_bytes)
+
+    def test_flags_are_part_of_key(self):
+        code = "int main(){}"
+        other = Compiler(flags=["-std=c++17"], cache=self.cache)
+
+        self.assertNotEqual(self.compiler.cache_key(code), other.cache_key(code))
+
+    def test_failure(self):
+        res = self.compiler.compile("int main(){")
+
+        self.assertNotEqual(res.returncode, 0)
+        self.assertIsNone(res.result)
+        with self.assertRaises(Compiler.Error):
+            self.compiler.evaluate(Lisp2Cpp("(+ 1 #t)").codegen(evaluate=True))
+
+    def test_failures_outside_the_code_arent_cached(self):
+        failed = self.compiler.compile("int main(){")
+        killed = CompileResult(returncode=-9, stderr="", result=None)
+        silent = CompileResult(returncode=1, stderr="", result=None)
+
+        self.assertTrue(Compiler.cacheable(failed))
+        self.assertFalse(Compiler.cacheable(killed))
+        self.assertFalse(Compiler.cacheable(silent))
+        with mock.patch.object(cppdriver, "run_measured", return_value=(-9, "", 0)):
+            self.compiler.compile("int main(){}")
+        self.assertIsNone(self.cache.get(self.compiler.cache_key("int main(){}")))
+
+    def test_pch(self):
+        compiler = Compiler(pch=True, pch_dir=os.path.join(self.temp_dir.name, "pch"))
+        code = "#include <type_traits>\n" + Lisp2Cpp("(- 7 2)").codegen(evaluate=True)
+
+        prefix, pch = compiler.precompiled_header()
+
+        self.assertTrue(os.path.exists(pch))
+        flag = "-include-pch" if compiler.is_clang else "-include"
+        self.assertIn(flag, compiler.command())
+        self.assertEqual(compiler.evaluate(code), "Int<5>")
+
+    def test_pch_outdated(self):
+        compiler = Compiler(pch=True, pch_dir=os.path.join(self.temp_dir.name, "pch"))
+
+        _, pch = compiler.precompiled_header()
+        with mock.patch.object(cppdriver, "header_digest", return_value="edited"):
+            _, new_pch = compiler.precompiled_header()
+
+        self.assertNotEqual(pch, new_pch)
+        self.assertTrue(os.path.exists(new_pch))
+
+    def test_prelude(self):
+        prelude = '#include "tmp_lisp.hpp"\nusing Seven = Int<7>;\n'
+        code = "Seven::force_compiler_error eval;"
+
+        for pch in [False, True]:
+            compiler = Compiler(
+                cache=self.cache,
+                pch=pch,
+                pch_dir=os.path.join(self.temp_dir.name, "pch"),
+                prelude=prelude,
+            )
+            self.assertEqual(compiler.evaluate(code), "Int<7>")
+        self.assertNotEqual(
+            compiler.cache_key(code), Compiler(pch=True).cache_key(code)
+        )
+
+    def test_value(self):
+        code = Lisp2Cpp("(cons (+ 1 2) '(-4))").codegen(serialize=True)
+
+        self.assertEqual(self.compiler.value(code), [3, -4])
+        self.assertEqual(self.compiler.value(code), [3, -4])
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        with self.assertRaises(Compiler.Error):
+            self.compiler.value(Lisp2Cpp("(+ 1 #t)").codegen(serialize=True))
+
+    def test_parse_result(self):
+        clang = (
+            "add.cpp:4:18: error: no type named 'force_compiler_error' in "
+            "'Cons<Int<1>, EmptyList>'"
+        )
+
+        self.assertEqual(Compiler.parse_result(clang), "Cons<Int<1>, EmptyList>")
+
+
+if __name__ == "__main__":
+    unittest.main()
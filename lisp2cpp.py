@@ -8,10 +8,24 @@
 #  http://www.boost.org/LICENSE_1_0.txt)
 
 import argparse
+import bisect
+import contextlib
 import enum
+import functools
+import glob
+import io
+import json
+import operator
 import os
 import re
+import sys
+import tempfile
+import time
+import tracemalloc
 from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from cppdriver import CompileCache, Compiler, available_cores, sha256
 
 LPAREN = "("
 RPAREN = ")"
@@ -21,9 +35,18 @@ SEMICOLON = ";"
 IF = "if"
 LETREC = "letrec"
 LET = "let"
+DO = "do"
+DEFINE = "define"
+REQUIRE = "require"
+
+DEFAULT_CHUNK_SIZE = 1 << 16
 
+BACKENDS = ("templates", "constexpr")
+DEFAULT_HEAP_CELLS = 1 << 16
 
-Token = namedtuple("Token", ["type", "value"])
+
+# offset is where the token starts in the source, in characters
+Token = namedtuple("Token", ["type", "value", "offset"], defaults=[None])
 
 
 class Lexer:
@@ -34,7 +57,7 @@ class Lexer:
     class Error(Exception):
         pass
 
-    def __init__(self, rules, comment_regex=None):
+    def __init__(self, rules, comment_regex=None, partial_regex=None):
         regex_clauses = []
         self.type_map = {}
         for idx, (regex, token_type) in enumerate(rules):
@@ -47,6 +70,11 @@ class Lexer:
         self.skip_whitespace_regex = re.compile(r"\S")
         if comment_regex is not None:
             self.comment_regex = re.compile(comment_regex)
+        # the unfinished tokens which aren't tokens themselves, e.g. a string
+        # missing its closing quote, that stream_tokens must wait out
+        self.partial_regex = None
+        if partial_regex is not None:
+            self.partial_regex = re.compile(partial_regex)
 
     def tokens(self, buf):
         pos = 0
@@ -58,7 +86,55 @@ class Lexer:
 
             yield token
 
-    def next_token(self, buf, pos):
+    def stream_tokens(self, f, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Like tokens, but pulls text from the file object f chunk_size characters
+        at a time. A token ending at (or, because `$` also matches before a final
+        newline, one before) the end of the buffered text may continue in the
+        next chunk, so it is only yielded once more text (or EOF) is seen. So
+        may text at the end that only matches partial_regex, which is kept
+        until it lexes or EOF shows it never will.
+        """
+        buf = ""
+        consumed = 0
+        at_eof = False
+        while not at_eof:
+            chunk = f.read(chunk_size)
+            at_eof = not chunk
+            buf += chunk
+
+            pos = 0
+            while True:
+                try:
+                    res = self.next_token(buf, pos, consumed)
+                except self.Error as e:
+                    if at_eof or not self._is_partial(buf, e.args[0][0]):
+                        raise
+                    break
+                if res is None:
+                    pos = len(buf)
+                    break
+                token, end = res
+                if end >= len(buf) - 1 and not at_eof:
+                    break
+                pos = end
+
+                yield token
+
+            buf = buf[pos:]
+            consumed += pos
+
+    def _is_partial(self, buf, pos):
+        return (
+            self.partial_regex is not None
+            and self.partial_regex.match(buf, pos) is not None
+        )
+
+    def next_token(self, buf, pos, base=0):
+        """
+        Returns the token at or after pos in buf and where it ends, or None if
+        only whitespace is left. buf starts base characters into the source.
+        """
         if pos >= len(buf):
             return None
 
@@ -74,7 +150,7 @@ class Lexer:
         if m:
             group_name = m.lastgroup
             token_type = self.type_map[group_name]
-            token = Token(token_type, m.group(group_name))
+            token = Token(token_type, m.group(group_name), base + pos)
             pos = m.end()
             return token, pos
 
@@ -87,6 +163,7 @@ class TokenType(enum.Enum):
     RParen = enum.auto()
     Comment = enum.auto()
     Identifier = enum.auto()
+    String = enum.auto()
 
 
 lisp_rules = [
@@ -95,33 +172,227 @@ lisp_rules = [
     (r"\)", TokenType.RParen),
     (r"[a-zA-Z_0-9\!\-\+\*\?#=<>]+", TokenType.Identifier),
     (r";[^\n\r]*(?:$|\n|\r)", TokenType.Comment),
+    (r'"[^"\n\r]*"', TokenType.String),
 ]
 
-lisp_lexer = Lexer(lisp_rules)
+lisp_lexer = Lexer(lisp_rules, partial_regex=r'"[^"\n\r]*\Z')
+
+
+class Node:
+    """
+    Base of the parse tree's node types, which behave like namedtuples (fields
+    by keyword or position, _fields, _replace, iteration, equality) but keep
+    their fields in slots, which takes less memory than a tuple. Equality is
+    worked out with an explicit stack, so deep trees compare without
+    recursing, and is cheap for the variables and operators the Parser
+    interns, which compare by identity first. So is the structural hash,
+    which every node keeps once it is worked out, so that hashing all the
+    nodes of a tree, e.g. to hash-cons it, takes linear time.
+    """
+
+    # the cached hash; the subclasses' slots are their fields
+    __slots__ = ("_hash",)
+
+    def __init__(self, *args, **kwargs):
+        fields = self.__slots__
+        if len(args) + len(kwargs) != len(fields):
+            raise TypeError(f"{type(self).__name__} takes fields {fields}")
+        for name, value in zip(fields, args):
+            setattr(self, name, value)
+        for name, value in kwargs.items():
+            if name not in fields[len(args) :]:
+                raise TypeError(f"{type(self).__name__} got bad field {name}")
+            setattr(self, name, value)
+
+    @property
+    def _fields(self):
+        return self.__slots__
+
+    def __iter__(self):
+        return (getattr(self, name) for name in self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def _replace(self, **kwargs):
+        res = type(self).__new__(type(self))
+        for name in self.__slots__:
+            value = kwargs.pop(name) if name in kwargs else getattr(self, name)
+            setattr(res, name, value)
+        if kwargs:
+            raise TypeError(f"{type(self).__name__} got bad fields {list(kwargs)}")
+        return res
+
+    def __eq__(self, other):
+        stack = [(self, other)]
+        while stack:
+            a, b = stack.pop()
+            if a is b:
+                continue
+            if isinstance(a, Node) or isinstance(a, list):
+                if type(a) is not type(b) or len(a) != len(b):
+                    return False
+                stack.extend(zip(a, b))
+            elif isinstance(b, Node) or a != b:
+                return False
+        return True
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            pass
+        # children before their parents, like __eq__ without recursing
+        results = []
+        stack = [(self, False)]
+        while stack:
+            item, ready = stack.pop()
+            if ready:
+                children = tuple(results[len(results) - len(item) :])
+                del results[len(results) - len(item) :]
+                if isinstance(item, Node):
+                    item._hash = hash((type(item).__name__, *children))
+                    results.append(item._hash)
+                else:
+                    results.append(hash(children))
+            elif isinstance(item, Node) and hasattr(item, "_hash"):
+                results.append(item._hash)
+            elif isinstance(item, (Node, list)):
+                stack.append((item, True))
+                stack.extend((child, False) for child in reversed(list(item)))
+            else:
+                results.append(hash(item))
+        return results.pop()
+
+    def __repr__(self):
+        fields = ", ".join(
+            f"{name}={value!r}" for name, value in zip(self.__slots__, self)
+        )
+        return f"{type(self).__name__}({fields})"
+
+
+class SExp(Node):
+    __slots__ = ("operator", "operands")
+
+
+class LambdaExp(Node):
+    __slots__ = ("arglist", "body")
+
+
+class IfExp(Node):
+    __slots__ = ("cond", "if_true", "if_false")
+
+
+class Binding(Node):
+    __slots__ = ("var", "value")
+
+
+class LetExp(Node):
+    __slots__ = ("bindings", "body")
+
+
+class VarExp(Node):
+    __slots__ = ("name",)
+
+
+class ListExp(Node):
+    __slots__ = ("values",)
+
+
+class OpExp(Node):
+    __slots__ = ("value",)
+
+
+# only made by Lisp2Cpp: the body of a self tail-recursive letrec lambda, in
+# which the tail calls to itself have become RecurExps
+class LoopExp(Node):
+    __slots__ = ("body",)
 
-SExp = namedtuple("SExp", ["operator", "operands"])
-LambdaExp = namedtuple("LambdaExp", ["arglist", "body"])
-IfExp = namedtuple("IfExp", ["cond", "if_true", "if_false"])
-Binding = namedtuple("Binding", ["var", "value"])
-LetExp = namedtuple("LetExp", ["bindings", "body"])
-VarExp = namedtuple("VarExp", ["name"])
-ListExp = namedtuple("ListExp", ["values"])
-OpExp = namedtuple("OpExp", ["value"])
+
+class RecurExp(Node):
+    __slots__ = ("operands",)
+
+
+# top-level forms of a module: (define var value) and (require "path")
+class DefineExp(Node):
+    __slots__ = ("var", "value")
+
+
+class RequireExp(Node):
+    __slots__ = ("path",)
+
+
+# the loop a do form lowers to. It can't be spelled in source, so it never
+# shadows a user's variable.
+DO_LOOP = VarExp("(do)")
+
+
+class Spans:
+    """
+    Where parsed forms came from: the [start, end) character offsets of the
+    source each parenthesized or quoted form spans. Forms are keyed by
+    identity, since equal forms may come from different places, and are kept
+    alive here so that their ids stay unique.
+    """
+
+    def __init__(self):
+        self._spans = {}
+
+    def __len__(self):
+        return len(self._spans)
+
+    def add(self, form, start, end):
+        self._spans[id(form)] = (form, start, end)
+
+    def get(self, form):
+        entry = self._spans.get(id(form))
+        return entry[1:] if entry is not None else None
+
+    def copy(self, form, rewritten):
+        # a form built from another one in codegen comes from the same place
+        span = self.get(form)
+        if span is not None:
+            self.add(rewritten, *span)
 
 
 class Parser:
     class Tokenizer:
+        """
+        Cursor over a lazily pulled token stream with one token of lookahead.
+        Comments are dropped here so the parser never sees them.
+        """
+
         def __init__(self, text):
-            self.tokens = list(lisp_lexer.tokens(text))
+            self._init_stream(lisp_lexer.tokens(text))
+
+        @classmethod
+        def from_file(cls, f, chunk_size=DEFAULT_CHUNK_SIZE):
+            tokenizer = cls.__new__(cls)
+            tokenizer._init_stream(lisp_lexer.stream_tokens(f, chunk_size))
+            return tokenizer
+
+        @classmethod
+        def from_tokens(cls, tokens):
+            tokenizer = cls.__new__(cls)
+            tokenizer._init_stream(iter(tokens))
+            return tokenizer
+
+        def _init_stream(self, tokens):
+            self._tokens = (tok for tok in tokens if tok.type != TokenType.Comment)
+            self._top = next(self._tokens, None)
 
         def top(self):
-            return self.tokens[0]
+            if self._top is None:
+                raise Parser.Error("unexpected end of input")
+            return self._top
 
         def pop(self):
-            return self.tokens.pop(0)
+            tok = self.top()
+            self._top = next(self._tokens, None)
+            return tok
 
         def no_more_tokens(self):
-            return len(self.tokens) == 0
+            return self._top is None
 
     class Error(Exception):
         pass
@@ -139,16 +410,47 @@ class Parser:
         "car": "Car",
         "cdr": "Cdr",
         "null?": "IsNull",
+        "map": "Map",
+        "filter": "Filter",
+        "foldl": "Foldl",
+        "length": "Length",
+        "append": "Append",
+        "reverse": "Reverse",
     }
 
-    def __init__(self, tokenizer):
+    def __init__(self, tokenizer, spans=None):
         self.tokenizer = tokenizer
+        self.spans = spans
         self.integer_regex = re.compile(r"^[-+]?[0-9]+$")
+        # atoms are interned: every use of an identifier is the same object,
+        # so a large program holds one VarExp per variable name rather than
+        # one per use, and comparing them is mostly an identity check
+        self.atoms = {}
+        self.variables = {}
+
+    @classmethod
+    def _tokenizer_for(cls, source, chunk_size=DEFAULT_CHUNK_SIZE):
+        if hasattr(source, "read"):
+            return cls.Tokenizer.from_file(source, chunk_size)
+        return cls.Tokenizer(source)
+
+    @classmethod
+    def parse(cls, source, spans=None):
+        """
+        Parse a single expression from a string or a readable text file. Given
+        a Spans, record in it where each form came from.
+        """
+        return cls(cls._tokenizer_for(source), spans).parse_exp()
 
     @classmethod
-    def parse(cls, text):
-        tokenizer = cls.Tokenizer(text)
-        return cls(tokenizer).parse_exp()
+    def parse_forms(cls, source, chunk_size=DEFAULT_CHUNK_SIZE, spans=None):
+        """
+        Lazily parse every top-level form of a string or text file, yielding
+        each one as soon as its closing token has been read.
+        """
+        parser = cls(cls._tokenizer_for(source, chunk_size), spans)
+        while not parser.tokenizer.no_more_tokens():
+            yield parser._parse_item()
 
     def parse_exp(self):
         res = self._parse_item()
@@ -159,10 +461,6 @@ class Parser:
         self._require(self.tokenizer.top().type == TokenType.LParen)
         self.tokenizer.pop()
 
-    def _pop_rparen_or_die(self):
-        self._require(self.tokenizer.top().type == TokenType.RParen)
-        self.tokenizer.pop()
-
     @classmethod
     def _require(cls, cond, msg=None):
         if not cond:
@@ -174,140 +472,346 @@ class Parser:
         # I think what I have is closes to letrec
         return token in (LET, LETREC)
 
+    class FormKind(enum.Enum):
+        SExp = enum.auto()
+        If = enum.auto()
+        Lambda = enum.auto()
+        Let = enum.auto()
+        Binding = enum.auto()
+        Quote = enum.auto()
+        Do = enum.auto()
+        Clause = enum.auto()
+        Define = enum.auto()
+        Require = enum.auto()
+
+    class Form:
+        """
+        A parenthesized form that has been opened but not yet closed. The parser
+        keeps these on an explicit stack instead of recursing, so nesting depth
+        is only limited by memory.
+        """
+
+        __slots__ = (
+            "kind",
+            "items",
+            "arglist",
+            "bindings",
+            "in_bindings",
+            "var",
+            "clause",
+            "start",
+        )
+
+        def __init__(self, kind, arglist=None, var=None):
+            self.kind = kind
+            self.start = None
+            self.items = []
+            self.arglist = arglist
+            self.bindings = []
+            self.in_bindings = kind in (Parser.FormKind.Let, Parser.FormKind.Do)
+            self.var = var
+            self.clause = None
+
     def _parse_item(self):
-        while self.tokenizer.top() == TokenType.Comment:
-            self.tokenizer.pop()
-
-        top_token = self.tokenizer.top()
-        top_token_type = top_token.type
-
-        if top_token_type == TokenType.LParen:
-            self.tokenizer.pop()
-            res = self._parse_parenthesized_exp()
-            self._pop_rparen_or_die()
-        elif top_token_type == TokenType.Identifier:
-            res = self._parse_identifier()
-        else:
-            res = self._parse_atom()
+        stack = []
+        while True:
+            form = stack[-1] if stack else None
+            tok = self.tokenizer.top()
 
-        return res
+            if form is not None and form.in_bindings:
+                self.tokenizer.pop()
+                if tok.type == TokenType.RParen:
+                    form.in_bindings = False
+                else:
+                    self._require(tok.type == TokenType.LParen, tok)
+                    stack.append(
+                        self.Form(self.FormKind.Binding, var=self._parse_var())
+                    )
+                continue
+
+            if tok.type == TokenType.RParen:
+                self._require(form is not None, tok)
+                self.tokenizer.pop()
+                stack.pop()
+                if form.kind == self.FormKind.Binding:
+                    if stack[-1].kind == self.FormKind.Do:
+                        # (var init step), where step defaults to var
+                        self._require(len(form.items) in (1, 2), tok)
+                        step = form.items[1] if len(form.items) == 2 else form.var
+                        binding = Binding(var=form.var, value=form.items[0])
+                        stack[-1].bindings.append((binding, step))
+                    else:
+                        self._require(len(form.items) == 1, tok)
+                        binding = Binding(var=form.var, value=form.items[0])
+                        stack[-1].bindings.append(binding)
+                    continue
+                if form.kind == self.FormKind.Clause:
+                    self._require(
+                        len(form.items) == 2, "do takes a (test result) clause"
+                    )
+                    stack[-1].clause = form.items
+                    continue
+                value = self._close_form(form)
+                if self.spans is not None:
+                    self.spans.add(value, form.start, tok.offset + 1)
+            elif tok.type == TokenType.Quote:
+                self.tokenizer.pop()
+                self._require(
+                    self.tokenizer.top().type == TokenType.LParen,
+                    "only know how to parse quoted lists right now",
+                )
+                self.tokenizer.pop()
+                stack.append(self.Form(self.FormKind.Quote))
+                stack[-1].start = tok.offset
+                continue
+            elif form is not None and form.kind == self.FormKind.Quote:
+                self._require(tok.type == TokenType.Identifier, tok)
+                value = self._parse_identifier()
+                if isinstance(value, VarExp):
+                    raise self.Error("don't know how to handle strings yet")
+            elif tok.type == TokenType.String:
+                self._require(
+                    form is not None
+                    and form.kind == self.FormKind.Require
+                    and not form.items,
+                    "don't know how to handle strings yet",
+                )
+                self.tokenizer.pop()
+                value = tok.value[1:-1]
+            elif tok.type == TokenType.LParen:
+                self.tokenizer.pop()
+                if (
+                    form is not None
+                    and form.kind == self.FormKind.Do
+                    and form.clause is None
+                ):
+                    stack.append(self.Form(self.FormKind.Clause))
+                else:
+                    stack.append(self._open_form(top_level=not stack))
+                stack[-1].start = tok.offset
+                continue
+            else:
+                value = self._parse_identifier()
+
+            if not stack:
+                return value
+            stack[-1].items.append(value)
+
+    def _open_form(self, top_level):
+        tok = self.tokenizer.top()
+        if tok.type == TokenType.Identifier:
+            identifier = tok.value
+            if identifier in (DEFINE, REQUIRE):
+                self._require(top_level, f"{identifier} is only allowed at top level")
+                self.tokenizer.pop()
+                if identifier == REQUIRE:
+                    return self.Form(self.FormKind.Require)
+                # (define (name param ...) body) defines a lambda
+                if self.tokenizer.top().type == TokenType.LParen:
+                    self.tokenizer.pop()
+                    name = self._parse_var()
+                    arglist = self._parse_arglist(opened=True)
+                    return self.Form(self.FormKind.Define, arglist=arglist, var=name)
+                return self.Form(self.FormKind.Define, var=self._parse_var())
+            if identifier == IF:
+                self.tokenizer.pop()
+                return self.Form(self.FormKind.If)
+            if identifier == LAMBDA:
+                self.tokenizer.pop()
+                return self.Form(self.FormKind.Lambda, arglist=self._parse_arglist())
+            if self._is_let(identifier):
+                self.tokenizer.pop()
+                name = None
+                # named let
+                if (
+                    identifier == LET
+                    and self.tokenizer.top().type == TokenType.Identifier
+                ):
+                    name = self._parse_var()
+                self._pop_lparen_or_die()
+                return self.Form(self.FormKind.Let, var=name)
+            if identifier == DO:
+                self.tokenizer.pop()
+                self._pop_lparen_or_die()
+                return self.Form(self.FormKind.Do)
+
+        return self.Form(self.FormKind.SExp)
+
+    def _close_form(self, form):
+        items = form.items
+        if form.kind == self.FormKind.SExp:
+            self._require(items, "empty application")
+            return SExp(operator=items[0], operands=items[1:])
+        if form.kind == self.FormKind.If:
+            self._require(len(items) == 3, "if takes a condition and two branches")
+            cond, if_true, if_false = items
+            return IfExp(cond=cond, if_true=if_true, if_false=if_false)
+        if form.kind == self.FormKind.Lambda:
+            self._require(len(items) == 1, "lambda takes a single body expression")
+            return LambdaExp(arglist=form.arglist, body=items[0])
+        if form.kind == self.FormKind.Let:
+            self._require(
+                not form.in_bindings and len(items) == 1,
+                "let takes bindings and a single body expression",
+            )
+            if form.var is not None:
+                return self._named_let(form.var, form.bindings, items[0])
+            return LetExp(bindings=form.bindings, body=items[0])
+        if form.kind == self.FormKind.Do:
+            # without mutable state a do body could have no effect
+            self._require(
+                not form.in_bindings and form.clause is not None and not items,
+                "do takes bindings and a single (test result) clause",
+            )
+            test, result = form.clause
+            recur = SExp(operator=DO_LOOP, operands=[step for _, step in form.bindings])
+            return self._named_let(
+                DO_LOOP,
+                [binding for binding, _ in form.bindings],
+                IfExp(cond=test, if_true=result, if_false=recur),
+            )
+        if form.kind == self.FormKind.Define:
+            self._require(len(items) == 1, "define takes a name and a single value")
+            value = items[0]
+            if form.arglist is not None:
+                value = LambdaExp(arglist=form.arglist, body=value)
+            return DefineExp(var=form.var, value=value)
+        if form.kind == self.FormKind.Require:
+            self._require(
+                len(items) == 1 and isinstance(items[0], str),
+                'require takes a single "path"',
+            )
+            return RequireExp(path=items[0])
+        assert form.kind == self.FormKind.Quote, form.kind
+        return ListExp(values=items)
+
+    @staticmethod
+    def _named_let(name, bindings, body):
+        # (let name ((var init) ...) body) is
+        # ((letrec ((name (lambda (var ...) body))) name) init ...), so the
+        # inits don't see name
+        fn = LambdaExp(arglist=[binding.var for binding in bindings], body=body)
+        return SExp(
+            operator=LetExp(bindings=[Binding(var=name, value=fn)], body=name),
+            operands=[binding.value for binding in bindings],
+        )
 
     def _parse_identifier(self):
         tok = self.tokenizer.pop()
         assert tok.type == TokenType.Identifier, tok
         identifier = tok.value
+        try:
+            return self.atoms[identifier]
+        except KeyError:
+            pass
 
         if identifier in self.ops:
-            return OpExp(self.ops[identifier])
-        if identifier == "#t":
-            return True
-        if identifier == "#f":
-            return False
-        if re.match(self.integer_regex, identifier):
-            return int(identifier)
-        return VarExp(identifier)
+            res = OpExp(self.ops[identifier])
+        elif identifier == "#t":
+            res = True
+        elif identifier == "#f":
+            res = False
+        elif re.match(self.integer_regex, identifier):
+            res = int(identifier)
+        else:
+            res = self._variable(identifier)
+        self.atoms[identifier] = res
+        return res
+
+    def _variable(self, name):
+        res = self.variables.get(name)
+        if res is None:
+            res = self.variables[name] = VarExp(name)
+        return res
 
     def _var_exp(self, value):
         self._require(self.integer_regex.match(value) is None)
-        return VarExp(value)
-
-    def _parse_let(self):
-        def parse_bindings():
-            res = []
-            while self.tokenizer.top().type == TokenType.LParen:
-                self.tokenizer.pop()
-                top = self.tokenizer.top()
-                self._require(top.type == TokenType.Identifier, top)
-                var = self._var_exp(top.value)
-                self.tokenizer.pop()
-                top = self.tokenizer.top()
-                value = self._parse_item()
-                self._pop_rparen_or_die()
-                res.append(Binding(var=var, value=value))
-            return res
-
-        def parse_body():
-            return self._parse_item()
+        return self._variable(value)
 
-        self._pop_lparen_or_die()
-        bindings = parse_bindings()
-        self._pop_rparen_or_die()
-
-        body = parse_body()
-
-        return LetExp(bindings=bindings, body=body)
-
-    def _parse_if(self):
-        cond = self._parse_item()
-
-        if_true = self._parse_item()
-
-        if_false = self._parse_item()
-
-        return IfExp(cond=cond, if_true=if_true, if_false=if_false)
+    def _parse_var(self):
+        top = self.tokenizer.top()
+        self._require(top.type == TokenType.Identifier, top)
+        self.tokenizer.pop()
+        return self._var_exp(top.value)
 
-    def _parse_lambda(self):
-        def parse_arglist():
+    def _parse_arglist(self, opened=False):
+        if not opened:
             self._pop_lparen_or_die()
-            res = []
-            while self.tokenizer.top().type != TokenType.RParen:
-                top = self.tokenizer.top()
-                param = self._parse_item()
-                self._require(isinstance(param, VarExp), top)
-                res.append(param)
-            self.tokenizer.pop()
-            return res
+        res = []
+        while self.tokenizer.top().type != TokenType.RParen:
+            top = self.tokenizer.top()
+            self._require(top.type == TokenType.Identifier, top)
+            param = self._parse_identifier()
+            self._require(isinstance(param, VarExp), top)
+            res.append(param)
+        self.tokenizer.pop()
+        return res
 
-        def parse_body():
-            return self._parse_item()
 
-        return LambdaExp(arglist=parse_arglist(), body=parse_body())
+class Scope:
+    """
+    The variables bound by one lambda or let, chained to the enclosing scope.
+    Used to resolve variables to (depth, index) addresses before running or
+    emitting anything.
+
+    A scope made with captures={} is a closure boundary: code inside it sees
+    its own names, then one frame holding the variables it captures, and
+    nothing further out. Resolving a variable bound outside such a scope adds
+    it to the captures of every closure boundary crossed on the way.
+    """
 
-    def _parse_atom(self):
-        next_tok = self.tokenizer.top()
-        if next_tok.type == TokenType.Identifier:
-            return self._parse_identifier()
-        if next_tok.type == TokenType.Quote:
-            self.tokenizer.pop()
-            self._require(
-                self.tokenizer.top().type == TokenType.LParen,
-                "only know how to parse quoted lists right now",
-            )
-            return self._parse_quoted_list()
+    __slots__ = ("names", "parent", "captures")
+
+    def __init__(self, names, parent, captures=None):
+        self.names = names
+        self.parent = parent
+        self.captures = captures
+
+    def resolve(self, name):
+        crossed = []
+        scope = self
+        depth = 0
+        while scope is not None:
+            if name in scope.names:
+                # the last binding of a repeated name wins, as in a dict
+                address = depth, len(scope.names) - 1 - scope.names[::-1].index(name)
+                break
+            if scope.captures is not None:
+                if name in scope.captures:
+                    address = depth + 1, scope.captures[name]
+                    break
+                crossed.append((scope, depth + 1))
+                depth = 0
+            else:
+                depth += 1
+            scope = scope.parent
+        else:
+            return None
 
-        self._require(False, next_tok)
+        # capture outermost first, so each closure captures from its parent
+        for closure, captures_depth in reversed(crossed):
+            index = closure.captures.setdefault(name, len(closure.captures))
+            address = captures_depth, index
+        return address
 
-    def _parse_quoted_list(self):
-        self._pop_lparen_or_die()
-        values = []
-        while self.tokenizer.top().type != TokenType.RParen:
-            item = self._parse_atom()
-            if isinstance(item, VarExp):
-                raise self.Error("don't know how to handle strings yet")
-            values.append(item)
-        self._pop_rparen_or_die()
-        return ListExp(values=values)
 
-    def _parse_parenthesized_exp(self):
-        tok = self.tokenizer.top()
-        if tok.type == TokenType.Identifier:
-            identifier = tok.value
-            if identifier == IF:
-                self.tokenizer.pop()
-                return self._parse_if()
-            if identifier == LAMBDA:
-                self.tokenizer.pop()
-                return self._parse_lambda()
-            if self._is_let(identifier):
-                self.tokenizer.pop()
-                return self._parse_let()
+class CountingWriter:
+    """
+    Passes writes on to sink, counting the characters written and, with
+    count_lines, the lines.
+    """
 
-        operator = self._parse_item()
-        operands = []
-        while self.tokenizer.top().type != TokenType.RParen:
-            operands.append(self._parse_item())
+    def __init__(self, sink, count_lines=False):
+        self.sink = sink
+        self.count = 0
+        self.count_lines = count_lines
+        self.lines = 0
 
-        return SExp(operator=operator, operands=operands)
+    def write(self, text):
+        self.count += len(text)
+        if self.count_lines:
+            self.lines += text.count("\n")
+        return self.sink.write(text)
 
 
 class Lisp2Cpp:
@@ -318,117 +822,2496 @@ class Lisp2Cpp:
 
     include = f'#include "{header_name}"\n\r\n\r'
 
-    def __init__(self, text):
-        self.parse = Parser.parse(text)
-        self.varmap = {}
-        self._compute_varmap(self.parse, self.varmap)
+    Pending = namedtuple("Pending", ["parse", "scope"])
+
+    # the capture list of a closure, written after its body has been walked
+    Captures = namedtuple("Captures", ["scope"])
+
+    # the end of the output for a form that started at start and has span
+    Mapped = namedtuple("Mapped", ["start", "span"])
+
+    # free variables spelled as C++ types instead of Unbound, e.g. the
+    # definitions of required modules
+    globals = {}
+
+    serialize_result = "\n\nextern constexpr Serialized<Result> serialized_result{};"
+
+    # where parsed forms came from, with track_spans
+    spans = None
+
+    # the Optimizer run over the parse, if any
+    optimizer = None
+
+    # whether repeated subtrees of the Result type are emitted once, as aliases
+    share = False
+
+    # the prefix of those aliases
+    shared_alias = "Sub_"
+
+    def __init__(
+        self,
+        source,
+        backend="templates",
+        heap_cells=DEFAULT_HEAP_CELLS,
+        track_spans=False,
+        optimize=0,
+        share=False,
+    ):
+        """
+        optimize is the level of the Optimizer pass run over the parse; the
+        parse as written is kept as unoptimized. With share, the template
+        backend hash-conses the type it generates (see emit_program).
+        """
+        if backend not in BACKENDS:
+            raise self.ConvertError(f"unknown backend {backend}")
+        if track_spans:
+            self.spans = Spans()
+        self.parse = self.unoptimized = Parser.parse(source, self.spans)
+        if optimize:
+            self.optimizer = Optimizer(optimize, self.spans)
+            self.parse = self.optimizer.optimize(self.parse)
+        self.unbound = self._find_unbound(self.parse)
+        self.backend = backend
+        self.heap_cells = heap_cells
+        self.share = share
+
+    @classmethod
+    def from_parse(
+        cls, parse, backend="templates", heap_cells=DEFAULT_HEAP_CELLS, share=False
+    ):
+        """
+        Like the constructor, but for an expression that is already parsed.
+        """
+        if backend not in BACKENDS:
+            raise cls.ConvertError(f"unknown backend {backend}")
+        self = cls.__new__(cls)
+        self.parse = parse
+        self.unbound = self._find_unbound(parse)
+        self.backend = backend
+        self.heap_cells = heap_cells
+        self.share = share
+        return self
+
+    def codegen(
+        self, evaluate=False, include_header=False, serialize=False, source_map=None
+    ):
+        out = io.StringIO()
+        self.emit(
+            out,
+            evaluate=evaluate,
+            include_header=include_header,
+            serialize=serialize,
+            source_map=source_map,
+        )
+        return out.getvalue()
+
+    def emit(
+        self,
+        sink,
+        evaluate=False,
+        include_header=False,
+        serialize=False,
+        source_map=None,
+    ):
+        """
+        Write the translation unit to sink, which can be any object with a text
+        write method (a file, io.StringIO, a compiler's stdin). Fragments are
+        written as the tree is walked, so no intermediate strings for subtrees
+        are built.
+
+        With serialize, the unit also defines the JSON text of Result as a
+        constant in its object file, which Compiler.value reads back.
+
+        source_map, a list, gets a (start, end, source_start, source_end) entry
+        per form parsed with track_spans, saying which characters of the output
+        were generated from which of the source (see SourceMap). Only the
+        template backend writes a type per form.
+        """
+        if source_map is not None:
+            sink = CountingWriter(sink)
 
-    def codegen(self, evaluate=False, include_header=False):
         if include_header:
-            res = self._paste_header()
+            self._emit_header(sink)
         else:
-            res = self.include
+            sink.write(self.include)
 
-        res += self._codegen_varlist()
-        to_eval = self._codegen(self.parse)
-        res += f"using Result = Eval<{to_eval}, EmptyEnv>;"
+        self.emit_program(sink, source_map)
 
         if evaluate:
-            res += "\n\nResult::force_compiler_error eval;"
+            sink.write("\n\nResult::force_compiler_error eval;")
+        if serialize:
+            sink.write(self.serialize_result)
+
+    def emit_program(self, sink, source_map=None):
+        """
+        Write just the variable aliases and the Result alias, without the
+        header, e.g. to place several programs in one translation unit.
+        Offsets in source_map count from the start of a CountingWriter sink,
+        or else from where the program starts.
+
+        With share, every subtree of the Result type that would be spelled
+        more than once, and is long enough for it to pay, is written once
+        instead, as a using Sub_k alias before Result, and referred to by name.
+        This is hash-consing the generated type rather than the parse, since
+        the same form spells differently in different scopes.
+        """
+        self._emit_unbound(sink)
+        if self.backend == "constexpr":
+            ConstexprCodegen(self.parse, self.unbound, self.heap_cells).emit(sink)
+            return
+        if self.share:
+            if source_map is not None:
+                raise self.ConvertError("a source map can't be made with share")
+            self._emit_shared(sink)
+            return
+        sink.write("using Result = Eval<")
+        if source_map is None:
+            fragments = self._fragments(self.parse)
+        else:
+            if self.spans is None:
+                raise self.ConvertError("a source map needs track_spans")
+            offset = sink.count if isinstance(sink, CountingWriter) else 0
+            fragments = self._mapped_fragments(self.parse, source_map, offset)
+        for fragment in fragments:
+            sink.write(fragment)
+        sink.write(", EmptyFrames>;")
+
+    def _find_unbound(self, parse, scope=None, unbound=None):
+        # Pre-order walk with an explicit stack: children are pushed in reverse
+        # so that free variables are numbered in the order they appear.
+        unbound = {} if unbound is None else unbound
+        stack = [(parse, scope)]
+        while stack:
+            parse, scope = stack.pop()
+            if isinstance(parse, SExp):
+                stack.extend((operand, scope) for operand in reversed(parse.operands))
+                stack.append((parse.operator, scope))
+            elif isinstance(parse, LambdaExp):
+                names = [param.name for param in parse.arglist]
+                stack.append((parse.body, Scope(names, scope)))
+            elif isinstance(parse, IfExp):
+                stack.extend(
+                    (exp, scope) for exp in (parse.if_false, parse.if_true, parse.cond)
+                )
+            elif isinstance(parse, VarExp):
+                address = scope.resolve(parse.name) if scope is not None else None
+                if (
+                    address is None
+                    and parse.name not in self.globals
+                    and parse.name not in unbound
+                ):
+                    unbound[parse.name] = len(unbound)
+            elif isinstance(parse, LetExp):
+                let_scope = Scope(
+                    [binding.var.name for binding in parse.bindings], scope
+                )
+                stack.append((parse.body, let_scope))
+                stack.extend(
+                    (binding.value, let_scope) for binding in reversed(parse.bindings)
+                )
+        return unbound
+
+    def _emit_unbound(self, sink):
+        for name, ix in self.unbound.items():
+            sink.write(f"// Unbound<{ix}>: {name}\n")
+
+    @classmethod
+    def _emit_header(cls, sink):
+        dir_path = os.path.dirname(os.path.realpath(__file__))
+        with open(os.path.join(dir_path, cls.header_name), "r") as f:
+            sink.write("/******************* BEGIN TMP_LISP *************/")
+            for line in f:
+                sink.write(line.replace("#pragma once", ""))  # such a hack ...
+            sink.write("\n\r/********************** END TMP_LISP ***************/")
+            sink.write("\n\r\n\r")
+
+    def _codegen(self, parse):
+        return "".join(self._fragments(parse))
+
+    def _fragments(self, parse, scope=None):
+        """
+        Yield the C++ for parse as a sequence of string fragments, walking the
+        tree with an explicit stack of pending fragments and subtrees.
+        """
+        stack = [self.Pending(parse, scope)]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                yield item
+            elif isinstance(item, self.Captures):
+                stack.extend(reversed(self._expand_captures(item.scope)))
+            else:
+                stack.extend(reversed(self._expand(*item)))
+
+    def _mapped_fragments(self, parse, source_map, offset):
+        """
+        Like _fragments, also appending to source_map where the fragments of
+        every form with a span start and end, given that the first is written
+        at offset.
+        """
+        stack = [self.Pending(parse, None)]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                offset += len(item)
+                yield item
+            elif isinstance(item, self.Captures):
+                stack.extend(reversed(self._expand_captures(item.scope)))
+            elif isinstance(item, self.Mapped):
+                source_map.append((item.start, offset, *item.span))
+            else:
+                span = self.spans.get(item.parse)
+                if span is not None:
+                    stack.append(self.Mapped(offset, span))
+                stack.extend(reversed(self._expand(*item)))
+
+    def _emit_shared(self, sink):
+        nodes, root = self._hash_consed(self.parse)
+
+        # how many times each distinct type is spelled in the others, once
+        # each; a type is only spelled more than once if it or one of the types
+        # containing it is, so aliasing those is enough
+        uses = [0] * len(nodes)
+        for node in nodes:
+            for item in node:
+                if type(item) is int:
+                    uses[item] += 1
+
+        # children come before their parents, so each type's length is known
+        # with its own children already aliased or not
+        names = {}
+        lengths = []
+        for ix, node in enumerate(nodes):
+            length = 0
+            for item in node:
+                length += lengths[item] if type(item) is int else len(item)
+            name = f"{self.shared_alias}{len(names)}"
+            declaration = len(f"using {name} = ;\n") + length
+            if uses[ix] > 1 and uses[ix] * (length - len(name)) > declaration:
+                names[ix] = name
+                length = len(name)
+            lengths.append(length)
+
+        for ix, name in names.items():
+            sink.write(f"using {name} = ")
+            for fragment in self._node_fragments(nodes, names, nodes[ix]):
+                sink.write(fragment)
+            sink.write(";\n")
+        sink.write("using Result = Eval<")
+        for fragment in self._node_fragments(nodes, names, nodes[root]):
+            sink.write(fragment)
+        sink.write(", EmptyFrames>;")
+
+    def _hash_consed(self, parse, scope=None):
+        """
+        The C++ type for parse as a DAG: returns a list of the distinct types
+        it is made of, each a tuple of fragments and the indices of its child
+        types, children first, and the index of parse's own type. Equal types
+        are found by their tuples, so it takes time linear in the parse.
+        """
+        ids = {}
+        nodes = []
+        # (the items of a type still to look at, the tuple so far)
+        stack = [(list(reversed(self._expand(parse, scope))), [])]
+        while True:
+            items, node = stack[-1]
+            if not items:
+                stack.pop()
+                node = tuple(node)
+                ix = ids.get(node)
+                if ix is None:
+                    ix = ids[node] = len(nodes)
+                    nodes.append(node)
+                if not stack:
+                    return nodes, ix
+                stack[-1][1].append(ix)
+                continue
+            item = items.pop()
+            if isinstance(item, str):
+                node.append(item)
+            elif isinstance(item, self.Captures):
+                # only known once the body before it has been walked
+                items.extend(reversed(self._expand_captures(item.scope)))
+            else:
+                stack.append((list(reversed(self._expand(*item))), []))
+
+    @staticmethod
+    def _node_fragments(nodes, names, node):
+        # the fragments spelling node, with the types in names by their alias
+        stack = list(reversed(node))
+        while stack:
+            item = stack.pop()
+            if type(item) is not int:
+                yield item
+            elif item in names:
+                yield names[item]
+            else:
+                stack.extend(reversed(nodes[item]))
+
+    def _expand(self, parse, scope):
+        """
+        One level of codegen: returns the fragments and the Pending child
+        subtrees (with the scope they are resolved in) that make up the C++ for
+        parse, in output order.
+        """
+        Pending = self.Pending
+        if isinstance(parse, LambdaExp):
+            names = [param.name for param in parse.arglist]
+            fn_scope = Scope(names, scope, captures={})
+            body = Pending(parse.body, fn_scope)
+            return [f"Fn<{len(names)}, ", body, self.Captures(fn_scope), ">"]
+        if isinstance(parse, LetExp):
+            names = [binding.var.name for binding in parse.bindings]
+            # the bindings capture what they use, like a lambda; the body sees
+            # every enclosing frame
+            rec_scope = Scope(names, scope, captures={})
+            values = [
+                Pending(value, rec_scope)
+                for value in self._rec_values(parse.bindings, self.spans)
+            ]
+            body = Pending(parse.body, Scope(names, scope))
+            return [
+                "Letrec<",
+                body,
+                ", Rec<",
+                *self._joined([value] for value in values),
+                ">",
+                self.Captures(rec_scope),
+                ">",
+            ]
+        if isinstance(parse, SExp):
+            operands = [Pending(operand, scope) for operand in parse.operands]
+            return [
+                "SExp<",
+                Pending(parse.operator, scope),
+                *self._prefixed(operands),
+                ">",
+            ]
+        if isinstance(parse, LoopExp):
+            # the loop variables are the innermost frame, as for the body
+            return ["Loop<", Pending(parse.body, scope), ">"]
+        if isinstance(parse, RecurExp):
+            operands = [[Pending(operand, scope)] for operand in parse.operands]
+            return ["Recur<", *self._joined(operands), ">"]
+        if isinstance(parse, IfExp):
+            return [
+                "If<",
+                Pending(parse.cond, scope),
+                ", ",
+                Pending(parse.if_true, scope),
+                ", ",
+                Pending(parse.if_false, scope),
+                ">",
+            ]
+        if isinstance(parse, bool):
+            return [f"Bool<{str(parse).lower()}>"]
+        if isinstance(parse, int):
+            return [f"Int<{parse}>"]
+        if isinstance(parse, VarExp):
+            address = scope.resolve(parse.name) if scope is not None else None
+            if address is None:
+                if parse.name in self.globals:
+                    return [self.globals[parse.name]]
+                return [f"Unbound<{self.unbound[parse.name]}>"]
+            return ["Ref<%d, %d>" % address]
+        if isinstance(parse, OpExp):
+            return [f"Op<OpCode::{parse.value}>"]
+        if isinstance(parse, ListExp):
+            # flat, so that a long literal doesn't nest a template per element
+            if not parse.values:
+                return ["EmptyList"]
+            if all(type(value) is int for value in parse.values):
+                return ["IntList<" + ", ".join(map(str, parse.values)) + ">"]
+            values = [[Pending(value, scope)] for value in parse.values]
+            return ["List<", *self._joined(values), ">"]
+        raise self.ConvertError(f"don't know how to convert {parse} to CPP")
+
+    @classmethod
+    def _rec_values(cls, bindings, spans=None):
+        # the last binding of a repeated name is the one its uses refer to
+        last = {binding.var.name: ix for ix, binding in enumerate(bindings)}
+        return [
+            (
+                last[binding.var.name] == ix
+                and cls._as_loop(binding.var, binding.value, spans)
+            )
+            or binding.value
+            for ix, binding in enumerate(bindings)
+        ]
 
+    @staticmethod
+    def _as_loop(var, fn, spans=None):
+        """
+        If fn, bound to var by a letrec, calls var in tail position with as
+        many arguments as it takes, returns fn with its body made a LoopExp and
+        those calls made RecurExps, so that iterating doesn't nest templates.
+        Otherwise returns None. The rebuilt forms get the spans of the ones
+        they replace.
+        """
+        rebuilt = spans.copy if spans is not None else lambda form, rewritten: None
+        if not isinstance(fn, LambdaExp) or var in fn.arglist:
+            return None
+
+        # rebuild the tail positions of the body, children before parents
+        found = False
+        res = []
+        stack = [(fn.body, False)]
+        while stack:
+            parse, rebuild = stack.pop()
+            if rebuild:
+                if isinstance(parse, IfExp):
+                    if_false = res.pop()
+                    if_true = res.pop()
+                    res.append(parse._replace(if_true=if_true, if_false=if_false))
+                else:
+                    res.append(parse._replace(body=res.pop()))
+                rebuilt(parse, res[-1])
+            elif isinstance(parse, IfExp):
+                stack.extend(
+                    ((parse, True), (parse.if_false, False), (parse.if_true, False))
+                )
+            elif isinstance(parse, LetExp) and all(
+                binding.var != var for binding in parse.bindings
+            ):
+                stack.extend(((parse, True), (parse.body, False)))
+            elif (
+                isinstance(parse, SExp)
+                and parse.operator == var
+                and len(parse.operands) == len(fn.arglist)
+            ):
+                found = True
+                res.append(RecurExp(operands=parse.operands))
+                rebuilt(parse, res[-1])
+            else:
+                res.append(parse)
+
+        if not found:
+            return None
+        loop = LoopExp(body=res.pop())
+        rebuilt(fn.body, loop)
+        res = fn._replace(body=loop)
+        rebuilt(fn, res)
         return res
 
+    def _expand_captures(self, scope):
+        # every name was found while walking the body, so each one resolves
+        # in the enclosing scope
+        captures = [self.Pending(VarExp(name), scope.parent) for name in scope.captures]
+        return self._prefixed(captures)
+
+    @staticmethod
+    def _prefixed(items):
+        # ", item0,item1,..." or nothing, so that empty packs stay valid C++
+        if not items:
+            return []
+        return [", ", *Lisp2Cpp._joined([item] for item in items)]
+
+    @staticmethod
+    def _joined(groups):
+        res = []
+        for ix, group in enumerate(groups):
+            if ix:
+                res.append(",")
+            res.extend(group)
+        return res
+
+
+class SourceMap:
+    """
+    Which ranges of generated C++ came from which Lisp forms: a sidecar to a
+    translation unit, built from what Lisp2Cpp.emit collects in source_map.
+    A mapping's generated range is in characters of the C++; its start and end
+    are 1-based (line, column) positions in the Lisp source, the end just past
+    the form.
+    """
+
+    version = 1
+
+    Mapping = namedtuple("Mapping", ["generated", "start", "end"])
+
+    def __init__(self, mappings, source=None):
+        self.mappings = mappings
+        self.source = source
+
     @classmethod
-    def _compute_varmap(cls, parse, varmap):
-        if isinstance(parse, SExp):
-            cls._compute_varmap(parse.operator, varmap)
-            for operand in parse.operands:
-                cls._compute_varmap(operand, varmap)
-        elif isinstance(parse, LambdaExp):
-            for exp in parse.arglist:
-                cls._compute_varmap(exp, varmap)
-            cls._compute_varmap(parse.body, varmap)
-        elif isinstance(parse, VarExp):
-            if parse.name not in varmap:
-                varmap[parse.name] = len(varmap)
-        elif isinstance(parse, LetExp):
-            for binding in parse.bindings:
-                if binding.var.name not in varmap:
-                    varmap[binding.var.name] = len(varmap)
-                cls._compute_varmap(binding.value, varmap)
-            cls._compute_varmap(parse.body, varmap)
-
-    def _codegen_varlist(self):
-        return "\n".join(
-            f"using {self._codegen_var(name)} = Var<{ix}>;"
-            for name, ix in self.varmap.items()
+    def build(cls, text, entries, source=None):
+        """
+        text is the Lisp source, entries the tuples collected by emit.
+        """
+        line_starts = [0] + [m.end() for m in re.finditer("\n", text)]
+
+        def position(offset):
+            line = bisect.bisect_right(line_starts, offset)
+            return line, offset - line_starts[line - 1] + 1
+
+        mappings = [
+            cls.Mapping((start, end), position(source_start), position(source_end))
+            for start, end, source_start, source_end in sorted(entries)
+        ]
+        return cls(mappings, source)
+
+    def to_json(self):
+        return dict(
+            version=self.version,
+            source=self.source,
+            mappings=[
+                dict(generated=list(m.generated), start=list(m.start), end=list(m.end))
+                for m in self.mappings
+            ],
         )
 
     @classmethod
-    def _paste_header(cls):
-        dir_path = os.path.dirname(os.path.realpath(__file__))
-        with open(os.path.join(dir_path, cls.header_name), "r") as f:
-            res = (
-                "/******************* BEGIN TMP_LISP *************/"
-                + f.read()
-                + "\n\r/********************** END TMP_LISP ***************/"
-                + "\n\r\n\r"
-            )
-            res = res.replace("#pragma once", "")  # such a hack ...
-            return res
+    def from_json(cls, obj):
+        if obj.get("version") != cls.version:
+            raise ValueError(f"unknown source map version {obj.get('version')}")
+        mappings = [
+            cls.Mapping(tuple(m["generated"]), tuple(m["start"]), tuple(m["end"]))
+            for m in obj["mappings"]
+        ]
+        return cls(mappings, obj.get("source"))
 
-    def _codegen(self, parse):
+
+class ConstexprCodegen:
+    """
+    Writes a program for the constexpr backend of tmp_lisp.hpp: a Program
+    whose code function has a case per lambda and letrec binding, and a
+    Result alias spelling the value the program computes.
+
+    Variables resolve to the same (depth, index) addresses as for the
+    template backend; each frame in scope is a C++ pointer. Code cases see
+    their frames as f0 and f1, and letrec bodies and loops name theirs with
+    immediately invoked lambdas. The tree is walked with an explicit stack,
+    and each case is written to its own buffer, since cases nest in the
+    program but not in the C++.
+    """
+
+    Pending = namedtuple("Pending", ["parse", "context"])
+
+    # the scope of an expression, the frames it sees, innermost first, and
+    # the array a Recur writes the next loop variables to
+    Context = namedtuple("Context", ["scope", "frames", "recur"])
+
+    # kind is "values" for arguments and loop variables, "captured" for the
+    # values a closure captured, which may be letrec slots, or "letrec"
+    Frame = namedtuple("Frame", ["name", "kind"])
+
+    Captures = namedtuple("Captures", ["scope", "context", "prefixed"])
+
+    # start and end of the code case for a lambda or letrec binding
+    Case = namedtuple("Case", ["code", "header"])
+    EndCase = namedtuple("EndCase", ["code"])
+
+    def __init__(self, parse, unbound, heap_cells=DEFAULT_HEAP_CELLS):
+        self.parse = parse
+        self.unbound = unbound
+        self.heap_cells = heap_cells
+
+    def emit(self, sink):
+        self._codes = 0
+        self._frames = 2
+        cases = self._cases()
+        sink.write(
+            "struct Program {\n"
+            f"  using M = constexpr_lisp::Machine<Program, {self.heap_cells}>;\n\n"
+            "  static constexpr constexpr_lisp::Value\n"
+            "  code(M &m, int id, int n, const constexpr_lisp::Value *f0,\n"
+            "       const constexpr_lisp::Value *f1) {\n"
+            "    using namespace constexpr_lisp;\n"
+            "    switch (id) {\n"
+        )
+        for code, fragments in sorted(cases.items()):
+            sink.write(f"    case {code}:\n")
+            for fragment in fragments:
+                sink.write(fragment)
+        sink.write(
+            "    }\n"
+            '    throw "no such code";\n'
+            "  }\n"
+            "};\n\n"
+            "struct Run {\n"
+            "  static constexpr Program::M machine = Program::M::run();\n"
+            "};\n\n"
+            "using Result = constexpr_lisp::Result_t<Run>;"
+        )
+
+    def _cases(self):
+        cases = {}
+        open_cases = []
+        stack = [
+            self.EndCase(0),
+            self.Pending(self.parse, self.Context(None, (), None)),
+            self._case(0),
+        ]
+        while stack:
+            item = stack.pop()
+            if isinstance(item, str):
+                cases[open_cases[-1]].append(item)
+            elif isinstance(item, self.Case):
+                open_cases.append(item.code)
+                cases[item.code] = [item.header]
+            elif isinstance(item, self.EndCase):
+                cases[open_cases.pop()].append(";\n")
+            elif isinstance(item, self.Captures):
+                stack.extend(reversed(self._expand_captures(item)))
+            else:
+                stack.extend(reversed(self._expand(*item)))
+        return cases
+
+    def _case(self, code, arity=None):
+        header = "      return "
+        if arity is not None:
+            header = f"      M::check_arity(n, {arity});\n" + header
+        return self.Case(code, header)
+
+    def _new_code(self):
+        self._codes += 1
+        return self._codes
+
+    def _new_frame(self):
+        self._frames += 1
+        return f"f{self._frames - 1}"
+
+    def _expand(self, parse, context):
+        """
+        One level of codegen, like Lisp2Cpp._expand: the fragments and
+        Pending subtrees making up the C++ expression for parse. A lambda or
+        letrec binding also contributes its code case, ahead of the
+        expression that refers to it.
+        """
+        Pending = self.Pending
+        Frame = self.Frame
         if isinstance(parse, LambdaExp):
-            body_codegen = self._codegen(parse.body)
-            params_codegen = ",".join(self._codegen(param) for param in parse.arglist)
-            return f"Lambda<{body_codegen}, {params_codegen}>"
+            names = [param.name for param in parse.arglist]
+            fn_scope = Scope(names, context.scope, captures={})
+            fn = self.Context(
+                fn_scope, (Frame("f0", "values"), Frame("f1", "captured")), None
+            )
+            code = self._new_code()
+            return [
+                self._case(code, arity=len(names)),
+                Pending(parse.body, fn),
+                self.EndCase(code),
+                f"m.closure({code}",
+                self.Captures(fn_scope, context, prefixed=True),
+                ")",
+            ]
         if isinstance(parse, LetExp):
-            env_codegen = self._env_codegen(parse.bindings)
-            body_codegen = self._codegen(parse.body)
-            return f"Let<{env_codegen}, {body_codegen}>"
-        if isinstance(parse, SExp):
-            operator = self._codegen(parse.operator)
-            operands_codegen = ",".join(
-                self._codegen(operand) for operand in parse.operands
+            names = [binding.var.name for binding in parse.bindings]
+            rec_scope = Scope(names, context.scope, captures={})
+            rec = self.Context(
+                rec_scope, (Frame("f0", "letrec"), Frame("f1", "captured")), None
+            )
+            last = {name: ix for ix, name in enumerate(names)}
+            res = []
+            codes = []
+            for ix, binding in enumerate(parse.bindings):
+                value = (
+                    last[binding.var.name] == ix and Lisp2Cpp._as_loop(*binding)
+                ) or binding.value
+                code = self._new_code()
+                codes.append(code)
+                res.extend((self._case(code), Pending(value, rec), self.EndCase(code)))
+            frame = self._new_frame()
+            body = self.Context(
+                Scope(names, context.scope),
+                (Frame(frame, "letrec"), *context.frames),
+                context.recur,
+            )
+            return [
+                *res,
+                f"[&](const Value *{frame}) {{ return ",
+                Pending(parse.body, body),
+                "; }(m.letrec(m.block(",
+                self.Captures(rec_scope, context, prefixed=False),
+                ")",
+                *(f", {code}" for code in codes),
+                "))",
+            ]
+        if isinstance(parse, LoopExp):
+            frame = self._new_frame()
+            recur = f"next_{frame}"
+            loop = context._replace(
+                frames=(Frame(frame, "values"), *context.frames[1:]), recur=recur
             )
-            return f"SExp<{operator}, {operands_codegen}>"
+            return [
+                f"m.loop<{len(context.scope.names)}>({context.frames[0].name}, "
+                f"[&](const Value *{frame}, Value *{recur}) {{ return ",
+                Pending(parse.body, loop),
+                "; })",
+            ]
+        if isinstance(parse, RecurExp):
+            operands = [Pending(operand, context) for operand in parse.operands]
+            return [f"M::recur({context.recur}", *Lisp2Cpp._prefixed(operands), ")"]
+        if isinstance(parse, SExp):
+            operands = [Pending(operand, context) for operand in parse.operands]
+            if isinstance(parse.operator, OpExp):
+                return [
+                    f"m.prim<OpCode::{parse.operator.value}>(",
+                    *Lisp2Cpp._joined([operand] for operand in operands),
+                    ")",
+                ]
+            return [
+                "m.call(",
+                Pending(parse.operator, context),
+                *Lisp2Cpp._prefixed(operands),
+                ")",
+            ]
         if isinstance(parse, IfExp):
-            cond = self._codegen(parse.cond)
-            if_true = self._codegen(parse.if_true)
-            if_false = self._codegen(parse.if_false)
-            return f"If<{cond}, {if_true}, {if_false}>"
+            return [
+                "(M::truthy(",
+                Pending(parse.cond, context),
+                ") ? ",
+                Pending(parse.if_true, context),
+                " : ",
+                Pending(parse.if_false, context),
+                ")",
+            ]
         if isinstance(parse, bool):
-            return f"Bool<{str(parse).lower()}>"
+            return [f"boolean({str(parse).lower()})"]
         if isinstance(parse, int):
-            return f"Int<{parse}>"
+            return [f"integer({parse})"]
         if isinstance(parse, VarExp):
-            return self._codegen_var(parse.name)
+            address = context.scope.resolve(parse.name) if context.scope else None
+            if address is None:
+                return [f"M::unbound({self.unbound[parse.name]})"]
+            depth, index = address
+            frame = context.frames[depth]
+            if frame.kind == "values":
+                return [f"{frame.name}[{index}]"]
+            return [f"m.get({frame.name} + {index})"]
         if isinstance(parse, OpExp):
-            return f"Op<OpCode::{parse.value}>"
+            return [f"op(OpCode::{parse.value})"]
         if isinstance(parse, ListExp):
-            return self._codegen_list(parse.values)
-        raise self.ConvertError(f"don't know how to convert {parse} to CPP")
+            values = [[Pending(value, context)] for value in parse.values]
+            return ["m.list(", *Lisp2Cpp._joined(values), ")"]
+        raise Lisp2Cpp.ConvertError(f"don't know how to convert {parse} to CPP")
+
+    def _expand_captures(self, item):
+        # a captured letrec binding may be the closure being made, so it is
+        # captured as a slot and only evaluated when used
+        captures = []
+        for name in item.scope.captures:
+            depth, index = item.context.scope.resolve(name)
+            frame = item.context.frames[depth]
+            if frame.kind == "letrec":
+                captures.append([f"m.slot({frame.name} + {index})"])
+            else:
+                captures.append([f"{frame.name}[{index}]"])
+        if item.prefixed:
+            return Lisp2Cpp._prefixed([capture for (capture,) in captures])
+        return Lisp2Cpp._joined(captures)
+
+
+ConsCell = namedtuple("ConsCell", ["car", "cdr"])
+
+
+class EmptyListType:
+    def __repr__(self):
+        return "EmptyList"
+
+
+EMPTY_LIST = EmptyListType()
+
+INT_MIN = -(1 << 31)
+INT_MAX = (1 << 31) - 1
+
+
+class Interpreter:
+    """
+    Evaluates parsed programs in Python, following the semantics of
+    tmp_lisp.hpp. The AST is compiled once into nested code tuples, which
+    a machine with an explicit stack runs, so that deeply nested and deeply
+    recursive programs don't run out of Python's stack.
+
+    Variables are resolved to (depth, index) pairs at compile time. Let binds
+    like letrec: each binding is a thunk evaluated, at most once, in the
+    environment that already contains the whole let frame, and only if it is
+    looked up. Scoping is lexical, as with the Ref addresses lisp2cpp emits.
+    """
+
+    class Error(Exception):
+        pass
+
+    class Mismatch(Exception):
+        pass
+
+    class Closure:
+        __slots__ = ("arity", "body", "env")
+
+        def __init__(self, arity, body, env):
+            self.arity = arity
+            self.body = body
+            self.env = env
+
+    class Primitive(namedtuple("Primitive", ["op"])):
+        pass
+
+    class Frame:
+        __slots__ = ("values", "parent")
+
+        def __init__(self, values, parent):
+            self.values = values
+            self.parent = parent
+
+    class Thunk:
+        __slots__ = ("code", "env", "forcing")
+
+        def __init__(self, code, env):
+            self.code = code
+            self.env = env
+            self.forcing = False
+
+    def __init__(self, parse=None, count_evaluations=False):
+        """
+        With count_evaluations, evaluations counts how many times any form was
+        evaluated, which bounds how many Eval_ instantiations the template
+        backend needs. Without a parse, the interpreter can still apply
+        operators, e.g. to fold constants.
+        """
+        self.count_evaluations = count_evaluations
+        self.evaluations = 0
+        if parse is not None:
+            self.code = self._compile(parse, None)
+
+    @classmethod
+    def evaluate(cls, source):
+        return cls(Parser.parse(source)).run()
+
+    def run(self):
+        return self._execute(self.code, None)
+
+    # kinds of compiled code, the first item of its tuple
+    CONST, VAR, UNBOUND, IF, LAMBDA, LET, APPLY = range(7)
+
+    # kinds of work on the machine's stack, besides evaluating code
+    EVAL, BRANCH, FORCE, CALL = range(4)
+
+    def _compile(self, parse, scope):
+        """
+        Compile parse into nested code tuples, children before their parents
+        with an explicit stack, like codegen, so nesting is only limited by
+        memory.
+        """
+        results = []
+        # (form, its scope, how many compiled children it takes or None)
+        stack = [(parse, scope, None)]
+        while stack:
+            parse, scope, children = stack.pop()
+            if children is not None:
+                compiled = results[len(results) - children :]
+                del results[len(results) - children :]
+                results.append(self._compile_form(parse, compiled))
+                continue
+            subforms = self._subforms(parse, scope)
+            if subforms is None:
+                results.append(self._compile_leaf(parse, scope))
+                continue
+            stack.append((parse, scope, len(subforms)))
+            stack.extend((form, scope) + (None,) for form, scope in reversed(subforms))
+        return results.pop()
+
+    def _subforms(self, parse, scope):
+        # the forms parse evaluates, with their scopes, or None for a leaf
+        if isinstance(parse, IfExp):
+            return [(form, scope) for form in parse]
+        if isinstance(parse, LambdaExp):
+            names = [param.name for param in parse.arglist]
+            return [(parse.body, Scope(names, scope))]
+        if isinstance(parse, LetExp):
+            let_scope = Scope([binding.var.name for binding in parse.bindings], scope)
+            forms = [binding.value for binding in parse.bindings] + [parse.body]
+            return [(form, let_scope) for form in forms]
+        if isinstance(parse, SExp):
+            return [(form, scope) for form in (parse.operator, *parse.operands)]
+        return None
+
+    def _compile_form(self, parse, compiled):
+        if isinstance(parse, IfExp):
+            return (self.IF, *compiled)
+        if isinstance(parse, LambdaExp):
+            return (self.LAMBDA, len(parse.arglist), compiled[0])
+        if isinstance(parse, LetExp):
+            *values, body = compiled
+            return (self.LET, values, body)
+        operator, *operands = compiled
+        return (self.APPLY, operator, operands)
+
+    def _compile_leaf(self, parse, scope):
+        if isinstance(parse, bool):
+            return (self.CONST, parse)
+        if isinstance(parse, int):
+            return (self.CONST, self._check_int(parse))
+        if isinstance(parse, OpExp):
+            return (self.CONST, self.Primitive(parse.value))
+        if isinstance(parse, ListExp):
+            return (self.CONST, self._quoted(parse))
+        if isinstance(parse, VarExp):
+            address = scope.resolve(parse.name) if scope is not None else None
+            if address is None:
+                return (self.UNBOUND, parse.name)
+            return (self.VAR, *address)
+        raise self.Error(f"don't know how to evaluate {parse}")
+
+    def _quoted(self, parse):
+        # elements before the lists holding them, with an explicit stack
+        results = []
+        stack = [(parse, False)]
+        while stack:
+            value, ready = stack.pop()
+            if ready:
+                res = EMPTY_LIST
+                for _ in value.values:
+                    res = ConsCell(results.pop(), res)
+                results.append(res)
+            elif isinstance(value, ListExp):
+                stack.append((value, True))
+                stack.extend((item, False) for item in reversed(value.values))
+            elif isinstance(value, OpExp):
+                results.append(self.Primitive(value.value))
+            elif isinstance(value, bool):
+                results.append(value)
+            else:
+                results.append(self._check_int(value))
+        return results.pop()
+
+    def _execute(self, code, env):
+        """
+        Evaluate code in env. The machine keeps what is left to do on an
+        explicit stack and the values worked out so far on another, so
+        neither nesting nor recursion in the program uses Python's stack,
+        and a tail call doesn't grow the machine's.
+        """
+        EVAL, BRANCH, FORCE, CALL = self.EVAL, self.BRANCH, self.FORCE, self.CALL
+        CONST, VAR, IF, LAMBDA, LET, APPLY = (
+            self.CONST,
+            self.VAR,
+            self.IF,
+            self.LAMBDA,
+            self.LET,
+            self.APPLY,
+        )
+        Thunk, Frame = self.Thunk, self.Frame
+        values = []
+        todo = [(EVAL, code, env)]
+        while todo:
+            work, item, env = todo.pop()
+            if work == EVAL:
+                if self.count_evaluations:
+                    self.evaluations += 1
+                kind = item[0]
+                if kind == CONST:
+                    values.append(item[1])
+                elif kind == VAR:
+                    _, depth, index = item
+                    for _ in range(depth):
+                        env = env.parent
+                    value = env.values[index]
+                    if isinstance(value, Thunk):
+                        if value.forcing:
+                            raise self.Error("let binding depends on its own value")
+                        value.forcing = True
+                        todo.append((FORCE, index, env))
+                        todo.append((EVAL, value.code, value.env))
+                    else:
+                        values.append(value)
+                elif kind == IF:
+                    todo.append((BRANCH, item, env))
+                    todo.append((EVAL, item[1], env))
+                elif kind == LAMBDA:
+                    values.append(self.Closure(item[1], item[2], env))
+                elif kind == LET:
+                    frame = Frame(None, env)
+                    frame.values = [Thunk(value, frame) for value in item[1]]
+                    todo.append((EVAL, item[2], frame))
+                elif kind == APPLY:
+                    _, operator, operands = item
+                    todo.append((CALL, len(operands), None))
+                    todo.extend((EVAL, operand, env) for operand in reversed(operands))
+                    todo.append((EVAL, operator, env))
+                else:
+                    raise self.Error(f"unbound variable {item[1]}")
+            elif work == BRANCH:
+                branch = item[2] if self.truthy(values.pop()) else item[3]
+                todo.append((EVAL, branch, env))
+            elif work == FORCE:
+                # item is the index of the thunk in the frame env
+                env.values[item] = values[-1]
+            else:
+                args = values[len(values) - item :]
+                del values[len(values) - item :]
+                operator = values.pop()
+                if isinstance(operator, self.Closure):
+                    self._check_arity(operator, args)
+                    todo.append((EVAL, operator.body, Frame(args, operator.env)))
+                else:
+                    values.append(self.apply(operator, args))
+        return values.pop()
+
+    def _check_arity(self, closure, args):
+        if len(args) != closure.arity:
+            raise self.Error(
+                f"closure takes {closure.arity} arguments, got {len(args)}"
+            )
+
+    def apply(self, operator, args):
+        if isinstance(operator, self.Closure):
+            self._check_arity(operator, args)
+            return self._execute(operator.body, self.Frame(args, operator.env))
+        if isinstance(operator, self.Primitive):
+            return getattr(self, f"_op_{operator.op}")(args)
+        raise self.Error(f"can't apply {self.to_lisp(operator)}")
+
+    @staticmethod
+    def truthy(value):
+        # detail::ConvertToBool: only False and Int<0> are false
+        if isinstance(value, bool):
+            return value
+        return not (isinstance(value, int) and value == 0)
 
     @staticmethod
-    def name_to_cpp(lisp_var_name):
-        return re.sub(r"[^0-9a-zA-Z_\-!\?#]+", "_", lisp_var_name)
-
-    def _codegen_list(self, list_values):
-        if not list_values:
-            return "EmptyList"
-        head = self._codegen(list_values[0])
-        tail = self._codegen_list(list_values[1:])
-        return f"Cons<{head}, {tail}>"
-
-    def _codegen_var(self, name):
-        return f"Var_{self.name_to_cpp(name)}"
-
-    def _env_codegen(self, bindings):
-        bindings_codegen = ",".join(
-            f"Binding<{self._codegen(binding.var)}, {self._codegen(binding.value)}>".format()
-            for binding in bindings
+    def is_int(value):
+        return isinstance(value, int) and not isinstance(value, bool)
+
+    @classmethod
+    def _check_int(cls, value):
+        if not INT_MIN <= value <= INT_MAX:
+            raise cls.Error(f"{value} doesn't fit in an int")
+        return value
+
+    def _ints(self, op, args):
+        if not all(self.is_int(arg) for arg in args):
+            raise self.Error(f"{op} takes integers, got {self._show(args)}")
+        return args
+
+    def _bools(self, op, args):
+        if not all(isinstance(arg, bool) for arg in args):
+            raise self.Error(f"{op} takes booleans, got {self._show(args)}")
+        return args
+
+    def _arity(self, op, args, n):
+        if len(args) != n:
+            raise self.Error(f"{op} takes {n} arguments, got {len(args)}")
+        return args
+
+    def _show(self, args):
+        return " ".join(self.to_lisp(arg) for arg in args)
+
+    def _op_Add(self, args):
+        return self._check_int(sum(self._ints("+", args)))
+
+    def _op_Sub(self, args):
+        first, *rest = self._ints("-", args) or [None]
+        if first is None:
+            raise self.Error("- takes at least one argument")
+        if not rest:
+            return self._check_int(-first)
+        return self._check_int(first - sum(rest))
+
+    def _op_Mul(self, args):
+        res = 1
+        for arg in self._ints("*", args):
+            res = self._check_int(res * arg)
+        return res
+
+    def _op_Eq(self, args):
+        # a left fold of ==, so (= 2 2 2) compares true with 2 just like C++
+        if not args:
+            raise self.Error("= takes at least one argument")
+        if all(self.is_int(arg) for arg in args) or all(
+            isinstance(arg, bool) for arg in args
+        ):
+            res = functools.reduce(operator.eq, args)
+            if not isinstance(res, bool):
+                if res not in (0, 1):
+                    raise self.Error(f"narrowing {res} to a bool")
+                res = bool(res)
+            return res
+        return False
+
+    def _op_Leq(self, args):
+        lhs, rhs = self._ints("<=", self._arity("<=", args, 2))
+        return lhs <= rhs
+
+    def _op_Or(self, args):
+        return any(self._bools("or", args))
+
+    def _op_And(self, args):
+        return all(self._bools("and", args))
+
+    def _op_Not(self, args):
+        (arg,) = self._bools("not", self._arity("not", args, 1))
+        return not arg
+
+    def _op_Cons(self, args):
+        return ConsCell(*self._arity("cons", args, 2))
+
+    def _op_Car(self, args):
+        return self._cell("car", args).car
+
+    def _op_Cdr(self, args):
+        return self._cell("cdr", args).cdr
+
+    def _cell(self, op, args):
+        (arg,) = self._arity(op, args, 1)
+        if not isinstance(arg, ConsCell):
+            raise self.Error(f"{op} takes a cons, got {self.to_lisp(arg)}")
+        return arg
+
+    def _op_IsNull(self, args):
+        (arg,) = self._arity("null?", args, 1)
+        return arg is EMPTY_LIST
+
+    def _items(self, op, value):
+        items = []
+        while isinstance(value, ConsCell):
+            items.append(value.car)
+            value = value.cdr
+        if value is not EMPTY_LIST:
+            raise self.Error(f"{op} takes a list, got {self.to_lisp(value)}")
+        return items
+
+    @staticmethod
+    def _list(items):
+        res = EMPTY_LIST
+        for item in reversed(items):
+            res = ConsCell(item, res)
+        return res
+
+    def _op_Map(self, args):
+        f, value = self._arity("map", args, 2)
+        return self._list([self.apply(f, [item]) for item in self._items("map", value)])
+
+    def _op_Filter(self, args):
+        f, value = self._arity("filter", args, 2)
+        items = self._items("filter", value)
+        return self._list(
+            [item for item in items if self.truthy(self.apply(f, [item]))]
+        )
+
+    def _op_Foldl(self, args):
+        f, res, value = self._arity("foldl", args, 3)
+        for item in self._items("foldl", value):
+            res = self.apply(f, [item, res])
+        return res
+
+    def _op_Length(self, args):
+        (value,) = self._arity("length", args, 1)
+        return len(self._items("length", value))
+
+    def _op_Append(self, args):
+        return self._list([item for arg in args for item in self._items("append", arg)])
+
+    def _op_Reverse(self, args):
+        (value,) = self._arity("reverse", args, 1)
+        return self._list(self._items("reverse", value)[::-1])
+
+    @classmethod
+    def to_lisp(cls, value):
+        """
+        Scheme-style rendering of a value, e.g. (1 2 6) or #t
+        """
+        # text and values still to render, on an explicit stack so that deeply
+        # nested lists don't recurse; values are never strs
+        pieces = []
+        stack = [value]
+        while stack:
+            value = stack.pop()
+            if isinstance(value, str):
+                pieces.append(value)
+            elif isinstance(value, bool):
+                pieces.append("#t" if value else "#f")
+            elif isinstance(value, int):
+                pieces.append(str(value))
+            elif value is EMPTY_LIST:
+                pieces.append("()")
+            elif isinstance(value, ConsCell):
+                work = ["("]
+                while isinstance(value, ConsCell):
+                    if len(work) > 1:
+                        work.append(" ")
+                    work.append(value.car)
+                    value = value.cdr
+                if value is not EMPTY_LIST:
+                    work.extend((" . ", value))
+                work.append(")")
+                stack.extend(reversed(work))
+            elif isinstance(value, cls.Primitive):
+                pieces.append(f"#<op {value.op}>")
+            else:
+                pieces.append("#<closure>")
+        return "".join(pieces)
+
+    @classmethod
+    def to_cpp(cls, value):
+        """
+        The tmp_lisp.hpp type for a value, or None for closures and ops, which
+        have no canonical spelling.
+        """
+        results = []
+        # (value, None) spells value; (tail, cells) spells the list of cells
+        # ending in tail from the spellings of its cars (and tail) in results
+        stack = [(value, None)]
+        while stack:
+            value, cells = stack.pop()
+            if cells is not None:
+                count = len(cells) + (value is not EMPTY_LIST)
+                parts = results[len(results) - count :]
+                del results[len(results) - count :]
+                if None in parts:
+                    results.append(None)
+                elif value is EMPTY_LIST:
+                    results.append("List<" + ", ".join(parts) + ">")
+                else:
+                    # an improper list: pairs of Cons, ending in its last cdr
+                    *cars, tail = parts
+                    results.append(
+                        "".join(f"Cons<{car}, " for car in cars)
+                        + tail
+                        + ">" * len(cars)
+                    )
+            elif isinstance(value, bool):
+                results.append(f"Bool<{str(value).lower()}>")
+            elif isinstance(value, int):
+                results.append(f"Int<{value}>")
+            elif value is EMPTY_LIST:
+                results.append("EmptyList")
+            elif isinstance(value, ConsCell):
+                cells = []
+                while isinstance(value, ConsCell):
+                    cells.append(value.car)
+                    value = value.cdr
+                if value is EMPTY_LIST and all(type(car) is int for car in cells):
+                    results.append("IntList<" + ", ".join(map(str, cells)) + ">")
+                    continue
+                stack.append((value, cells))
+                if value is not EMPTY_LIST:
+                    stack.append((value, None))
+                stack.extend((car, None) for car in reversed(cells))
+            else:
+                results.append(None)
+        return results.pop()
+
+
+class Optimizer:
+    """
+    Partial evaluation of a parse before codegen, so that what Python can
+    work out in microseconds doesn't cost template instantiations. At level
+
+    1. applications of operators to literals are folded, with the semantics
+       (and errors) of the Interpreter, so a program that doesn't compile
+       still doesn't; ifs with a literal condition become the branch taken;
+       uses of let bindings to scalars and to other variables are replaced
+       by their values; and let bindings nothing uses are dropped, which
+       can't change a result since bindings are only evaluated when looked up.
+    2. also, calls of small lambdas a let binds, that don't refer to the
+       let's own names, are inlined, and applications of lambdas to values
+       (literals, lambdas and the parameters of enclosing lambdas, which are
+       already evaluated) become lets, so that level 1 can carry on with the
+       arguments. A let-bound variable isn't a value: an application forces
+       it, and so fails if it does, where a let binding it wouldn't.
+
+    Every round rewrites the tree bottom-up with an explicit stack, like
+    codegen; rounds are repeated until nothing changes.
+    """
+
+    levels = (0, 1, 2)
+
+    # the most forms a lambda may have to be inlined where it's called
+    inline_limit = 24
+
+    max_rounds = 16
+
+    # how a let binding is substituted in its scope: value replaces the name
+    # everywhere, or only where it is called; free is the names value uses
+    Entry = namedtuple("Entry", ["value", "free", "calls_only"])
+
+    NO_NAMES = frozenset()
+
+    def __init__(self, level=1, spans=None):
+        if level not in self.levels:
+            raise ValueError(f"unknown optimization level {level}")
+        self.level = level
+        self.spans = spans
+        self.interpreter = Interpreter()
+        self.counts = dict(
+            folded=0, branches=0, propagated=0, inlined=0, beta_reduced=0, dropped=0
+        )
+        self.rounds = 0
+
+    def optimize(self, parse):
+        if not self.level:
+            return parse
+        while self.rounds < self.max_rounds:
+            before = sum(self.counts.values())
+            parse = self._round(parse)
+            self.rounds += 1
+            if sum(self.counts.values()) == before:
+                break
+        return parse
+
+    def _round(self, parse):
+        # results holds (form, names free in form) for rewritten forms; forced
+        # is the names in scope that are lambda parameters, whose values have
+        # been evaluated
+        results = []
+        stack = [(parse, {}, self.NO_NAMES, None)]
+        while stack:
+            form, env, forced, children = stack.pop()
+            if children is not None:
+                rewritten = results[len(results) - children :]
+                del results[len(results) - children :]
+                results.append(self._rewrite(form, env, forced, rewritten))
+                continue
+            if isinstance(form, VarExp):
+                entry = env.get(form.name)
+                if entry is not None and not entry.calls_only:
+                    self.counts["propagated"] += 1
+                    results.append((entry.value, entry.free))
+                else:
+                    results.append((form, frozenset([form.name])))
+            elif isinstance(form, SExp):
+                stack.append((form, env, forced, 1 + len(form.operands)))
+                stack.extend(
+                    (operand, env, forced, None) for operand in reversed(form.operands)
+                )
+                stack.append((form.operator, env, forced, None))
+            elif isinstance(form, IfExp):
+                stack.append((form, env, forced, 3))
+                stack.extend(
+                    (exp, env, forced, None)
+                    for exp in (form.if_false, form.if_true, form.cond)
+                )
+            elif isinstance(form, LambdaExp):
+                names = {param.name for param in form.arglist}
+                stack.append((form, env, forced, 1))
+                stack.append(
+                    (form.body, self._shadow(env, names), forced | names, None)
+                )
+            elif isinstance(form, LetExp):
+                let_env = self._let_env(form, env)
+                let_forced = forced - {binding.var.name for binding in form.bindings}
+                stack.append((form, env, forced, 1 + len(form.bindings)))
+                stack.append((form.body, let_env, let_forced, None))
+                stack.extend(
+                    (binding.value, let_env, let_forced, None)
+                    for binding in reversed(form.bindings)
+                )
+            else:
+                results.append((form, self.NO_NAMES))
+        return results.pop()[0]
+
+    def _rewrite(self, form, env, forced, rewritten):
+        """
+        Returns form, with its children rewritten to rewritten, optimized one
+        level, and the names free in it.
+        """
+        forms = [child for child, _ in rewritten]
+        free = frozenset().union(*(names for _, names in rewritten))
+        if isinstance(form, SExp):
+            return self._rewrite_application(form, env, forced, forms, rewritten)
+        if isinstance(form, IfExp):
+            cond, if_true, if_false = rewritten
+            truthy = self._truthy(cond[0])
+            if truthy is not None:
+                self.counts["branches"] += 1
+                return if_true if truthy else if_false
+            return self._rebuilt(form, forms, lambda: IfExp(*forms)), free
+        if isinstance(form, LambdaExp):
+            names = {param.name for param in form.arglist}
+            res = self._rebuilt(form, forms, lambda: form._replace(body=forms[0]))
+            return res, free - names
+        assert isinstance(form, LetExp), form
+        return self._rewrite_let(form, rewritten)
+
+    def _rewrite_application(self, form, env, forced, forms, rewritten):
+        operator, *operands = forms
+        operator_free = rewritten[0][1]
+        operands_free = frozenset().union(*(names for _, names in rewritten[1:]))
+        if isinstance(operator, OpExp) and all(map(self._is_literal, operands)):
+            folded = self._fold(operator, operands)
+            if folded is not None:
+                self.counts["folded"] += 1
+                return folded, self.NO_NAMES
+        if self.level >= 2 and isinstance(operator, VarExp):
+            entry = env.get(operator.name)
+            if entry is not None and entry.calls_only:
+                self.counts["inlined"] += 1
+                operator, operator_free = entry.value, entry.free
+        if (
+            self.level >= 2
+            and isinstance(operator, LambdaExp)
+            and len(operator.arglist) == len(operands)
+            and all(self._is_value(operand, forced) for operand in operands)
+        ):
+            names = [param.name for param in operator.arglist]
+            # the bindings of a let see each other, unlike arguments
+            if len(set(names)) == len(names) and not operands_free & set(names):
+                self.counts["beta_reduced"] += 1
+                if not names:
+                    return operator.body, operator_free
+                bindings = [
+                    Binding(var=param, value=operand)
+                    for param, operand in zip(operator.arglist, operands)
+                ]
+                let = LetExp(bindings=bindings, body=operator.body)
+                if self.spans is not None:
+                    self.spans.copy(form, let)
+                return let, operator_free | operands_free
+        forms = [operator, *operands]
+        res = self._rebuilt(
+            form, forms, lambda: SExp(operator=operator, operands=operands)
+        )
+        return res, operator_free | operands_free
+
+    def _rewrite_let(self, form, rewritten):
+        *values, (body, body_free) = rewritten
+        names = [binding.var.name for binding in form.bindings]
+        name_set = set(names)
+        bindings = [
+            binding if value is binding.value else binding._replace(value=value)
+            for binding, (value, _) in zip(form.bindings, values)
+        ]
+        frees = [free for _, free in values]
+        if len(name_set) == len(names):
+            # what the body uses, and what that uses in turn
+            free_of = dict(zip(names, frees))
+            live = set()
+            pending = list(body_free & name_set)
+            while pending:
+                name = pending.pop()
+                if name not in live:
+                    live.add(name)
+                    pending.extend(free_of[name] & name_set)
+            if len(live) < len(names):
+                self.counts["dropped"] += len(names) - len(live)
+                kept = [ix for ix, name in enumerate(names) if name in live]
+                bindings = [bindings[ix] for ix in kept]
+                frees = [frees[ix] for ix in kept]
+            if not bindings:
+                return body, body_free
+        free = body_free.union(*frees) - name_set
+        unchanged = len(bindings) == len(form.bindings) and body is form.body
+        res = self._rebuilt(
+            form,
+            [*bindings, body] if unchanged else [],
+            lambda: LetExp(bindings=bindings, body=body),
+        )
+        return res, free
+
+    def _let_env(self, form, env):
+        names = [binding.var.name for binding in form.bindings]
+        name_set = set(names)
+        res = dict(self._shadow(env, name_set))
+        for binding in form.bindings:
+            name, value = binding.var.name, binding.value
+            if names.count(name) > 1:
+                continue
+            if self._is_scalar(value):
+                res[name] = self.Entry(value, self.NO_NAMES, False)
+            elif isinstance(value, VarExp) and value.name not in name_set:
+                res[name] = self.Entry(value, frozenset([value.name]), False)
+            elif self.level >= 2 and isinstance(value, LambdaExp):
+                free = self._small_free(value)
+                if free is not None and not free & name_set:
+                    res[name] = self.Entry(value, free, True)
+        return res
+
+    @staticmethod
+    def _shadow(env, names):
+        # what a binder of names leaves of env: substitutions for other names
+        # whose values don't use names
+        if not env:
+            return env
+        return {
+            name: entry
+            for name, entry in env.items()
+            if name not in names and not entry.free & names
+        }
+
+    def _small_free(self, form):
+        """
+        The names free in form, or None if form has over inline_limit forms.
+        """
+        size = 0
+        free = set()
+        stack = [(form, frozenset())]
+        while stack:
+            form, bound = stack.pop()
+            size += 1
+            if size > self.inline_limit:
+                return None
+            if isinstance(form, VarExp):
+                if form.name not in bound:
+                    free.add(form.name)
+            elif isinstance(form, SExp):
+                stack.extend(
+                    (child, bound) for child in (form.operator, *form.operands)
+                )
+            elif isinstance(form, IfExp):
+                stack.extend((child, bound) for child in form)
+            elif isinstance(form, LambdaExp):
+                names = bound | {param.name for param in form.arglist}
+                stack.append((form.body, names))
+            elif isinstance(form, LetExp):
+                names = bound | {binding.var.name for binding in form.bindings}
+                stack.append((form.body, names))
+                stack.extend((binding.value, names) for binding in form.bindings)
+        return frozenset(free)
+
+    def _rebuilt(self, form, children, build):
+        """
+        form itself if children are its children, so that it keeps its
+        identity and span, else form built from new ones with build.
+        """
+        if len(children) == len(self._children(form)) and all(
+            new is old for new, old in zip(children, self._children(form))
+        ):
+            return form
+        res = build()
+        if self.spans is not None:
+            self.spans.copy(form, res)
+        return res
+
+    @staticmethod
+    def _children(form):
+        # in the order _round rewrites them
+        if isinstance(form, SExp):
+            return [form.operator, *form.operands]
+        if isinstance(form, IfExp):
+            return list(form)
+        if isinstance(form, LambdaExp):
+            return [form.body]
+        return [*form.bindings, form.body]
+
+    @staticmethod
+    def _is_literal(form):
+        return isinstance(form, (OpExp, ListExp)) or (
+            isinstance(form, int) and INT_MIN <= form <= INT_MAX
+        )
+
+    @classmethod
+    def _is_scalar(cls, form):
+        # a literal that is cheap to repeat wherever it is used
+        return (
+            cls._is_literal(form) and not isinstance(form, ListExp)
+        ) or form == ListExp(values=[])
+
+    def _truthy(self, form):
+        # whether If takes the true branch on form, or None if it isn't known
+        if not self._is_literal(form):
+            return None
+        try:
+            return Interpreter.truthy(self._value(form))
+        except Interpreter.Error:
+            return None
+
+    @classmethod
+    def _is_value(cls, form, forced):
+        # evaluating it can't fail, so it needn't be evaluated eagerly
+        return (
+            cls._is_literal(form)
+            or isinstance(form, LambdaExp)
+            or (isinstance(form, VarExp) and form.name in forced)
+        )
+
+    def _value(self, literal):
+        if isinstance(literal, ListExp):
+            return self.interpreter._quoted(literal)
+        if isinstance(literal, OpExp):
+            return Interpreter.Primitive(literal.value)
+        if isinstance(literal, bool):
+            return literal
+        return Interpreter._check_int(literal)
+
+    def _fold(self, operator, operands):
+        try:
+            value = self.interpreter.apply(
+                Interpreter.Primitive(operator.value), list(map(self._value, operands))
+            )
+        except Interpreter.Error:
+            return None
+        return self._literal(value)
+
+    @classmethod
+    def _literal(cls, value):
+        """
+        The literal spelling value, or None if it has none, e.g. a closure or
+        an improper list.
+        """
+        if isinstance(value, (bool, int)):
+            return value
+        if isinstance(value, Interpreter.Primitive):
+            return OpExp(value.op)
+        values = []
+        while isinstance(value, ConsCell):
+            item = cls._literal(value.car)
+            if item is None:
+                return None
+            values.append(item)
+            value = value.cdr
+        if value is not EMPTY_LIST:
+            return None
+        return ListExp(values=values)
+
+    def report(self, original, optimized, backend="templates"):
+        """
+        How much smaller optimized is than original: generated code, forms,
+        and how many times the Interpreter evaluates a form (None if it fails
+        to), which bounds the Eval_ instantiations of the template backend.
+        """
+        res = dict(level=self.level, rounds=self.rounds, **self.counts)
+        for key, parse in (("before", original), ("after", optimized)):
+            code = Lisp2Cpp.from_parse(parse, backend=backend).codegen()
+            res[f"bytes_{key}"] = len(code)
+            res[f"forms_{key}"] = tree_size(parse)[0]
+            interpreter = Interpreter(parse, count_evaluations=True)
+            try:
+                interpreter.run()
+                res[f"evaluations_{key}"] = interpreter.evaluations
+            except Interpreter.Error:
+                res[f"evaluations_{key}"] = None
+        return res
+
+
+def differential_check(lisp2cpp, compiler):
+    """
+    Evaluate the program both with the Interpreter and with the template
+    backend, and raise Interpreter.Mismatch unless they agree: same value, or
+    both failing (in which case the interpreter's error is re-raised).
+    """
+    try:
+        value = Interpreter(lisp2cpp.parse).run()
+        error = None
+    except Interpreter.Error as e:
+        value = None
+        error = e
+
+    code = lisp2cpp.codegen()
+    expected = None if error is not None else Interpreter.to_cpp(value)
+    if expected is not None:
+        code += (
+            "\n#include <type_traits>\n"
+            f"static_assert(std::is_same<Result, {expected}>::value);\n"
+        )
+    res = compiler.compile(code)
+
+    if error is not None and res.returncode == 0:
+        raise Interpreter.Mismatch(f"interpreter failed ({error}) but C++ compiled")
+    if error is None and res.returncode != 0:
+        raise Interpreter.Mismatch(
+            f"interpreter gave {Interpreter.to_lisp(value)}, C++ failed:\n{res.stderr}"
+        )
+    if error is not None:
+        raise error
+    return value
+
+
+BatchResult = namedtuple("BatchResult", ["text", "expected", "ok", "diagnostics"])
+
+
+class Batch:
+    """
+    Many programs, each with an optional expected Result type, checked in a
+    single translation unit. Program i lives in namespace tmp_lisp_batch_i,
+    is exported as Result_i and gets its own static_assert. Diagnostics are
+    mapped back to programs by the lines they point at. If the compiler stops
+    early, say at a fatal error, the programs after the last line it got to
+    weren't checked, and fail.
+    """
+
+    location_regex = re.compile(r"^<stdin>:(\d+):", re.MULTILINE)
+    stopped_regex = re.compile(
+        r"fatal error:|compilation terminated|too many errors emitted"
+    )
+
+    def __init__(self, cases, backend="templates"):
+        self.cases = [(text, expected) for text, expected in cases]
+        self.backend = backend
+
+    def codegen(self):
+        """
+        Returns the translation unit and, per case, the range of its lines.
+        """
+        code = io.StringIO()
+        # counts lines as they are written, rather than recounting the code
+        out = CountingWriter(code, count_lines=True)
+        out.write(Lisp2Cpp.include.replace("\r", ""))
+        out.write("#include <type_traits>\n\n")
+        line_ranges = []
+        for ix, (text, expected) in enumerate(self.cases):
+            first_line = out.lines + 1
+            out.write(f"namespace tmp_lisp_batch_{ix} {{\n")
+            Lisp2Cpp(text, backend=self.backend).emit_program(out)
+            out.write(f"\n}}\nusing Result_{ix} = tmp_lisp_batch_{ix}::Result;\n")
+            if expected is not None:
+                out.write(
+                    f"static_assert(std::is_same<Result_{ix}, {expected}>::value, "
+                    f'"batch case {ix}");\n'
+                )
+            out.write("\n")
+            line_ranges.append(range(first_line, out.lines + 1))
+        return code.getvalue(), line_ranges
+
+    def results(self, compile_result, line_ranges):
+        diagnostics = [[] for _ in self.cases]
+        unattributed = []
+        # the last line of the translation unit the compiler said anything about
+        reached = 0
+        for line in compile_result.stderr.splitlines():
+            m = self.location_regex.match(line)
+            owner = None
+            if m:
+                lineno = int(m.group(1))
+                reached = max(reached, lineno)
+                for ix, line_range in enumerate(line_ranges):
+                    if lineno in line_range:
+                        owner = ix
+                        break
+            (diagnostics[owner] if owner is not None else unattributed).append(line)
+
+        failed = compile_result.returncode != 0
+        # a failure we can't pin on any case (say, in the prelude) fails them all
+        blame_all = failed and not any(diagnostics)
+        # and if the compiler stopped early, the cases after the last line it
+        # got to weren't checked
+        stopped = failed and (
+            compile_result.returncode < 0
+            or self.stopped_regex.search(compile_result.stderr) is not None
+        )
+        for diags, line_range in zip(diagnostics, line_ranges):
+            if stopped and not blame_all and not diags and line_range.start > reached:
+                diags.append(f"not checked: the compiler stopped at <stdin>:{reached}")
+        return [
+            BatchResult(
+                text=text,
+                expected=expected,
+                ok=not (diags or blame_all),
+                diagnostics="\n".join(diags or (unattributed if blame_all else [])),
+            )
+            for (text, expected), diags in zip(self.cases, diagnostics)
+        ]
+
+    def run(self, compiler):
+        code, line_ranges = self.codegen()
+        return self.results(compiler.compile(code), line_ranges)
+
+
+def check_batch(cases, compiler, jobs=None, backend="templates"):
+    """
+    Check many (lisp text, expected type or None) cases, sharded into one
+    batch per worker and compiled in parallel. Returns a BatchResult per case,
+    in order.
+    """
+    cases = list(cases)
+    if not cases:
+        return []
+    jobs = min(jobs or available_cores(), len(cases))
+    shard_size = -(-len(cases) // jobs)
+    batches = [
+        Batch(cases[start : start + shard_size], backend)
+        for start in range(0, len(cases), shard_size)
+    ]
+    codegens = [batch.codegen() for batch in batches]
+    compile_results = compiler.compile_many([code for code, _ in codegens], jobs)
+
+    res = []
+    for batch, (_, line_ranges), compile_result in zip(
+        batches, codegens, compile_results
+    ):
+        res.extend(batch.results(compile_result, line_ranges))
+    return res
+
+
+class Module(Lisp2Cpp):
+    """
+    A file of top-level forms: (require "path") of other modules, (define var
+    value) and at most one other expression, the module's Result. Definitions
+    are mutually recursive, like the bindings of one letrec, and see those of
+    the modules required directly.
+
+    It is transpiled into a header of its own, namespace name_space, in which
+    every definition is a using alias. A required module's definitions are
+    spelled as its aliases, so a module's header is only regenerated when it
+    or what it requires changes.
+    """
+
+    def __init__(self, source, name_space="tmp_lisp_module", required=None):
+        self.requires = []
+        self.definitions = []
+        self.body = None
+        for form in Parser.parse_forms(source):
+            if isinstance(form, RequireExp):
+                self.requires.append(form.path)
+            elif isinstance(form, DefineExp):
+                self.definitions.append(form)
+            elif self.body is not None:
+                raise self.ConvertError("a module has at most one expression")
+            else:
+                self.body = form
+        self.backend = "templates"
+        self.scope = Scope([define.var.name for define in self.definitions], None)
+        self.link(name_space, required or {})
+
+    def link(self, name_space, required):
+        """
+        Set the module's namespace and what it requires, as a dict from the
+        namespace of each required module to the names it defines.
+        """
+        self.name_space = name_space
+        self.globals = {}
+        for module_space, names in required.items():
+            self.globals.update(
+                (name, f"{module_space}::{self.alias(name)}") for name in names
+            )
+        self.unbound = {}
+        rec_scope = Scope(self.scope.names, None, captures={})
+        for define in self.definitions:
+            self._find_unbound(define.value, rec_scope, self.unbound)
+        if self.body is not None:
+            self._find_unbound(self.body, self.scope, self.unbound)
+
+    @property
+    def names(self):
+        return list(dict.fromkeys(self.scope.names))
+
+    @staticmethod
+    def alias(name):
+        # a C++ identifier for a Lisp name: def_ followed by its letters and
+        # digits, anything else escaped as _hex_, so distinct names stay
+        # distinct and none is a keyword
+        return "def_" + re.sub(r"[^A-Za-z0-9]", lambda m: f"_{ord(m.group()):x}_", name)
+
+    def emit_header(self, sink, includes=()):
+        """
+        Write the module's header: include guards, the headers of the modules
+        it requires, named in includes, and its definitions.
+        """
+        guard = f"{self.name_space.upper()}_HPP"
+        sink.write(f"#ifndef {guard}\n#define {guard}\n\n")
+        sink.write(self.include.replace("\r", ""))
+        for include in includes:
+            sink.write(f'#include "{include}"\n')
+        sink.write(f"\nnamespace {self.name_space} {{\n")
+        self.emit_program(sink)
+        sink.write(f"\n}} // namespace {self.name_space}\n\n#endif // {guard}\n")
+
+    def emit_program(self, sink):
+        self.emit_definitions(sink)
+        self.emit_result(sink)
+
+    def emit_definitions(self, sink):
+        self._emit_unbound(sink)
+        # every alias is a Letrec over the same bindings, so they share one
+        # RecFrame and the instantiations made through it
+        rec_scope = Scope(self.scope.names, None, captures={})
+        sink.write("using Definitions = Rec<")
+        for ix, value in enumerate(self._rec_values(self.definitions)):
+            if ix:
+                sink.write(",")
+            for fragment in self._fragments(value, rec_scope):
+                sink.write(fragment)
+        sink.write(">;\n")
+        for name in self.names:
+            address = "Ref<%d, %d>" % self.scope.resolve(name)
+            sink.write(
+                f"using {self.alias(name)} = "
+                f"Eval<Letrec<{address}, Definitions>, EmptyFrames>; // {name}\n"
+            )
+
+    def emit_result(self, sink):
+        if self.body is not None:
+            sink.write("using Result = Eval<Letrec<")
+            for fragment in self._fragments(self.body, self.scope):
+                sink.write(fragment)
+            sink.write(", Definitions>, EmptyFrames>;\n")
+
+
+class ModuleBuilder:
+    """
+    Transpiles a module and those it requires into headers in directory, one
+    per module, and keeps a manifest of what they were built from. A module
+    is re-transpiled only when its source, or the key of a module it
+    requires, has changed; its key hashes both, so editing one module
+    rebuilds it and its dependents only.
+    """
+
+    class Error(Exception):
+        pass
+
+    manifest_name = "manifest.json"
+
+    # bumped whenever the generated headers, or the manifest, change shape
+    version = "2"
+
+    ModuleInfo = namedtuple("ModuleInfo", ["path", "key", "header", "name_space"])
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, self.manifest_name)
+        try:
+            with open(self.manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+        # the modules transpiled by this builder, in order
+        self.transpiled = []
+
+    @staticmethod
+    def module_id(path):
+        stem = re.sub(r"\W", "_", os.path.splitext(os.path.basename(path))[0])
+        return f"{stem}_{sha256(path)[:8]}"
+
+    def build(self, path):
+        """
+        Bring the header of the module at path, and of everything it
+        requires, up to date. Returns its ModuleInfo.
+        """
+        built = {}
+        res = self._build(os.path.realpath(path), built, [])
+        self._save_manifest()
+        return res
+
+    def _build(self, path, built, requiring):
+        if path in requiring:
+            cycle = " -> ".join([*requiring[requiring.index(path) :], path])
+            raise self.Error(f"circular require: {cycle}")
+        if path in built:
+            return built[path]
+
+        try:
+            with open(path, "r") as f:
+                source = f.read()
+        except OSError as e:
+            raise self.Error(f"can't read module {path}: {e}")
+        source_hash = sha256(source)
+        entry = self.manifest.get(path)
+        module = None
+        if entry is not None and entry["source"] == source_hash:
+            requires = entry["requires"]
+        else:
+            module = self._parse(source, path)
+            requires = [
+                os.path.realpath(os.path.join(os.path.dirname(path), required))
+                for required in module.requires
+            ]
+
+        deps = [self._build(dep, built, [*requiring, path]) for dep in requires]
+        key = sha256(self.version, source_hash, *(dep.key for dep in deps))
+        module_id = self.module_id(path)
+        info = self.ModuleInfo(
+            path=path,
+            key=key,
+            header=os.path.join(self.directory, f"{module_id}.hpp"),
+            name_space=f"tmp_lisp_module_{module_id}",
         )
-        return f"Env<{bindings_codegen}>"
+        if entry is None or entry["key"] != key or not os.path.exists(info.header):
+            required = {
+                dep.name_space: self.manifest[dep.path]["names"] for dep in deps
+            }
+            if module is None:
+                module = self._parse(source, path)
+            module.link(info.name_space, required)
+            self._transpile(module, [dep.header for dep in deps], info)
+            self.manifest[path] = {
+                "source": source_hash,
+                "requires": requires,
+                "key": key,
+                "names": module.names,
+                "has_result": module.body is not None,
+            }
+            self.transpiled.append(path)
+        built[path] = info
+        return info
+
+    def _parse(self, source, path):
+        try:
+            return Module(source)
+        except (Parser.Error, Lisp2Cpp.ConvertError) as e:
+            raise self.Error(f"{path}: {e}")
+
+    def _transpile(self, module, includes, info):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            module.emit_header(f, [os.path.basename(include) for include in includes])
+        os.replace(tmp_path, info.header)
+
+    def _save_manifest(self):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def program(self, path, evaluate=False, serialize=False):
+        """
+        Build the module at path and return a translation unit evaluating its
+        Result. The key of the module is part of the code, so compile caches
+        keyed on the code see edits to any module it requires.
+        """
+        info = self.build(path)
+        if not self.manifest[info.path]["has_result"]:
+            raise self.Error(f"{path}: module has no body expression")
+        res = (
+            f"{Lisp2Cpp.include}// tmp_lisp module {info.key}\n"
+            f'#include "{info.header}"\n\n'
+            f"using Result = {info.name_space}::Result;"
+        )
+        if evaluate:
+            res += "\n\nResult::force_compiler_error eval;"
+        if serialize:
+            res += Lisp2Cpp.serialize_result
+        return res
+
+
+class Repl:
+    """
+    Evaluates inputs one after another, each a Module whose definitions stay
+    in scope for the inputs after it. Definitions are only transpiled once:
+    an input's aliases live in a namespace of their own, later inputs refer to
+    them by name, and once they compile they join the compiler's prelude,
+    which is precompiled when the compiler uses a PCH. So each step only
+    makes the compiler process the new input; without a PCH, each step
+    recompiles the whole prelude.
+
+    Later definitions of a name shadow earlier ones; definitions that call
+    each other must be made in the same input.
+    """
+
+    class Error(Exception):
+        pass
+
+    Step = namedtuple("Step", ["result", "names", "seconds"])
+
+    def __init__(self, compiler):
+        self.compiler = compiler
+        self.compiler.prelude = Lisp2Cpp.include.replace("\r", "")
+        # namespace of each step with definitions: the names it defines
+        self.required = {}
+
+    def feed(self, text):
+        """
+        Evaluate one input. Returns a Step with the type its expression
+        evaluates to, or None if it only defines, the names it defined and how
+        long it took. Raises Repl.Error, keeping no definitions, if it fails.
+        """
+        start = time.perf_counter()
+        name_space = f"tmp_lisp_repl_{len(self.required)}"
+        try:
+            module = Module(text, name_space, self.required)
+        except (Parser.Error, Lexer.Error, Lisp2Cpp.ConvertError) as e:
+            raise self.Error(str(e))
+        if module.requires:
+            raise self.Error("require isn't supported in the REPL")
+
+        definitions = io.StringIO()
+        definitions.write(f"namespace {name_space} {{\n")
+        module.emit_definitions(definitions)
+        definitions.write(f"}} // namespace {name_space}\n")
+        code = definitions.getvalue()
+        if module.body is not None:
+            out = io.StringIO()
+            out.write(f"namespace {name_space} {{\n")
+            module.emit_result(out)
+            out.write(f"}} // namespace {name_space}\n")
+            code += out.getvalue() + f"{name_space}::Result::force_compiler_error eval;"
+
+        try:
+            res = self.compiler.compile(code)
+        except Compiler.Error as e:
+            raise self.Error(str(e))
+        result = res.result if module.body is not None else None
+        # the only error may be the one asking for the result's type
+        errors = [
+            line
+            for line in res.stderr.splitlines()
+            if "error:" in line and "force_compiler_error" not in line
+        ]
+        if res.returncode != 0 and (errors or result is None):
+            raise self.Error("\n".join(errors) or res.stderr)
+        if module.names:
+            self.required[name_space] = module.names
+            self.compiler.prelude += definitions.getvalue()
+        return self.Step(result, module.names, time.perf_counter() - start)
+
+    def run(self, stdin, stdout, prompt="> "):
+        """
+        Read inputs from stdin until EOF, printing each result and its
+        latency. An input ends with the line that closes its last form.
+        """
+        lines = []
+        while True:
+            if prompt and stdin.isatty():
+                stdout.write("  " if lines else prompt)
+                stdout.flush()
+            line = stdin.readline()
+            if not line:
+                return
+            lines.append(line)
+            text = "".join(lines)
+            if not text.strip() or self._incomplete(text):
+                if not text.strip():
+                    lines = []
+                continue
+            lines = []
+            try:
+                step = self.feed(text)
+            except self.Error as e:
+                stdout.write(f"error: {e}\n")
+                continue
+            if step.result is not None:
+                stdout.write(f"{step.result}\n")
+            elif step.names:
+                stdout.write(f"; defined {' '.join(step.names)}\n")
+            stdout.write(f"; {step.seconds * 1000:.0f} ms\n")
+            stdout.flush()
+
+    @staticmethod
+    def _incomplete(text):
+        try:
+            for _ in Parser.parse_forms(text):
+                pass
+        except Parser.Error as e:
+            return str(e) == "unexpected end of input"
+        except Lexer.Error:
+            return False
+        return False
+
+
+@functools.lru_cache(maxsize=None)
+def tool_digest():
+    """
+    Hash of this transpiler's source, standing in for its version: output
+    written by an edited lisp2cpp.py is never mistaken for up to date.
+    """
+    with open(os.path.realpath(__file__), "rb") as f:
+        return sha256(f.read())
+
+
+TranspileTask = namedtuple(
+    "TranspileTask", ["source", "output", "key_prefix", "previous_key", "options"]
+)
+
+TranspileOutcome = namedtuple(
+    "TranspileOutcome", ["source", "key", "size", "skipped", "error"]
+)
+
+
+def transpile_file(task):
+    """
+    Transpile one file for DirectoryTranspiler, in a worker process. The
+    source is hashed here, so skipping an unchanged file costs one read.
+    """
+    try:
+        with open(task.source, "r") as f:
+            text = f.read()
+    except OSError as e:
+        return TranspileOutcome(task.source, None, 0, False, str(e))
+    except ValueError as e:
+        # UnicodeDecodeError included: a file that isn't text fails alone
+        error = f"{type(e).__qualname__}: {e}"
+        return TranspileOutcome(task.source, None, 0, False, error)
+    key = sha256(task.key_prefix, text)
+    size = len(text.encode())
+    if key == task.previous_key and os.path.exists(task.output):
+        return TranspileOutcome(task.source, key, size, True, None)
+    try:
+        lisp2cpp = Lisp2Cpp(text, **task.options)
+        directory = os.path.dirname(task.output)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                lisp2cpp.emit(f)
+                f.write("\n")
+            os.replace(tmp_path, task.output)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    except (Parser.Error, Lexer.Error, Lisp2Cpp.ConvertError) as e:
+        error = f"{type(e).__qualname__}: {e}"
+        return TranspileOutcome(task.source, None, size, False, error)
+    return TranspileOutcome(task.source, key, size, False, None)
+
+
+class DirectoryTranspiler:
+    """
+    Transpiles every .scm file under some directories or glob patterns into
+    output_dir, one .cpp per input at its path relative to root (by default
+    the current directory), across a pool of worker processes.
+    output_dir/index.json records the key each output was built from (this
+    tool's digest, the options and the source), so a rerun skips the inputs
+    that haven't changed, whichever patterns named them.
+    """
+
+    class Error(Exception):
+        pass
+
+    index_name = "index.json"
+
+    Stats = namedtuple(
+        "Stats", ["files", "transpiled", "skipped", "failed", "bytes", "seconds"]
+    )
+
+    def __init__(self, output_dir, jobs=None, root=None, **options):
+        self.output_dir = output_dir
+        self.jobs = jobs or available_cores()
+        self.root = os.path.realpath(root or os.getcwd())
+        self.options = options
+        self.index_path = os.path.join(output_dir, self.index_name)
+        # source path, relative to root: error message
+        self.errors = {}
+
+    @staticmethod
+    def expand(patterns):
+        """
+        The files named by patterns: directories are searched recursively for
+        .scm files, anything else is a glob (or a plain path).
+        """
+        res = []
+        for pattern in patterns:
+            if os.path.isdir(pattern):
+                matches = glob.glob(
+                    os.path.join(pattern, "**", "*.scm"), recursive=True
+                )
+            else:
+                matches = glob.glob(pattern, recursive=True)
+            res.extend(sorted(os.path.realpath(match) for match in matches))
+        return list(dict.fromkeys(path for path in res if os.path.isfile(path)))
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        os.makedirs(self.output_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.output_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+    def run(self, patterns):
+        start = time.perf_counter()
+        sources = self.expand(patterns)
+        root = self.root
+        for source in sources:
+            if os.path.commonpath([root, source]) != root:
+                raise self.Error(f"{source} is outside the root {root}")
+        key_prefix = sha256(tool_digest(), json.dumps(self.options, sort_keys=True))
+        index = self._load_index()
+        tasks = []
+        for source in sources:
+            name = os.path.relpath(source, root)
+            output = os.path.join(self.output_dir, os.path.splitext(name)[0] + ".cpp")
+            previous_key = index.get(name, {}).get("key")
+            tasks.append(
+                TranspileTask(source, output, key_prefix, previous_key, self.options)
+            )
+
+        if self.jobs == 1 or len(tasks) <= 1:
+            outcomes = list(map(transpile_file, tasks))
+        else:
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                # chunks amortize the round trip to a worker over many files
+                chunksize = max(1, len(tasks) // (4 * self.jobs))
+                outcomes = list(
+                    executor.map(transpile_file, tasks, chunksize=chunksize)
+                )
+
+        self.errors = {}
+        for task, outcome in zip(tasks, outcomes):
+            name = os.path.relpath(task.source, root)
+            if outcome.error is not None:
+                self.errors[name] = outcome.error
+                index.pop(name, None)
+                continue
+            index[name] = {
+                "key": outcome.key,
+                "output": os.path.relpath(task.output, self.output_dir),
+            }
+        self._save_index(index)
+
+        skipped = sum(outcome.skipped for outcome in outcomes)
+        return self.Stats(
+            files=len(outcomes),
+            transpiled=len(outcomes) - skipped - len(self.errors),
+            skipped=skipped,
+            failed=len(self.errors),
+            bytes=sum(outcome.size for outcome in outcomes),
+            seconds=time.perf_counter() - start,
+        )
+
+    @staticmethod
+    def summary(stats):
+        seconds = max(stats.seconds, 1e-9)
+        return (
+            f"{stats.files} files ({stats.transpiled} transpiled, {stats.skipped} "
+            f"up to date, {stats.failed} failed) in {stats.seconds:.2f} s: "
+            f"{stats.files / seconds:.1f} files/s, "
+            f"{stats.bytes / seconds / 1e6:.2f} MB/s"
+        )
+
+
+def tree_size(parse):
+    """
+    Returns the number of nodes of a parse and how deeply they nest.
+    """
+    nodes = depth = 0
+    stack = [(parse, 1)]
+    while stack:
+        item, item_depth = stack.pop()
+        if isinstance(item, Node):
+            nodes += 1
+            depth = max(depth, item_depth)
+            stack.extend((child, item_depth + 1) for child in item)
+        elif isinstance(item, (list, tuple)):
+            stack.extend((child, item_depth) for child in item)
+    return nodes, depth
+
+
+class Timings:
+    """
+    Runs the pipeline one stage at a time and measures each: lex, parse,
+    optimize (with an optimization level), resolve (finding unbound
+    variables), codegen, header (the include line or the pasted header) and,
+    given a compiler, compile. report() gives the wall
+    time and peak memory of every stage and the sizes of what went through
+    them, as a flat JSON-able dict so that reports of many builds are easy to
+    aggregate.
+
+    Unlike Lisp2Cpp, all tokens are lexed before parsing starts, so that the
+    two can be told apart. The peak memory of a Python stage is the most
+    tracemalloc saw allocated at once beyond what the stage started with;
+    tracing slows those stages down, so trace_memory can be turned off. That
+    of compile is the largest resident size of the compiler process, or None
+    if the result came from the cache.
+    """
+
+    version = 1
+
+    Stage = namedtuple("Stage", ["name", "seconds", "peak_bytes"])
+
+    def __init__(
+        self,
+        text,
+        backend="templates",
+        heap_cells=DEFAULT_HEAP_CELLS,
+        include_header=False,
+        evaluate=False,
+        serialize=False,
+        compiler=None,
+        trace_memory=True,
+        optimize=0,
+        share=False,
+    ):
+        self.text = text
+        self.options = dict(backend=backend, heap_cells=heap_cells, share=share)
+        self.optimize = optimize
+        self.include_header = include_header
+        self.evaluate = evaluate
+        self.serialize = serialize
+        self.compiler = compiler
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.counts = {}
+        self.code = None
+        self.compile_result = None
+
+    def run(self):
+        """
+        Run every stage, keeping the generated code in code and, with a
+        compiler, its CompileResult in compile_result. Returns self.
+        """
+        tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        try:
+            self._run()
+        finally:
+            if tracing:
+                tracemalloc.stop()
+        return self
+
+    def _run(self):
+        with self._stage("lex"):
+            tokens = list(lisp_lexer.tokens(self.text))
+        with self._stage("parse"):
+            parse = Parser(Parser.Tokenizer.from_tokens(tokens)).parse_exp()
+        if self.optimize:
+            with self._stage("optimize"):
+                parse = Optimizer(self.optimize).optimize(parse)
+        with self._stage("resolve"):
+            lisp2cpp = Lisp2Cpp.from_parse(parse, **self.options)
+        with self._stage("codegen"):
+            program = io.StringIO()
+            lisp2cpp.emit_program(program)
+        with self._stage("header"):
+            out = io.StringIO()
+            if self.include_header:
+                lisp2cpp._emit_header(out)
+            else:
+                out.write(lisp2cpp.include)
+            out.write(program.getvalue())
+            if self.evaluate:
+                out.write("\n\nResult::force_compiler_error eval;")
+            if self.serialize:
+                out.write(lisp2cpp.serialize_result)
+            self.code = out.getvalue()
+
+        nodes, depth = tree_size(parse)
+        self.counts = dict(
+            source_bytes=len(self.text.encode()),
+            tokens=len(tokens),
+            ast_nodes=nodes,
+            ast_depth=depth,
+            program_bytes=len(program.getvalue().encode()),
+            code_bytes=len(self.code.encode()),
+        )
+
+        if self.compiler is not None:
+            self._compile()
+
+    def _compile(self):
+        cache = self.compiler.cache
+        hits = cache.hits if cache is not None else 0
+        start = time.perf_counter()
+        self.compile_result = self.compiler.compile(
+            self.code, serialized=self.serialize
+        )
+        seconds = time.perf_counter() - start
+        self.stages.append(
+            self.Stage("compile", seconds, self.compile_result.peak_bytes)
+        )
+        self.counts["compile_returncode"] = self.compile_result.returncode
+        self.counts["compile_cached"] = cache is not None and cache.hits > hits
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            before, _ = tracemalloc.get_traced_memory()
+        start = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1] - before if tracing else None
+        self.stages.append(self.Stage(name, seconds, peak))
+
+    def report(self):
+        res = dict(
+            version=self.version,
+            backend=self.options["backend"],
+            share=self.options["share"],
+        )
+        res.update(self.counts)
+        for stage in self.stages:
+            res[f"{stage.name}_seconds"] = stage.seconds
+            res[f"{stage.name}_peak_bytes"] = stage.peak_bytes
+        res["total_seconds"] = sum(stage.seconds for stage in self.stages)
+        return res
 
 
 def create_parser():
@@ -445,6 +3328,141 @@ def create_parser():
         help="evaluate the expression by asking for a non-existent member type alias",
         action="store_true",
     )
+    parser.add_argument(
+        "--output",
+        "-o",
+        help="write the generated C++ to this file instead of stdout",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--compile",
+        "-c",
+        help="compile the generated program and print the type Result evaluates to",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--json",
+        help="compile the generated program and print what Result evaluates to as "
+        "JSON, read from the object file rather than from a diagnostic",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="where --compile caches results (default: $TMP_LISP_CACHE_DIR or "
+        "~/.cache/tmp_lisp)",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--no-cache", help="don't cache --compile results", action="store_true"
+    )
+    parser.add_argument(
+        "--pch",
+        help="compile against a precompiled tmp_lisp.hpp, built once per header "
+        "version, compiler and flags (default: only with --repl)",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-stats",
+        help="print compile cache hit/miss stats as JSON to stderr",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--backend",
+        help="evaluate with template instantiations (the default) or with "
+        "constexpr functions",
+        choices=BACKENDS,
+        default="templates",
+    )
+    parser.add_argument(
+        "--heap-cells",
+        help="heap size of the constexpr backend, in values",
+        type=int,
+        default=DEFAULT_HEAP_CELLS,
+    )
+    parser.add_argument(
+        "--interpret",
+        help="evaluate the program with the Python interpreter and print its value",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--differential",
+        help="with --interpret, also evaluate with the template backend and fail "
+        "if the two disagree",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--repl",
+        help="read inputs from stdin, keeping their definitions, and print what "
+        "each evaluates to",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--batch",
+        help="transpile every .scm file under these directories or glob patterns "
+        "into --output, a directory, in parallel",
+        type=str,
+        nargs="+",
+        default=None,
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        help="worker processes for --batch (default: one per available core)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--batch-root",
+        help="directory --batch outputs are placed relative to (default: the "
+        "current directory)",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--module-dir",
+        help="read --file as a module, which may define and require others, and "
+        "transpile it and what it requires into cached headers in this directory",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "-O",
+        dest="optimize",
+        help="optimization level: 0 emits the program as written, 1 folds "
+        "constants, dead branches and unused or literal let bindings, 2 also "
+        "inlines small lambdas",
+        type=int,
+        choices=Optimizer.levels,
+        default=0,
+    )
+    parser.add_argument(
+        "--opt-report",
+        help="print, as JSON to stderr, what -O did and how much smaller the "
+        "generated code and the number of evaluations got",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--share",
+        help="emit each repeated subtree of the generated type once, as a using "
+        "alias",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--source-map",
+        help="also write a JSON file mapping ranges of the generated C++ to the "
+        "lines and columns of the Lisp they came from",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--timings",
+        help="measure the time and memory every stage takes, and print them with "
+        "the sizes of the tokens, tree and code as JSON to stderr",
+        action="store_true",
+    )
     parser.add_argument(
         "--include-header",
         help="instead of having and include line, paste the entire header include",
@@ -454,21 +3472,224 @@ def create_parser():
 
 
 def main(args):
-    lisp_str = ""
+    if args.module_dir:
+        return main_module(args)
+    if args.batch:
+        return main_batch(args)
+    if args.repl:
+        return main_repl(args)
+
+    if args.timings:
+        return main_timings(args)
+
+    if args.source_map:
+        return main_source_map(args)
+
+    options = dict(
+        backend=args.backend,
+        heap_cells=args.heap_cells,
+        optimize=args.optimize,
+        share=args.share,
+    )
     if args.input:
-        lisp_str = args.input
+        lisp2cpp = Lisp2Cpp(args.input, **options)
     elif args.file:
         with open(args.file, "r") as f:
-            lisp_str = f.read()
+            lisp2cpp = Lisp2Cpp(f, **options)
+    else:
+        return
+    if args.opt_report:
+        optimizer = lisp2cpp.optimizer or Optimizer(0)
+        report = optimizer.report(lisp2cpp.unoptimized, lisp2cpp.parse, args.backend)
+        print(json.dumps(report), file=sys.stderr)
+
+    if args.interpret:
+        try:
+            if args.differential:
+                cache = None if args.no_cache else CompileCache(args.cache_dir)
+                value = differential_check(
+                    lisp2cpp, Compiler(cache=cache, pch=args.pch)
+                )
+            else:
+                value = Interpreter(lisp2cpp.parse).run()
+        except (Interpreter.Error, Interpreter.Mismatch) as e:
+            sys.exit(str(e))
+        print(Interpreter.to_lisp(value))
+        return
+
+    if args.compile or args.json:
+        code = lisp2cpp.codegen(evaluate=not args.json, serialize=args.json)
+        return print_compiled(args, code)
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        lisp2cpp.emit(out, evaluate=args.eval, include_header=args.include_header)
+        out.write("\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def print_compiled(args, code):
+    """
+    Compile code and print what its Result evaluates to: as JSON with --json,
+    else as the type the compiler spells.
+    """
+    cache = None if args.no_cache else CompileCache(args.cache_dir)
+    try:
+        compiler = Compiler(cache=cache, pch=args.pch)
+        if args.json:
+            print(json.dumps(compiler.value(code)))
+        else:
+            print(compiler.evaluate(code))
+    except Compiler.Error as e:
+        sys.exit(str(e))
+    finally:
+        if args.cache_stats and cache is not None:
+            print(json.dumps(cache.stats()), file=sys.stderr)
+
 
-    if not lisp_str:
+def main_source_map(args):
+    if args.input:
+        text = args.input
+    elif args.file:
+        with open(args.file, "r") as f:
+            text = f.read()
+    else:
         return
+    if args.backend != "templates" or args.compile or args.json or args.interpret:
+        sys.exit("--source-map maps the template backend's generated code")
+    if args.share:
+        sys.exit("--source-map maps code without shared subtrees")
 
-    print(
-        Lisp2Cpp(lisp_str).codegen(
-            evaluate=args.eval, include_header=args.include_header
+    lisp2cpp = Lisp2Cpp(
+        text, heap_cells=args.heap_cells, track_spans=True, optimize=args.optimize
+    )
+    entries = []
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        lisp2cpp.emit(
+            out,
+            evaluate=args.eval,
+            include_header=args.include_header,
+            source_map=entries,
         )
+        out.write("\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    source_map = SourceMap.build(text, entries, source=args.file)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(args.source_map)), suffix=".tmp"
     )
+    with os.fdopen(fd, "w") as f:
+        json.dump(source_map.to_json(), f)
+    os.replace(tmp_path, args.source_map)
+
+
+def main_timings(args):
+    if args.input:
+        text = args.input
+    elif args.file:
+        with open(args.file, "r") as f:
+            text = f.read()
+    else:
+        return
+    if args.interpret:
+        sys.exit("--timings measures transpiling, not --interpret")
+
+    compiler = None
+    if args.compile or args.json:
+        cache = None if args.no_cache else CompileCache(args.cache_dir)
+        compiler = Compiler(cache=cache, pch=args.pch)
+        if args.pch:
+            compiler.precompiled_header()  # not part of any one build's timings
+    timings = Timings(
+        text,
+        backend=args.backend,
+        heap_cells=args.heap_cells,
+        include_header=args.include_header,
+        evaluate=args.eval or (args.compile and not args.json),
+        serialize=args.json,
+        compiler=compiler,
+        optimize=args.optimize,
+        share=args.share,
+    ).run()
+
+    try:
+        if compiler is None:
+            out = open(args.output, "w") if args.output else sys.stdout
+            try:
+                out.write(timings.code + "\n")
+            finally:
+                if out is not sys.stdout:
+                    out.close()
+        elif timings.compile_result.result is None:
+            sys.exit(timings.compile_result.stderr)
+        elif args.json:
+            print(json.dumps(json.loads(timings.compile_result.result)))
+        else:
+            print(timings.compile_result.result)
+    finally:
+        print(json.dumps(timings.report()), file=sys.stderr)
+
+
+def main_repl(args):
+    # without a PCH every step recompiles the whole prelude, so it is on
+    # unless --no-pch; the prelude changes with every definition, so its PCHs
+    # are only worth keeping for the session
+    with tempfile.TemporaryDirectory() as pch_dir:
+        compiler = Compiler(pch=args.pch is not False, pch_dir=pch_dir)
+        Repl(compiler).run(sys.stdin, sys.stdout)
+
+
+def main_batch(args):
+    if not args.output:
+        sys.exit("--batch needs an --output directory")
+    transpiler = DirectoryTranspiler(
+        args.output,
+        jobs=args.jobs,
+        root=args.batch_root,
+        backend=args.backend,
+        heap_cells=args.heap_cells,
+        optimize=args.optimize,
+        share=args.share,
+    )
+    try:
+        stats = transpiler.run(args.batch)
+    except DirectoryTranspiler.Error as e:
+        sys.exit(str(e))
+    for name, error in sorted(transpiler.errors.items()):
+        print(f"{name}: {error}", file=sys.stderr)
+    print(DirectoryTranspiler.summary(stats), file=sys.stderr)
+    if stats.failed:
+        sys.exit(1)
+
+
+def main_module(args):
+    if not args.file:
+        sys.exit("--module-dir needs a --file")
+    if args.backend != "templates" or args.interpret or args.include_header:
+        sys.exit("modules are only transpiled to the template backend")
+    try:
+        code = ModuleBuilder(args.module_dir).program(
+            args.file,
+            evaluate=(args.eval or args.compile) and not args.json,
+            serialize=args.json,
+        )
+    except ModuleBuilder.Error as e:
+        sys.exit(str(e))
+
+    if args.compile or args.json:
+        return print_compiled(args, code)
+
+    out = open(args.output, "w") if args.output else sys.stdout
+    try:
+        out.write(code + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
 
 
 if __name__ == "__main__":
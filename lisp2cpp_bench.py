@@ -0,0 +1,320 @@
+#  Restricted Scheme-like Language using Template Metaprogramming
+#
+#  Copyright Thomas D Peters 2018-present
+#
+#  Use, modification and distribution is subject to the
+#  Boost Software License, Version 1.0. (See accompanying
+#  file LICENSE or copy at
+#  http://www.boost.org/LICENSE_1_0.txt)
+
+import argparse
+import io
+import json
+import random
+import time
+import tracemalloc
+
+from lisp2cpp import Parser, Timings, tree_size
+
+
+def quoted_list_program(n):
+    values = " ".join(str(i) for i in range(n))
+    return f"(car '({values}))"
+
+
+def many_forms_program(n):
+    return "\n".join(f"(+ {i} (* {i} 2)) ; form {i}" for i in range(n))
+
+
+def calls_program(n):
+    # mostly uses of a handful of variables and operators, as in real programs
+    calls = " ".join(f"(if (<= x {i}) (f (- x 1) y) (g x (+ y {i})))" for i in range(n))
+    return f"(lambda (f g x y) (f {calls}))"
+
+
+# operators and their arity, None for those taking any number of operands
+RANDOM_OPERATORS = {
+    "+": None,
+    "*": None,
+    "and": None,
+    "or": None,
+    "-": 2,
+    "=": 2,
+    "<=": 2,
+    "cons": 2,
+    "append": 2,
+    "not": 1,
+    "car": 1,
+    "cdr": 1,
+    "null?": 1,
+    "length": 1,
+    "reverse": 1,
+}
+
+
+def random_program(seed, size=1000, depth=16, list_length=8, variables=8):
+    """
+    A random program that parses and only refers to bound variables, of about
+    size parse tree nodes and literals, nested about depth forms deep. It is
+    built from operator applications, ifs, lets, letrecs and applied lambdas,
+    over integers, booleans, variables and quoted lists of list_length
+    integers.
+    An outer let binds the variables v0 ... v{variables - 1}, and every inner
+    binding reuses one of those names. The same arguments always give the
+    same program, but it needn't be well typed, so it is for measuring the
+    transpiler, not the compiler.
+    """
+    rng = random.Random(seed)
+    names = [f"v{i}" for i in range(variables)]
+    pieces = []
+    # a work item is either a piece of text or an expression still to
+    # generate, as (budget, depth, names in scope); built with an explicit
+    # stack, like the parser, so depth isn't limited by Python's recursion
+    work = []
+
+    def split(budget, k):
+        weights = [rng.random() + 1e-9 for _ in range(k)]
+        total = sum(weights)
+        res = [int(budget * w / total) for w in weights]
+        res[0] += budget - sum(res)
+        return res
+
+    def scoped(scope, bound):
+        return tuple(dict.fromkeys(scope + tuple(bound)))
+
+    def expression(budget, depth, scope):
+        # pushed in reverse, so that they are popped in order
+        items = []
+        kind = rng.choices(["op", "if", "let", "lambda"], [6, 2, 1, 1])[0]
+        if kind == "op":
+            op = rng.choice(list(RANDOM_OPERATORS))
+            arity = RANDOM_OPERATORS[op] or rng.randint(2, 4)
+            items.append(f"({op}")
+            items.extend((b, depth - 1, scope) for b in split(budget - 2, arity))
+        elif kind == "if":
+            items.append("(if")
+            items.extend((b, depth - 1, scope) for b in split(budget - 1, 3))
+        elif kind == "let" and names:
+            bound = rng.sample(names, rng.randint(1, min(3, len(names))))
+            *values, body = split(budget - 1 - len(bound), len(bound) + 1)
+            outer = tuple(name for name in scope if name not in bound)
+            items.append(f"({rng.choice(['let', 'letrec'])} (")
+            for name, b in zip(bound, values):
+                items.extend([f"({name}", (b, depth - 2, outer), ")"])
+            items.extend([")", (body, depth - 1, scoped(scope, bound))])
+        elif kind == "lambda" and names:
+            params = rng.sample(names, rng.randint(1, min(3, len(names))))
+            body, *args = split(budget - 2, len(params) + 1)
+            items.append(f"((lambda ({' '.join(params)})")
+            items.extend([(body, depth - 2, scoped(scope, params)), ")"])
+            items.extend((b, depth - 1, scope) for b in args)
+        else:
+            return leaf(scope)
+        items.append(")")
+        work.extend(reversed(items))
+
+    def leaf(scope):
+        kind = rng.choices(["var", "int", "bool", "list"], [5, 3, 1, 1])[0]
+        if kind == "var" and scope:
+            pieces.append(rng.choice(scope))
+        elif kind == "bool":
+            pieces.append(rng.choice(["#t", "#f"]))
+        elif kind == "list":
+            values = " ".join(str(rng.randrange(100)) for _ in range(list_length))
+            pieces.append(f"'({values})")
+        else:
+            pieces.append(str(rng.randrange(-100, 100)))
+
+    if names:
+        *values, body = split(size - 1 - len(names), len(names) + 1)
+        work.extend([")", (body, depth - 1, tuple(names)), ")"])
+        for name, b in reversed(list(zip(names, values))):
+            work.extend([")", (b, depth - 2, ()), f"({name}"])
+        work.append("(let (")
+    else:
+        work.append((size, depth, ()))
+    while work:
+        item = work.pop()
+        if isinstance(item, str):
+            pieces.append(item)
+        elif item[0] <= 1 or item[1] <= 1:
+            leaf(item[2])
+        else:
+            expression(*item)
+    return " ".join(pieces).replace("( ", "(").replace(" )", ")")
+
+
+def time_it(func):
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def bench_parse(sizes, chunk_size):
+    """
+    Parse ever larger inputs. Time per token should stay flat if parsing is
+    linear in the number of tokens.
+    """
+    print(f"{'workload':<12}{'tokens':>10}{'seconds':>12}{'us/token':>12}")
+    for n in sizes:
+        text = quoted_list_program(n)
+        num_tokens = n + 6
+        elapsed = time_it(lambda: Parser.parse(io.StringIO(text)))
+        print(
+            f"{'quoted-list':<12}{num_tokens:>10}{elapsed:>12.4f}"
+            f"{1e6 * elapsed / num_tokens:>12.3f}"
+        )
+
+    for n in sizes:
+        text = many_forms_program(n // 8)
+        num_tokens = 9 * (n // 8)
+        elapsed = time_it(
+            lambda: sum(1 for _ in Parser.parse_forms(io.StringIO(text), chunk_size))
+        )
+        print(
+            f"{'many-forms':<12}{num_tokens:>10}{elapsed:>12.4f}"
+            f"{1e6 * elapsed / num_tokens:>12.3f}"
+        )
+
+
+def bench_memory(sizes):
+    """
+    Parse ever larger programs and measure the memory their parse trees take,
+    per node: retained once parsing is done, and at the peak while parsing.
+    Both should stay flat, and interned variables keep them low.
+    """
+    print(f"{'workload':<12}{'nodes':>10}{'retained B':>12}{'peak B':>12}")
+    for n in sizes:
+        text = calls_program(n // 16)
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            parse = Parser.parse(text)
+            retained, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        nodes, _ = tree_size(parse)
+        print(
+            f"{'calls':<12}{nodes:>10}{(retained - before) / nodes:>12.1f}"
+            f"{(peak - before) / nodes:>12.1f}"
+        )
+
+
+def bench_throughput(sizes, seed, depth, list_length, variables, repeat, as_json):
+    """
+    Run the lexer, parser, resolver and code generator over random programs
+    of the given sizes, and report the throughput of each stage: tokens/s
+    lexed, parse tree nodes/s parsed and resolved, and MB/s of C++ generated.
+    Each is the best of repeat runs. The programs only depend on the
+    generator arguments, so runs of different versions are comparable.
+    """
+    if not as_json:
+        print(
+            f"{'tokens':>10}{'nodes':>10}{'out MB':>9}{'lex tok/s':>12}"
+            f"{'parse node/s':>14}{'resolve node/s':>16}{'codegen MB/s':>14}"
+        )
+    for size in sizes:
+        text = random_program(seed, size, depth, list_length, variables)
+        reports = [
+            Timings(text, trace_memory=False).run().report() for _ in range(repeat)
+        ]
+        report = reports[0]
+        best = {
+            stage: min(r[f"{stage}_seconds"] for r in reports)
+            for stage in ("lex", "parse", "resolve", "codegen")
+        }
+        res = dict(
+            seed=seed,
+            size=size,
+            depth=depth,
+            list_length=list_length,
+            variables=variables,
+            tokens=report["tokens"],
+            ast_nodes=report["ast_nodes"],
+            ast_depth=report["ast_depth"],
+            program_bytes=report["program_bytes"],
+            lex_tokens_per_second=report["tokens"] / best["lex"],
+            parse_nodes_per_second=report["ast_nodes"] / best["parse"],
+            resolve_nodes_per_second=report["ast_nodes"] / best["resolve"],
+            codegen_mb_per_second=report["program_bytes"] / 1e6 / best["codegen"],
+        )
+        if as_json:
+            print(json.dumps(res))
+            continue
+        print(
+            f"{res['tokens']:>10}{res['ast_nodes']:>10}"
+            f"{res['program_bytes'] / 1e6:>9.2f}"
+            f"{res['lex_tokens_per_second']:>12.0f}"
+            f"{res['parse_nodes_per_second']:>14.0f}"
+            f"{res['resolve_nodes_per_second']:>16.0f}"
+            f"{res['codegen_mb_per_second']:>14.2f}"
+        )
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    parse = subparsers.add_parser("parse", help="parser scaling in token count")
+    parse.add_argument(
+        "--sizes",
+        help="token counts to parse",
+        type=int,
+        nargs="+",
+        default=[1 << i for i in range(12, 19)],
+    )
+    parse.add_argument("--chunk-size", type=int, default=1 << 16)
+
+    memory = subparsers.add_parser("memory", help="memory per parse tree node")
+    memory.add_argument(
+        "--sizes",
+        help="node counts to parse",
+        type=int,
+        nargs="+",
+        default=[1 << i for i in range(12, 19, 2)],
+    )
+
+    throughput = subparsers.add_parser(
+        "throughput", help="throughput of each stage over random programs"
+    )
+    throughput.add_argument(
+        "--sizes",
+        help="approximate node counts of the programs",
+        type=int,
+        nargs="+",
+        default=[1 << i for i in range(12, 19, 2)],
+    )
+    throughput.add_argument("--seed", type=int, default=0)
+    throughput.add_argument("--depth", help="nesting depth", type=int, default=32)
+    throughput.add_argument(
+        "--list-length", help="length of quoted lists", type=int, default=8
+    )
+    throughput.add_argument(
+        "--variables", help="number of distinct variables", type=int, default=8
+    )
+    throughput.add_argument("--repeat", type=int, default=3)
+    throughput.add_argument(
+        "--json", help="print one JSON object per program", action="store_true"
+    )
+    return parser
+
+
+def main(args):
+    if args.bench == "parse":
+        bench_parse(args.sizes, args.chunk_size)
+    elif args.bench == "memory":
+        bench_memory(args.sizes)
+    elif args.bench == "throughput":
+        bench_throughput(
+            args.sizes,
+            args.seed,
+            args.depth,
+            args.list_length,
+            args.variables,
+            args.repeat,
+            args.json,
+        )
+
+
+if __name__ == "__main__":
+    main(create_parser().parse_args())
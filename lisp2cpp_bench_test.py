@@ -0,0 +1,33 @@
+import unittest
+
+from lisp2cpp import Lisp2Cpp, Parser, tree_size
+from lisp2cpp_bench import random_program
+
+
+class RandomProgramTest(unittest.TestCase):
+    def test_reproducible(self):
+        self.assertEqual(random_program(3, 500), random_program(3, 500))
+        self.assertNotEqual(random_program(3, 500), random_program(4, 500))
+
+    def test_transpiles(self):
+        for seed in range(20):
+            text = random_program(seed, 200, depth=8, list_length=3, variables=4)
+            lisp2cpp = Lisp2Cpp(text)
+            self.assertEqual(lisp2cpp.unbound, {})
+            lisp2cpp.codegen()
+
+    def test_shape(self):
+        parse = Parser.parse(random_program(0, 4000, depth=12, variables=5))
+        nodes, depth = tree_size(parse)
+        self.assertGreater(nodes, 2000)
+        self.assertLessEqual(depth, 14)
+        self.assertEqual(len(parse.bindings), 5)
+
+    def test_without_variables(self):
+        text = random_program(1, 50, variables=0)
+        self.assertEqual(Lisp2Cpp(text).unbound, {})
+        self.assertNotIn("let", text)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,244 @@
+#  Restricted Scheme-like Language using Template Metaprogramming
+#
+#  Copyright Thomas D Peters 2018-present
+#
+#  Use, modification and distribution is subject to the
+#  Boost Software License, Version 1.0. (See accompanying
+#  file LICENSE or copy at
+#  http://www.boost.org/LICENSE_1_0.txt)
+
+"""
+Where does compiling a Lisp program spend its time? Compiles the program with
+clang's -ftime-trace and charges every template instantiation in the trace to
+the Lisp form whose type it instantiates, found through a SourceMap.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from collections import namedtuple
+
+from cppdriver import DEFAULT_FLAGS, Compiler
+from lisp2cpp import Lisp2Cpp, SourceMap
+
+TRACE_FLAGS = ("-ftime-trace", "-ftime-trace-granularity=0")
+
+# how many levels of template arguments to look through for a form, e.g.
+# Apply_<FnClosure<1, Body, ...>, ...> is charged to the lambda body Body
+SEARCH_DEPTH = 3
+
+Hotspot = namedtuple("Hotspot", ["locations", "source", "count", "self_us", "total_us"])
+
+
+def template_args(spelling):
+    """
+    The top-level template arguments of a type spelled like 'A<B, C<D>>', with
+    whitespace removed, or [] if it isn't a template.
+    """
+    spelling = "".join(spelling.split())
+    start = spelling.find("<")
+    if start < 0 or not spelling.endswith(">"):
+        return []
+    args = []
+    depth = 0
+    arg_start = start + 1
+    for ix in range(start + 1, len(spelling) - 1):
+        c = spelling[ix]
+        if c == "<":
+            depth += 1
+        elif c == ">":
+            depth -= 1
+        elif c == "," and depth == 0:
+            args.append(spelling[arg_start:ix])
+            arg_start = ix + 1
+    args.append(spelling[arg_start:-1])
+    return [arg for arg in args if arg]
+
+
+def type_key(spelling):
+    # compilers space their spellings differently, and a deep program has
+    # long ones, so types are compared by a digest of their non-space text
+    text = "".join(spelling.split())
+    return hashlib.blake2b(text.encode(), digest_size=16).digest()
+
+
+class Profile:
+    """
+    Instantiation counts and times per Lisp form. Forms generating the very
+    same type share their instantiations, so they are reported together.
+    """
+
+    def __init__(self, code, source_map, text):
+        self.text = text
+        self.line_starts = [0] + [ix + 1 for ix, c in enumerate(text) if c == "\n"]
+        self.forms = {}
+        for mapping in source_map.mappings:
+            start, end = mapping.generated
+            key = type_key(code[start:end])
+            self.forms.setdefault(key, []).append(mapping)
+
+    def _offset(self, position):
+        line, column = position
+        return self.line_starts[line - 1] + column - 1
+
+    def attribute(self, detail):
+        """
+        The key of the form an instantiation spelled detail is charged to, or
+        None: the first of its template arguments, breadth first, that was
+        generated from a form.
+        """
+        level = template_args(detail)
+        for _ in range(SEARCH_DEPTH):
+            for arg in level:
+                key = type_key(arg)
+                if key in self.forms:
+                    return key
+            level = [nested for arg in level for nested in template_args(arg)]
+        return None
+
+    def hotspots(self, events):
+        """
+        Returns the Hotspots of the instantiation events of a Chrome trace,
+        costliest first, and the time of those charged to no form. Self time
+        excludes nested instantiations; total time includes them, counting an
+        instantiation nested in another of the same form only once.
+        """
+        events = sorted(
+            (
+                event
+                for event in events
+                if event.get("ph") == "X" and event["name"].startswith("Instantiate")
+            ),
+            key=lambda event: (event.get("tid", 0), event["ts"], -event["dur"]),
+        )
+        count = {}
+        self_us = {}
+        total_us = {}
+        stack = []  # (end, key, tid) of the enclosing instantiations
+        active = {}
+        for event in events:
+            tid = event.get("tid", 0)
+            while stack and (stack[-1][2] != tid or stack[-1][0] <= event["ts"]):
+                active[stack.pop()[1]] -= 1
+            key = self.attribute(event.get("args", {}).get("detail", ""))
+            if stack:
+                parent = stack[-1][1]
+                self_us[parent] = self_us.get(parent, 0) - event["dur"]
+            count[key] = count.get(key, 0) + 1
+            self_us[key] = self_us.get(key, 0) + event["dur"]
+            if not active.get(key):
+                total_us[key] = total_us.get(key, 0) + event["dur"]
+            active[key] = active.get(key, 0) + 1
+            stack.append((event["ts"] + event["dur"], key, tid))
+
+        res = []
+        for key, mappings in self.forms.items():
+            if key not in count:
+                continue
+            first = mappings[0]
+            source = self.text[self._offset(first.start) : self._offset(first.end)]
+            res.append(
+                Hotspot(
+                    locations=[mapping.start for mapping in mappings],
+                    source=" ".join(source.split()),
+                    count=count[key],
+                    self_us=self_us[key],
+                    total_us=total_us[key],
+                )
+            )
+        res.sort(key=lambda hotspot: hotspot.self_us, reverse=True)
+        return res, self_us.get(None, 0)
+
+
+def time_trace(compiler, code):
+    """
+    Compile code with compiler, which must be clang with TRACE_FLAGS, and
+    return the trace it writes next to the object file.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, "program.o")
+        proc = subprocess.run(
+            compiler.command(output),
+            input=code,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            env=compiler.env(),
+        )
+        if proc.returncode != 0:
+            raise Compiler.Error(proc.stderr)
+        with open(os.path.splitext(output)[0] + ".json", "r") as f:
+            return json.load(f)
+
+
+def print_report(hotspots, unattributed_us, top):
+    print(f"{'self ms':>10}{'total ms':>10}{'count':>8}  location  form")
+    for hotspot in hotspots[:top]:
+        line, column = hotspot.locations[0]
+        location = f"{line}:{column}"
+        if len(hotspot.locations) > 1:
+            location += f" (+{len(hotspot.locations) - 1})"
+        source = hotspot.source
+        if len(source) > 60:
+            source = source[:57] + "..."
+        print(
+            f"{hotspot.self_us / 1000:>10.2f}{hotspot.total_us / 1000:>10.2f}"
+            f"{hotspot.count:>8}  {location:<8}  {source}"
+        )
+    print(f"{unattributed_us / 1000:>10.2f}{'':>10}{'':>8}  (not from any form)")
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("file", help="the Lisp program to profile")
+    parser.add_argument(
+        "--compiler",
+        help="a clang, whose -ftime-trace the profile is made from",
+        type=str,
+        default="clang++",
+    )
+    parser.add_argument("--top", help="how many forms to print", type=int, default=20)
+    parser.add_argument(
+        "--json", help="print every hotspot as JSON instead", action="store_true"
+    )
+    return parser
+
+
+def main(args):
+    with open(args.file, "r") as f:
+        text = f.read()
+    lisp2cpp = Lisp2Cpp(text, track_spans=True)
+    entries = []
+    code = lisp2cpp.codegen(source_map=entries)
+    source_map = SourceMap.build(text, entries, source=args.file)
+
+    compiler = Compiler(executable=args.compiler, flags=DEFAULT_FLAGS + TRACE_FLAGS)
+    if not compiler.is_clang:
+        sys.exit(f"{args.compiler} is not clang, which -ftime-trace needs")
+    try:
+        trace = time_trace(compiler, code)
+    except Compiler.Error as e:
+        sys.exit(str(e))
+
+    hotspots, unattributed_us = Profile(code, source_map, text).hotspots(
+        trace["traceEvents"]
+    )
+    if args.json:
+        print(
+            json.dumps(
+                dict(
+                    hotspots=[hotspot._asdict() for hotspot in hotspots],
+                    unattributed_us=unattributed_us,
+                )
+            )
+        )
+    else:
+        print_report(hotspots, unattributed_us, args.top)
+
+
+if __name__ == "__main__":
+    main(create_parser().parse_args())
@@ -0,0 +1,59 @@
+import unittest
+
+from lisp2cpp import Lisp2Cpp, SourceMap
+from lisp2cpp_profile import Profile, template_args
+
+
+class ProfileTest(unittest.TestCase):
+    text = "(letrec ((f (lambda (n)\n  (* n (- n 1)))))\n  (+ (f 3) (f 4)))"
+
+    def setUp(self):
+        lisp2cpp = Lisp2Cpp(self.text, track_spans=True)
+        entries = []
+        code = lisp2cpp.codegen(source_map=entries)
+        self.profile = Profile(code, SourceMap.build(self.text, entries), self.text)
+
+    @staticmethod
+    def event(detail, ts, dur, name="InstantiateClass"):
+        return dict(ph="X", name=name, ts=ts, dur=dur, args=dict(detail=detail))
+
+    def test_template_args(self):
+        self.assertEqual(
+            template_args("Eval_<SExp<Ref<0, 0>, Int<-1> >, Frames<> >"),
+            ["SExp<Ref<0,0>,Int<-1>>", "Frames<>"],
+        )
+        self.assertEqual(template_args("Int<3>"), ["3"])
+        self.assertEqual(template_args("EmptyList"), [])
+
+    def test_hotspots(self):
+        sub = "SExp<Op<OpCode::Sub>, Ref<0, 0>, Int<1>>"
+        # clang spaces the types its own way
+        mul = "SExp<Op<OpCode::Mul>,Ref<0,0>,SExp<Op<OpCode::Sub>,Ref<0,0>,Int<1> > >"
+        closure = f"FnClosure<1, {mul}, Frame<>>"
+        events = [
+            self.event(f"Apply_<{closure}, Int<3>>", 0, 100),
+            self.event(f"Eval_<{mul}, Frames<Frame<Int<3>>>>", 10, 80),
+            self.event(f"Eval_<{sub}, Frames<Frame<Int<3>>>>", 20, 30),
+            self.event("Apply_<Op<OpCode::Sub>, Int<3>, Int<1>>", 25, 5),
+            self.event(f"Eval_<{sub}, Frames<Frame<Int<4>>>>", 200, 10),
+            dict(ph="X", name="Frontend", ts=0, dur=1000),
+        ]
+
+        hotspots, unattributed_us = self.profile.hotspots(events)
+
+        by_source = {hotspot.source: hotspot for hotspot in hotspots}
+        self.assertEqual(set(by_source), {"(* n (- n 1))", "(- n 1)"})
+        self.assertEqual(hotspots[0].source, "(* n (- n 1))")
+        # the Apply_ of the closure and the Eval_ of its body are one form
+        self.assertEqual(by_source["(* n (- n 1))"].count, 2)
+        self.assertEqual(by_source["(* n (- n 1))"].self_us, 70)
+        self.assertEqual(by_source["(* n (- n 1))"].total_us, 100)
+        self.assertEqual(by_source["(- n 1)"].locations, [(2, 8)])
+        self.assertEqual(
+            (by_source["(- n 1)"].count, by_source["(- n 1)"].self_us), (2, 35)
+        )
+        self.assertEqual(unattributed_us, 5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,24 +1,56 @@
+import io
 import unittest
 from pathlib import Path
-from subprocess import PIPE, Popen
+from subprocess import DEVNULL, PIPE, Popen
 from tempfile import TemporaryDirectory
 
+from cppdriver import CompileCache, Compiler
 from lisp2cpp import (
+    DO_LOOP,
+    EMPTY_LIST,
     LAMBDA,
     LPAREN,
     QUOTE,
     RPAREN,
+    Batch,
+    Binding,
+    ConsCell,
+    DefineExp,
+    DirectoryTranspiler,
+    IfExp,
+    Interpreter,
     LambdaExp,
+    LetExp,
     Lisp2Cpp,
+    ListExp,
+    ModuleBuilder,
     OpExp,
+    Optimizer,
     Parser,
+    Repl,
+    RequireExp,
     SExp,
+    SourceMap,
+    Spans,
+    Timings,
     TokenType,
     VarExp,
+    check_batch,
+    differential_check,
     lisp_lexer,
 )
 
 
+def temporary_compiler(directory, **options):
+    # a compiler keeping its cache and PCHs in directory, so that tests
+    # neither depend on nor fill the user's cache
+    return Compiler(
+        cache=CompileCache(str(Path(directory) / "cache")),
+        pch_dir=str(Path(directory) / "pch"),
+        **options,
+    )
+
+
 class TokenizerTest(unittest.TestCase):
     @staticmethod
     def tokenize(text):
@@ -220,6 +252,38 @@ class TokenizerTest(unittest.TestCase):
             ],
         )
 
+    def test_stream_tokens(self):
+        expr = "(letrec ((fact (lambda (n) ; comment\n (* n 1)))) (fact 123456))"
+
+        for chunk_size in [1, 2, 3, 7, 1 << 16]:
+            tokens = list(lisp_lexer.stream_tokens(io.StringIO(expr), chunk_size))
+            self.assertEqual(tokens, self.tokenize(expr), chunk_size)
+
+    def test_stream_tokens_string_across_chunks(self):
+        expr = '(require "abcdefghij.scm")\n(+ 1 2)'
+
+        for chunk_size in range(1, len(expr) + 1):
+            tokens = list(lisp_lexer.stream_tokens(io.StringIO(expr), chunk_size))
+            self.assertEqual(tokens, self.tokenize(expr), chunk_size)
+
+        with self.assertRaises(lisp_lexer.Error):
+            list(lisp_lexer.stream_tokens(io.StringIO('(require "abc'), 4))
+
+    def test_stream_tokens_comment_at_eof(self):
+        expr = "(x) ;no newline"
+
+        tokens = list(lisp_lexer.stream_tokens(io.StringIO(expr), 4))
+
+        self.assertEqual(tokens, self.tokenize(expr))
+
+    def test_offsets(self):
+        expr = "(f ;c\n  'x 12)"
+
+        tokens = self.tokenize(expr)
+
+        self.assertEqual([_.offset for _ in tokens], [0, 1, 3, 8, 9, 11, 13])
+        self.assertTrue(all(expr.startswith(_.value, _.offset) for _ in tokens))
+
 
 class ParserTest(unittest.TestCase):
     @staticmethod
@@ -247,12 +311,209 @@ class ParserTest(unittest.TestCase):
         self.assertEqual(parse.arglist, [VarExp(varname)])
         self.assertEqual(parse.body, expectedBody)
 
+    def test_comments(self):
+        expr = "; leading\n(+ 1 ; inner\n 2) ; trailing"
+
+        self.assertEqual(self.parse(expr), SExp(operator=OpExp("Add"), operands=[1, 2]))
+
+    def test_parse_file(self):
+        expr = "(lambda (x) (+ x 1))"
+
+        self.assertEqual(Parser.parse(io.StringIO(expr)), self.parse(expr))
+
+    def test_parse_forms(self):
+        text = "(+ 1 2)\n; comment\n'(1 2) x\n(lambda (y) y)"
+
+        for source in [text, io.StringIO(text)]:
+            forms = list(Parser.parse_forms(source, chunk_size=3))
+            self.assertEqual(
+                forms,
+                [
+                    SExp(operator=OpExp("Add"), operands=[1, 2]),
+                    ListExp(values=[1, 2]),
+                    VarExp("x"),
+                    LambdaExp(arglist=[VarExp("y")], body=VarExp("y")),
+                ],
+            )
+
+    def test_define_and_require(self):
+        text = '(require "lib.scm") (define x 1) (define (f y) (+ x y)) (f 2)'
+
+        self.assertEqual(
+            list(Parser.parse_forms(text)),
+            [
+                RequireExp("lib.scm"),
+                DefineExp(var=VarExp("x"), value=1),
+                DefineExp(
+                    var=VarExp("f"),
+                    value=LambdaExp(
+                        arglist=[VarExp("y")],
+                        body=SExp(OpExp("Add"), [VarExp("x"), VarExp("y")]),
+                    ),
+                ),
+                SExp(operator=VarExp("f"), operands=[2]),
+            ],
+        )
+
+    def test_spans(self):
+        text = "(let ((x '(1 2)))\n  (if (= x 0) (lambda (y) y) x))"
+        spans = Spans()
+
+        parse = Parser.parse(io.StringIO(text), spans)
+
+        def source(form):
+            start, end = spans.get(form)
+            return text[start:end]
+
+        self.assertEqual(source(parse), text)
+        self.assertEqual(source(parse.bindings[0].value), "'(1 2)")
+        self.assertEqual(source(parse.body.cond), "(= x 0)")
+        self.assertEqual(source(parse.body.if_true), "(lambda (y) y)")
+        self.assertIsNone(spans.get(parse.body.if_false))
+        self.assertEqual(len(spans), 5)
+
+    def test_malformed_define_and_require(self):
+        for expr in [
+            "(let ((x (define y 1))) x)",
+            "(define x 1 2)",
+            "(require lib)",
+            '(require "a" "b")',
+            '(car "lib")',
+        ]:
+            with self.assertRaises(Parser.Error, msg=expr):
+                list(Parser.parse_forms(expr))
+
+    def test_large_quoted_list(self):
+        n = 100000
+        values = " ".join(str(i) for i in range(n))
+
+        parse = self.parse(f"'({values})")
+
+        self.assertEqual(parse.values, list(range(n)))
+
+    def test_deep_nesting(self):
+        depth = 20000
+        expr = "(+ 1 " * depth + "0" + ")" * depth
+
+        parse = self.parse(expr)
+
+        for _ in range(depth):
+            self.assertEqual(parse.operands[0], 1)
+            parse = parse.operands[1]
+        self.assertEqual(parse, 0)
+
+    def test_interned_atoms(self):
+        parse = self.parse("(lambda (x) (+ (+ x 1000) (car '(1000)) x))")
+
+        inner, car, last = parse.body.operands
+        self.assertIs(inner.operands[0], last)
+        self.assertIs(inner.operands[0], parse.arglist[0])
+        self.assertIs(inner.operator, parse.body.operator)
+        self.assertIs(inner.operands[1], car.operands[0].values[0])
+        self.assertIsNot(self.parse("x"), self.parse("x"))
+
+    def test_nodes(self):
+        parse = self.parse("(if x 1 2)")
+
+        self.assertEqual(parse, IfExp(VarExp("x"), if_true=1, if_false=2))
+        self.assertNotEqual(parse, IfExp(VarExp("y"), 1, 2))
+        self.assertNotEqual(VarExp("x"), OpExp("x"))
+        self.assertNotEqual(IfExp(VarExp("x"), 1, 2), IfExp(VarExp("x"), 1, [2]))
+        self.assertEqual(parse._replace(cond=True), IfExp(True, 1, 2))
+        self.assertEqual(list(parse), [VarExp("x"), 1, 2])
+        self.assertEqual(parse._fields, ("cond", "if_true", "if_false"))
+        self.assertEqual(
+            repr(parse), "IfExp(cond=VarExp(name='x'), if_true=1, if_false=2)"
+        )
+        self.assertEqual(len({VarExp("x"), VarExp("x"), OpExp("Add")}), 2)
+        with self.assertRaises(TypeError):
+            IfExp(1, 2)
+        with self.assertRaises(TypeError):
+            IfExp(1, 2, if_else=3)
+
+        depth = 20000
+        deep = "(- " * depth + "1" + ")" * depth
+        self.assertEqual(self.parse(deep), self.parse(deep))
+        self.assertNotEqual(self.parse(deep), self.parse(deep.replace("1", "2")))
+
+    def test_node_hashes(self):
+        text = "(let ((f (lambda (x) (+ x 1)))) (f 2))"
+
+        self.assertEqual(hash(self.parse(text)), hash(self.parse(text)))
+        self.assertEqual(len({self.parse(text), self.parse(text.replace("2", "3"))}), 2)
+        depth = 20000
+        deep = "(if #t " * depth + "1" + " 2)" * depth
+        self.assertEqual(hash(self.parse(deep)), hash(self.parse(deep)))
+
+    def test_malformed_special_forms(self):
+        for expr in ["(if 1 2)", "(lambda (x) 1 2)", "(let ((x 1)) x x)", "()"]:
+            with self.assertRaises(Parser.Error, msg=expr):
+                self.parse(expr)
+
+    def test_unexpected_eof(self):
+        with self.assertRaises(Parser.Error):
+            self.parse("(+ 1 2")
+
+    def test_named_let(self):
+        parse = self.parse("(let loop ((i 0)) (loop i))")
+
+        self.assertEqual(
+            parse,
+            SExp(
+                operator=LetExp(
+                    bindings=[
+                        Binding(
+                            var=VarExp("loop"),
+                            value=LambdaExp(
+                                arglist=[VarExp("i")],
+                                body=SExp(
+                                    operator=VarExp("loop"), operands=[VarExp("i")]
+                                ),
+                            ),
+                        )
+                    ],
+                    body=VarExp("loop"),
+                ),
+                operands=[0],
+            ),
+        )
+
+    def test_do(self):
+        parse = self.parse("(do ((i 0 (+ i 1)) (n 5)) ((= i n) i))")
+
+        (binding,) = parse.operator.bindings
+        self.assertEqual(binding.var, DO_LOOP)
+        self.assertEqual(parse.operands, [0, 5])
+        self.assertEqual(
+            binding.value.body.if_false,
+            SExp(
+                operator=DO_LOOP,
+                operands=[
+                    SExp(operator=OpExp("Add"), operands=[VarExp("i"), 1]),
+                    VarExp("n"),
+                ],
+            ),
+        )
+
+    def test_malformed_do(self):
+        for expr in [
+            "(do ((i 0)) (#t))",
+            "(do ((i 0)) (#t 1) i)",
+            "(do ((i 0 1 2)) (#t 1))",
+        ]:
+            with self.assertRaises(Parser.Error, msg=expr):
+                self.parse(expr)
+
 
 class Lisp2CppTest(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
         cls.temp_dir = TemporaryDirectory()
         cls.temp_dir_name = Path(cls.temp_dir.name)
+        # the PCH holds <type_traits>, so code checked on its own compiles
+        # without it, and must include what it uses
+        cls.compiler = temporary_compiler(cls.temp_dir.name, pch=True)
+        cls.plain_compiler = temporary_compiler(cls.temp_dir.name)
 
     @classmethod
     def tearDownClass(cls):
@@ -274,22 +535,293 @@ class Lisp2CppTest(unittest.TestCase):
 
         self.check_compiles(cpp_code)
 
+    def check_cppevals(self, cases):
+        for res in check_batch(cases, self.compiler):
+            self.assertTrue(res.ok, (res.text, res.expected, res.diagnostics))
+
     def check_compiles(self, code):
-        with Popen(["echo", code], stdout=PIPE) as codegen_process, Popen(
-            ["c++", "-xc++", "-std=c++1z", "-", "-c", "-o", self.compiler_outfile],
-            stdin=codegen_process.stdout,
-            stdout=PIPE,
-            stderr=PIPE,
-        ) as compile_process:
-            out, err = compile_process.communicate()
+        res = self.plain_compiler.compile(code)
 
-        self.assertEqual(compile_process.returncode, 0, (out, err))
+        self.assertEqual(res.returncode, 0, res.stderr)
 
-    def test_varmap_1(self):
+    def test_unbound_1(self):
         exp = "(lambda (x y) (+ x y z))"
         lisp2cpp = Lisp2Cpp(exp)
 
-        self.assertEqual(set(lisp2cpp.varmap), {"x", "y", "z"})
+        self.assertEqual(lisp2cpp.unbound, {"z": 0})
+        self.assertIn(
+            "Fn<2, SExp<Op<OpCode::Add>, Ref<0, 0>,Ref<0, 1>,Unbound<0>>>",
+            lisp2cpp.codegen(),
+        )
+
+    def test_lexical_addresses(self):
+        exp = "(lambda (x) (let ((y x) (x 1)) (if x y (lambda () x))))"
+
+        self.assertIn(
+            "Fn<1, Letrec<If<Ref<0, 1>, Ref<0, 0>, Fn<0, Ref<1, 0>, Ref<0, 1>>>, "
+            "Rec<Ref<0, 1>,Int<1>>>>",
+            self.codegen(exp),
+        )
+
+    def test_letrec_captures_free_variables(self):
+        exp = "(lambda (a b) (let ((f (lambda (x) (+ x b)))) (f a)))"
+
+        self.assertIn(
+            "Fn<2, Letrec<SExp<Ref<0, 0>, Ref<1, 0>>, "
+            "Rec<Fn<1, SExp<Op<OpCode::Add>, Ref<0, 0>,Ref<1, 0>>, Ref<1, 0>>>, "
+            "Ref<0, 1>>>",
+            self.codegen(exp),
+        )
+
+    def test_closure_captures_free_variables(self):
+        exp = "(lambda (a b c) (lambda (x) (+ x b z)))"
+
+        self.assertIn(
+            "Fn<3, Fn<1, SExp<Op<OpCode::Add>, Ref<0, 0>,Ref<1, 0>,Unbound<0>>, "
+            "Ref<0, 1>>>",
+            self.codegen(exp),
+        )
+
+    def test_closures(self):
+        counter = (
+            "(letrec ((count (lambda (n acc)"
+            "                  (if (= n 0)"
+            "                      (acc 0)"
+            "                      (count (- n 1) (lambda (x) (acc (+ x 1))))))))"
+            "  (count 10 (lambda (x) x)))"
+        )
+        siblings = (
+            "(letrec ((even? (lambda (n) (if (= n 0) #t (odd? (- n 1)))))"
+            "         (odd? (lambda (n) (if (= n 0) #f (even? (- n 1))))))"
+            "  (let ((f (lambda (k) (even? k)))) (f 11)))"
+        )
+        adder = (
+            "(let ((make-adder (lambda (n) (lambda (x) (+ x n))))) ((make-adder 3) 4))"
+        )
+
+        self.check_cppevals(
+            [(counter, "Int<10>"), (siblings, "False"), (adder, "Int<7>")]
+        )
+
+    def test_self_tail_calls_loop(self):
+        exp = "(letrec ((f (lambda (n) (if (= n 0) 0 (f (- n 1)))))) (f 3))"
+        not_tail = "(letrec ((f (lambda (n) (if (= n 0) 0 (+ 1 (f (- n 1))))))) (f 3))"
+
+        self.assertIn(
+            "Rec<Fn<1, Loop<If<SExp<Op<OpCode::Eq>, Ref<0, 0>,Int<0>>, Int<0>, "
+            "Recur<SExp<Op<OpCode::Sub>, Ref<0, 0>,Int<1>>>>>>>",
+            self.codegen(exp),
+        )
+        self.assertNotIn("Loop", self.codegen(not_tail))
+
+    def test_loops(self):
+        # each takes thousands of iterations, far more than the default
+        # template depth would allow if every one nested an Eval_/Apply_ pair
+        countdown = (
+            "(letrec ((count (lambda (n acc)"
+            "                  (if (= n 0)"
+            "                      acc"
+            "                      (let ((m (- n 1))) (count m (+ acc 2)))))))"
+            "  (count 3000 0))"
+        )
+        named_let = (
+            "(let loop ((i 0) (acc 0)) (if (= i 2000) acc (loop (+ i 1) (+ acc i))))"
+        )
+        do = "(do ((i 0 (+ i 1)) (acc 0 (+ acc i)) (k 7)) ((= i 2000) (+ acc k)))"
+
+        self.check_cppevals(
+            [
+                (countdown, "Int<6000>"),
+                (named_let, f"Int<{sum(range(2000))}>"),
+                (do, f"Int<{sum(range(2000)) + 7}>"),
+            ]
+        )
+
+    def test_long_lists(self):
+        # car, cdr and cons don't nest with the length of a list, so these
+        # compile at the default template depth
+        n = 10000
+        values = " ".join(str(i) for i in range(n))
+
+        self.check_cppevals(
+            [
+                (f"(car (cdr (cdr '({values}))))", "Int<2>"),
+                (f"(null? (cdr (cons #t '({values}))))", "False"),
+                (f"(cdr '({values}))", f"IntList<{', '.join(map(str, range(1, n)))}>"),
+            ]
+        )
+
+    def test_list_builtins(self):
+        # map, filter, foldl and friends expand the list as a pack, so they
+        # don't nest with its length the way mapcar does
+        n = 1000
+        values = " ".join(str(i) for i in range(n))
+
+        self.check_cppevals(
+            [
+                (
+                    f"(map (lambda (x) (* x 2)) '({values}))",
+                    f"IntList<{', '.join(str(2 * i) for i in range(n))}>",
+                ),
+                (f"(length (filter (lambda (x) (<= x 9)) '({values})))", "Int<10>"),
+                (f"(foldl + 0 '({values}))", f"Int<{sum(range(n))}>"),
+                (f"(car (reverse (append '({values}) '(-1))))", "Int<-1>"),
+            ]
+        )
+
+    def test_serialized_value(self):
+        n = 5000
+        values = " ".join(str(i) for i in range(n))
+        cases = [
+            ("(cons 1 (cons #f 2))", {"car": 1, "cdr": {"car": False, "cdr": 2}}),
+            ("(cons '() (cons car '()))", [[], {"op": "Car"}]),
+            ("(cons (lambda (x y) x) '())", [{"closure": 2}]),
+            (f"(reverse '({values}))", list(reversed(range(n)))),
+        ]
+
+        for text, expected in cases:
+            code = Lisp2Cpp(text).codegen(serialize=True)
+            self.assertEqual(self.compiler.value(code), expected, text)
+        code = Lisp2Cpp("(cons - 3)", backend="constexpr").codegen(serialize=True)
+        self.assertEqual(self.compiler.value(code), {"car": {"op": "Sub"}, "cdr": 3})
+
+    def test_constexpr_backend(self):
+        fact = (
+            "(letrec ((fact (lambda (n) (if (= 0 n) 1 (* n (fact (- n 1)))))))"
+            "  (fact 10))"
+        )
+        mapcar = (
+            "(letrec ((mapcar (lambda (f list)"
+            "                   (if (null? list)"
+            "                       '()"
+            "                       (cons (f (car list)) (mapcar f (cdr list)))))))"
+            "  (mapcar (lambda (x) (* x 2)) '(1 2 3)))"
+        )
+        # far more iterations than the template backend could afford
+        loop = "(do ((i 0 (+ i 1)) (acc 0 (+ acc 2))) ((= i 20000) acc))"
+        cases = [
+            (fact, "Int<3628800>"),
+            (mapcar, "IntList<2, 4, 6>"),
+            ("(let ((y (+ x 1)) (x 2)) (cons y (cons #t '())))", "List<Int<3>, True>"),
+            ("((lambda (f) (f 1 2 3)) +)", "Int<6>"),
+            (
+                "(cons + (lambda (x) x))",
+                "Cons<Op<OpCode::Add>, constexpr_lisp::Procedure<1>>",
+            ),
+            (loop, "Int<40000>"),
+        ]
+
+        for res in check_batch(cases, self.compiler, backend="constexpr"):
+            self.assertTrue(res.ok, (res.text, res.expected, res.diagnostics))
+
+    def test_codegen_deep_nesting(self):
+        depth = 20000
+        expr = "(+ 1 " * depth + "0" + ")" * depth
+
+        code = self.codegen(expr)
+
+        self.assertIn("SExp<Op<OpCode::Add>, Int<1>," * depth + "Int<0>", code)
+
+    def test_shared_subtrees(self):
+        exp = "(cons '(1 2 3 4 5 6 7 8 9) '(1 2 3 4 5 6 7 8 9))"
+
+        code = Lisp2Cpp(exp, share=True).codegen()
+
+        self.assertEqual(
+            code,
+            Lisp2Cpp.include + "using Sub_0 = IntList<1, 2, 3, 4, 5, 6, 7, 8, 9>;\n"
+            "using Result = Eval<SExp<Op<OpCode::Cons>, Sub_0,Sub_0>, EmptyFrames>;",
+        )
+        # not worth an alias
+        self.assertEqual(
+            Lisp2Cpp("(+ 1 1)", share=True).codegen(), self.codegen("(+ 1 1)")
+        )
+        with self.assertRaises(Lisp2Cpp.ConvertError):
+            Lisp2Cpp(exp, share=True, track_spans=True).codegen(source_map=[])
+
+    def test_shared_subtrees_deep_nesting(self):
+        depth = 20000
+        nested = "(- " * depth + "1" + ")" * depth
+
+        code = Lisp2Cpp(f"(+ {nested} {nested})", share=True).codegen()
+
+        self.assertEqual(code.count("SExp<"), depth + 1)
+        self.assertIn("SExp<Op<OpCode::Add>, Sub_1,Sub_1>", code)
+
+    def test_shared_subtrees_compile(self):
+        for text in [*InterpreterTest.programs, "(lambda (x) x)"]:
+            differential_check(Lisp2Cpp(text, share=True), self.compiler)
+        with open(Path(__file__).parent / "examples" / "mapcar.scm") as f:
+            lisp2cpp = Lisp2Cpp(f, share=True)
+        self.assertIn("using Sub_0", lisp2cpp.codegen())
+        self.assertEqual(
+            differential_check(lisp2cpp, self.compiler),
+            Interpreter.evaluate("'(1 2 6 24 120)"),
+        )
+
+    def test_codegen_long_list(self):
+        n = 100000
+        values = " ".join(str(i) for i in range(n))
+
+        code = self.codegen(f"'({values})")
+
+        self.assertIn("IntList<0, 1, 2, 3,", code)
+        self.assertIn(f"{n - 2}, {n - 1}>", code)
+
+    def test_source_map(self):
+        text = (
+            "(letrec ((count (lambda (n acc)\n"
+            "                  (if (= n 0) acc (count (- n 1) (+ acc 1))))))\n"
+            "  (count 3 (- 5 1)))"
+        )
+        entries = []
+
+        code = Lisp2Cpp(text, track_spans=True).codegen(
+            evaluate=True, source_map=entries
+        )
+        source_map = SourceMap.build(text, entries, source="count.scm")
+        generated = {
+            m.start + m.end: code[slice(*m.generated)] for m in source_map.mappings
+        }
+
+        self.assertEqual(code, Lisp2Cpp(text).codegen(evaluate=True))
+        self.assertEqual(len(source_map.mappings), 10)
+        self.assertEqual(
+            generated[(3, 12, 3, 19)], "SExp<Op<OpCode::Sub>, Int<5>,Int<1>>"
+        )
+        # the body of a loop keeps the span of the if it was rebuilt from
+        self.assertTrue(generated[(2, 19, 2, 61)].startswith("If<SExp<Op<OpCode::Eq>"))
+        self.assertTrue(generated[(2, 35, 2, 60)].startswith("Recur<"))
+        self.assertEqual(
+            SourceMap.from_json(source_map.to_json()).mappings, source_map.mappings
+        )
+        with self.assertRaises(Lisp2Cpp.ConvertError):
+            Lisp2Cpp(text).codegen(source_map=[])
+
+    def test_emit(self):
+        exp = "(letrec ((f (lambda (x) (* x 2)))) (f '(1 2)))"
+        out = io.StringIO()
+
+        Lisp2Cpp(exp).emit(out, evaluate=True)
+
+        self.assertEqual(out.getvalue(), Lisp2Cpp(exp).codegen(evaluate=True))
+
+    def test_emit_to_compiler_pipe(self):
+        with Popen(
+            ["c++", "-xc++", "-std=c++1z", "-", "-c", "-o", self.compiler_outfile],
+            stdin=PIPE,
+            stdout=DEVNULL,
+            stderr=PIPE,
+            text=True,
+        ) as compile_process:
+            compile_process.stdin.write("#include <type_traits>\n")
+            Lisp2Cpp("(* 6 7)").emit(compile_process.stdin, include_header=True)
+            compile_process.stdin.write(
+                "\nstatic_assert(std::is_same<Result, Int<42>>::value);\n"
+            )
+            _, err = compile_process.communicate()
+
+        self.assertEqual(compile_process.returncode, 0, err)
 
     def test_compile_subprocess(self):
         self.check_compiles("int main(){}")
@@ -332,16 +864,18 @@ class Lisp2CppTest(unittest.TestCase):
                 return 1
             return n * fact(n - 1)
 
-        for integer in [0, 1, 10]:
-            exp = (
+        def fact_exp(n):
+            return (
                 "(letrec ((fact (lambda (n)"
                 "               (if (= 0 n)"
                 "                   1"
                 "                   (* n (fact (- n 1)))))))"
-                f"    (fact {integer}))"
+                f"    (fact {n}))"
             )
 
-            self.check_cppeval(exp, f"Int<{fact(integer)}>")
+        self.check_cppevals(
+            (fact_exp(integer), f"Int<{fact(integer)}>") for integer in [0, 1, 10]
+        )
 
     def test_mapcar(self):
         def mapcar_exp(func_exp, list_exp):
@@ -359,7 +893,7 @@ class Lisp2CppTest(unittest.TestCase):
 
         self.check_cppeval(
             mapcar_exp(func_exp=double_fun, list_exp=list_exp),
-            "Cons<Int<2>, Cons<Int<4>, Cons<Int<6>, EmptyList>>>",
+            "IntList<2, 4, 6>",
         )
 
     def test_mess_with_keywords(self):
@@ -387,16 +921,561 @@ class Lisp2CppTest(unittest.TestCase):
                 return 1
             return fib_py(n - 1) + fib_py(n - 2)
 
-        for n in range(10):
-            self.check_cppeval(fib_exp(n), f"Int<{fib_py(n)}>")
+        self.check_cppevals((fib_exp(n), f"Int<{fib_py(n)}>") for n in range(10))
+
+        # every (fib k) is a single instantiation, so this is linear in n
+        self.check_cppeval(fib_exp(25), f"Int<{fib_py(25)}>")
+
+    def test_nullary(self):
+        self.check_cppeval("(+)", "Int<0>")
+        self.check_cppeval("((lambda () 7))", "Int<7>")
 
     def test_unary_minus(self):
-        self.check_cppeval("(- 1)", "Int<-1>")
-        self.check_cppeval("(- 0)", "Int<0>")
+        self.check_cppevals([("(- 1)", "Int<-1>"), ("(- 0)", "Int<0>")])
 
     def test_lots_of_minuses(self):
-        self.check_cppeval("(- 1 2)", "Int<-1>")
-        self.check_cppeval("(- 1 2 3)", "Int<-4>")
+        self.check_cppevals([("(- 1 2)", "Int<-1>"), ("(- 1 2 3)", "Int<-4>")])
+
+    def test_batch_diagnostics(self):
+        cases = [
+            ("(+ 1 2)", "Int<3>"),
+            ("(+ 1 #t)", "Int<2>"),
+            ("(* 2 2)", "Int<5>"),
+            ("(- 1)", None),
+        ]
+
+        results = Batch(cases).run(self.compiler)
+
+        self.assertEqual([res.ok for res in results], [True, False, False, True])
+        self.assertIn("Result_1", results[1].diagnostics)
+        self.assertIn("batch case 2", results[2].diagnostics)
+        self.assertEqual(results[0].diagnostics, "")
+
+    def test_batch_stops_at_fatal_error(self):
+        deep = "(letrec ((f (lambda (n) (if (= n 0) 0 (+ 1 (f (- n 1))))))) (f 2000))"
+        cases = [("(+ 1 2)", "Int<3>"), (deep, "Int<2000>"), ("(+ 1 2)", "Int<999>")]
+
+        results = Batch(cases).run(self.compiler)
+
+        # the compiler gives up at the too deep recursion, never getting to the last
+        self.assertEqual([res.ok for res in results], [True, False, False])
+        self.assertIn("not checked", results[2].diagnostics)
+
+    def test_check_batch_sharding(self):
+        cases = [(f"(* {i} 3)", f"Int<{3 * i}>") for i in range(9)]
+        cases[4] = ("(* 4 3)", "Int<0>")
+
+        results = check_batch(cases, self.compiler, jobs=4)
+
+        self.assertEqual([res.text for res in results], [text for text, _ in cases])
+        self.assertEqual([res.ok for res in results], [i != 4 for i in range(9)])
+
+    def test_check_batch_empty(self):
+        self.assertEqual(check_batch([], self.compiler), [])
+
+
+class ModuleBuilderTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = TemporaryDirectory()
+        cls.compiler = temporary_compiler(cls.temp_dir.name, pch=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.temp_dir.cleanup()
+
+    def setUp(self):
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = Path(temp_dir.name)
+        self.write(
+            "util.scm",
+            "(define (fact n) (if (= n 0) 1 (* n (fact (- n 1)))))\n"
+            "(define (even? n) (if (= n 0) #t (odd? (- n 1))))\n"
+            "(define (odd? n) (if (= n 0) #f (even? (- n 1))))\n",
+        )
+        self.write("other.scm", "(define ten 10)")
+        self.write(
+            "main.scm",
+            '(require "util.scm") (require "other.scm")\n'
+            "(define (double x) (* 2 x))\n"
+            "(cons (map double (map fact '(1 2 3))) (odd? ten))",
+        )
+
+    def write(self, name, text):
+        (self.dir / name).write_text(text)
+
+    def build(self):
+        builder = ModuleBuilder(str(self.dir / "out"))
+        code = builder.program(str(self.dir / "main.scm"))
+        return code, [Path(path).name for path in builder.transpiled]
+
+    def check_result(self, code, expected):
+        code += f"\nstatic_assert(std::is_same<Result, {expected}>::value);"
+        res = self.compiler.compile("#include <type_traits>\n" + code)
+
+        self.assertEqual(res.returncode, 0, res.stderr)
+
+    def test_modules(self):
+        code, transpiled = self.build()
+
+        self.assertEqual(transpiled, ["util.scm", "other.scm", "main.scm"])
+        self.check_result(code, "Cons<IntList<2, 4, 12>, False>")
+
+    def test_rebuilds_only_what_changed(self):
+        self.build()
+        self.assertEqual(self.build()[1], [])
+
+        self.write("other.scm", "(define ten 11)")
+        code, transpiled = self.build()
+
+        self.assertEqual(transpiled, ["other.scm", "main.scm"])
+        self.check_result(code, "Cons<IntList<2, 4, 12>, True>")
+
+        self.write("main.scm", "(define x 1) x")
+        self.assertEqual(self.build()[1], ["main.scm"])
+
+    def test_names_are_mangled(self):
+        self.build()
+
+        header = next((self.dir / "out").glob("util_*.hpp")).read_text()
+
+        self.assertIn("using def_odd_3f_ = ", header)
+
+    def test_program_needs_a_body(self):
+        builder = ModuleBuilder(str(self.dir / "out"))
+
+        with self.assertRaisesRegex(ModuleBuilder.Error, "no body expression"):
+            builder.program(str(self.dir / "other.scm"))
+        # the definitions can still be required
+        self.check_result(self.build()[0], "Cons<IntList<2, 4, 12>, False>")
+
+    def test_circular_require(self):
+        self.write("other.scm", '(require "main.scm")')
+
+        with self.assertRaises(ModuleBuilder.Error):
+            self.build()
+
+
+class DirectoryTranspilerTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.dir = Path(temp_dir.name)
+        (self.dir / "in" / "sub").mkdir(parents=True)
+        for i in range(6):
+            self.write(f"{'sub/' if i % 2 else ''}p{i}.scm", f"(+ {i} 1)")
+
+    def write(self, name, text):
+        (self.dir / "in" / name).write_text(text)
+
+    def run_transpiler(self, patterns, **options):
+        transpiler = DirectoryTranspiler(
+            str(self.dir / "out"), jobs=2, root=str(self.dir / "in"), **options
+        )
+        return transpiler, transpiler.run(patterns)
+
+    def test_transpiles_tree(self):
+        _, stats = self.run_transpiler([str(self.dir / "in")])
+
+        self.assertEqual((stats.files, stats.transpiled, stats.failed), (6, 6, 0))
+        self.assertEqual(
+            (self.dir / "out" / "sub" / "p3.cpp").read_bytes().decode(),
+            Lisp2Cpp("(+ 3 1)").codegen() + "\n",
+        )
+
+    def test_skips_unchanged(self):
+        self.run_transpiler([str(self.dir / "in")])
+        self.write("p2.scm", "(+ 2 2)")
+
+        _, stats = self.run_transpiler([str(self.dir / "in" / "**" / "*.scm")])
+
+        self.assertEqual((stats.transpiled, stats.skipped), (1, 5))
+        self.assertIn("Int<2>,Int<2>", (self.dir / "out" / "p2.cpp").read_text())
+
+        # outputs stay where they are whichever patterns name their sources
+        _, stats = self.run_transpiler([str(self.dir / "in" / "sub")])
+
+        self.assertEqual((stats.files, stats.skipped), (3, 3))
+        self.assertEqual(
+            sorted(path.name for path in (self.dir / "out").rglob("*.cpp")),
+            [f"p{i}.cpp" for i in range(6)],
+        )
+
+        # other options make other outputs
+        _, stats = self.run_transpiler([str(self.dir / "in")], backend="constexpr")
+
+        self.assertEqual(stats.transpiled, 6)
+
+    def test_errors(self):
+        self.write("bad.scm", "(+ 1")
+
+        transpiler, stats = self.run_transpiler([str(self.dir / "in")])
+
+        self.assertEqual((stats.transpiled, stats.failed), (6, 1))
+        self.assertEqual(list(transpiler.errors), ["bad.scm"])
+        self.assertIn("Parser.Error", transpiler.errors["bad.scm"])
+
+    def test_sources_outside_root(self):
+        transpiler = DirectoryTranspiler(
+            str(self.dir / "out"), root=str(self.dir / "in" / "sub")
+        )
+
+        with self.assertRaises(DirectoryTranspiler.Error):
+            transpiler.run([str(self.dir / "in")])
+
+    def test_undecodable_file(self):
+        (self.dir / "in" / "binary.scm").write_bytes(b"(+ 1 \xff\xfe)")
+
+        transpiler, stats = self.run_transpiler([str(self.dir / "in")])
+
+        self.assertEqual((stats.transpiled, stats.failed), (6, 1))
+        self.assertIn("UnicodeDecodeError", transpiler.errors["binary.scm"])
+        self.assertEqual(list((self.dir / "out").rglob("*.tmp")), [])
+
+
+class TimingsTest(unittest.TestCase):
+    text = "(letrec ((f (lambda (x) (* x 2)))) ; doubles\n (map f '(1 2)))"
+
+    def test_stages(self):
+        timings = Timings(self.text, evaluate=True).run()
+        report = timings.report()
+
+        self.assertEqual(timings.code, Lisp2Cpp(self.text).codegen(evaluate=True))
+        self.assertEqual(
+            [stage.name for stage in timings.stages],
+            ["lex", "parse", "resolve", "codegen", "header"],
+        )
+        self.assertEqual(report["tokens"], 29)
+        self.assertEqual((report["ast_nodes"], report["ast_depth"]), (12, 5))
+        self.assertEqual(report["code_bytes"], len(timings.code))
+        self.assertGreater(report["parse_peak_bytes"], 0)
+
+    def test_compile(self):
+        with TemporaryDirectory() as cache_dir:
+            compiler = Compiler(cache=CompileCache(cache_dir))
+            timings = Timings(self.text, serialize=True, compiler=compiler).run()
+            cached = Timings(self.text, serialize=True, compiler=compiler).run()
+
+        report = timings.report()
+        self.assertEqual(timings.stages[-1].name, "compile")
+        self.assertEqual(timings.compile_result.result, "[2,4]")
+        self.assertEqual(report["compile_returncode"], 0)
+        self.assertGreater(report["compile_peak_bytes"], 0)
+        self.assertTrue(cached.report()["compile_cached"])
+        self.assertIsNone(cached.report()["compile_peak_bytes"])
+        untraced = Timings("(+ 1 2)", trace_memory=False).run()
+        self.assertIsNone(untraced.stages[0].peak_bytes)
+
+
+class ReplTest(unittest.TestCase):
+    def setUp(self):
+        temp_dir = TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.pch_dir = temp_dir.name
+
+    def repl(self, pch=False):
+        return Repl(Compiler(pch=pch, pch_dir=self.pch_dir))
+
+    def test_definitions_persist(self):
+        for pch in [False, True]:
+            repl = self.repl(pch)
+
+            step = repl.feed("(define (fact n) (if (= n 0) 1 (* n (fact (- n 1)))))")
+            self.assertEqual((step.result, step.names), (None, ["fact"]))
+            self.assertEqual(repl.feed("(fact 5)").result, "Int<120>")
+            self.assertEqual(
+                repl.feed(
+                    "(define (sq x) (* x x)) (map sq (map fact '(1 2 3)))"
+                ).result,
+                "IntList<1, 4, 36>",
+            )
+            # later definitions shadow earlier ones
+            self.assertEqual(repl.feed("(define fact 3) (+ fact 1)").result, "Int<4>")
+
+    def test_failed_input_keeps_no_definitions(self):
+        repl = self.repl()
+
+        with self.assertRaises(Repl.Error):
+            repl.feed("(define x 1) (car '())")
+        with self.assertRaises(Repl.Error):
+            repl.feed("(+ 1")
+
+        self.assertEqual(repl.feed("(define x 2) x").result, "Int<2>")
+        self.assertEqual(list(repl.required), ["tmp_lisp_repl_0"])
+
+    def test_broken_definition_with_good_body(self):
+        repl = self.repl()
+        repl.feed("(define (sq x) (* x x))")
+
+        with self.assertRaises(Repl.Error):
+            repl.feed("(define z (car 5)) (sq 3)")
+
+        self.assertEqual(repl.feed("(sq 5)").result, "Int<25>")
+        self.assertEqual(list(repl.required), ["tmp_lisp_repl_0"])
+
+    def test_run(self):
+        stdin = io.StringIO("(define (sq x)\n  (* x x))\n\n(sq 3)\n(car '())\n")
+        stdout = io.StringIO()
+
+        self.repl().run(stdin, stdout)
+
+        lines = [line for line in stdout.getvalue().splitlines() if " ms" not in line]
+        self.assertEqual(lines[:2], ["; defined sq", "Int<9>"])
+        self.assertTrue(lines[2].startswith("error: "), lines)
+
+
+class InterpreterTest(unittest.TestCase):
+    programs = {
+        "(+ 2 3)": 5,
+        "((lambda (x y) (+ x 1 y)) 2 3)": 6,
+        "(or #t #f #t)": True,
+        "(if #t 1 3)": 1,
+        "(if '() 1 3)": 1,
+        "(if 0 1 3)": 3,
+        "(car (cdr (cdr (cons 0 (cons 1 (cons 2 3))))))": 2,
+        "(let ((x 1)(y 2)) (+ x y))": 3,
+        "(let ((y (+ x 1)) (x 2)) y)": 3,
+        "(= 2 2 2)": False,
+        "(= 1 1 1)": True,
+        "(= 1 #t)": False,
+        "(- 1 2 3)": -4,
+        "(- 1)": -1,
+        "(*)": 1,
+        "(null? '())": True,
+        "(cdr '(1))": EMPTY_LIST,
+        "(cons 1 2)": ConsCell(1, 2),
+        "(cdr '(#t 1 2))": ConsCell(1, ConsCell(2, EMPTY_LIST)),
+        "(cons '() (cdr '(#t 1)))": ConsCell(EMPTY_LIST, ConsCell(1, EMPTY_LIST)),
+        "(let loop ((i 0) (acc 1)) (if (= i 3) acc (loop (+ i 1) (* acc 2))))": 8,
+        "(let loop ((loop 2)) loop)": 2,
+        "(do ((i 0 (+ i 1)) (acc 0 (+ acc i)) (k 5)) ((= i 4) (+ acc k)))": 11,
+        "(map (lambda (x) (* x x)) '(1 2 3))": ConsCell(
+            1, ConsCell(4, ConsCell(9, EMPTY_LIST))
+        ),
+        "(filter (lambda (x) (<= x 1)) '(0 3 1))": ConsCell(0, ConsCell(1, EMPTY_LIST)),
+        "(foldl cons '() '(1 2))": ConsCell(2, ConsCell(1, EMPTY_LIST)),
+        "(foldl + 0 '())": 0,
+        "(length (cons #t '(1 2)))": 3,
+        "(append '(1) '() (cons #t '()))": ConsCell(1, ConsCell(True, EMPTY_LIST)),
+        "(reverse '(#t 1))": ConsCell(1, ConsCell(True, EMPTY_LIST)),
+    }
+
+    failing_programs = [
+        "(car '())",
+        "(+ 1 #t)",
+        "((lambda (x) x))",
+        "(* 65536 65536)",
+        "(letrec ((x x)) x)",
+        "(length 3)",
+        "(map car '(1))",
+        "unbound",
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = TemporaryDirectory()
+        cls.compiler = temporary_compiler(cls.temp_dir.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.temp_dir.cleanup()
+
+    @staticmethod
+    def evaluate(text):
+        return Interpreter.evaluate(text)
+
+    def test_programs(self):
+        for text, expected in self.programs.items():
+            value = self.evaluate(text)
+            self.assertEqual(value, expected, text)
+            self.assertIs(type(value), type(expected), text)
+
+    def test_failing_programs(self):
+        for text in self.failing_programs:
+            with self.assertRaises(Interpreter.Error, msg=text):
+                self.evaluate(text)
+
+    def test_fib(self):
+        exp = (
+            "(letrec ((fib (lambda (n)"
+            "                  (if (<= n 0)"
+            "                      1"
+            "                      (+ (fib (- n 1)) (fib (- n 2)))))))"
+            "     (fib 20))"
+        )
+
+        self.assertEqual(self.evaluate(exp), 17711)
+
+    def test_examples(self):
+        examples = Path(__file__).parent / "examples"
+        expected = {
+            "add.scm": "3",
+            "fact.scm": "3628800",
+            "func.scm": "5",
+            "mapcar.scm": "(1 2 6 24 120)",
+        }
+
+        for name, value in expected.items():
+            with open(examples / name) as f:
+                self.assertEqual(Interpreter.to_lisp(self.evaluate(f)), value)
+
+    def test_unused_binding_is_not_evaluated(self):
+        self.assertEqual(self.evaluate("(let ((x (car '()))) 1)"), 1)
+
+    def test_to_cpp(self):
+        value = self.evaluate("(cons #t '(1 2))")
+
+        self.assertEqual(Interpreter.to_cpp(value), "List<Bool<true>, Int<1>, Int<2>>")
+        self.assertEqual(
+            Interpreter.to_cpp(self.evaluate("(cdr (cons #t '(1 2)))")), "IntList<1, 2>"
+        )
+        self.assertEqual(
+            Interpreter.to_cpp(self.evaluate("(cons 1 (cons '() 2))")),
+            "Cons<Int<1>, Cons<EmptyList, Int<2>>>",
+        )
+        self.assertIsNone(Interpreter.to_cpp(self.evaluate("(lambda (x) x)")))
+
+    def test_deep_nesting(self):
+        self.assertEqual(self.evaluate("(+ 1 " * 5000 + "0" + ")" * 5000), 5000)
+        deep_recursion = (
+            "(letrec ((f (lambda (n) (if (= n 0) 0 (+ 1 (f (- n 1)))))))" "  (f 5000))"
+        )
+        self.assertEqual(self.evaluate(deep_recursion), 5000)
+
+        nested = self.evaluate("(cons " * 5000 + "1 2)" + " 3)" * 4999)
+        self.assertTrue(Interpreter.to_lisp(nested).startswith("(" * 5000 + "1 . 2)"))
+        self.assertTrue(Interpreter.to_cpp(nested).startswith("Cons<" * 5000))
+
+        optimized = Lisp2Cpp("(+ 1 " * 5000 + "0" + ")" * 5000, optimize=1)
+        report = optimized.optimizer.report(optimized.unoptimized, optimized.parse)
+        self.assertEqual(report["evaluations_before"], 15001)
+
+    def test_differential(self):
+        for text in [*self.programs, "(lambda (x) x)"]:
+            differential_check(Lisp2Cpp(text), self.compiler)
+
+        for text in ["(car '())", "(+ 1 #t)"]:
+            with self.assertRaises(Interpreter.Error, msg=text):
+                differential_check(Lisp2Cpp(text), self.compiler)
+
+    def test_differential_constexpr(self):
+        for text in [*self.programs, "(lambda (x) x)"]:
+            differential_check(Lisp2Cpp(text, backend="constexpr"), self.compiler)
+
+        for text in self.failing_programs:
+            with self.assertRaises(Interpreter.Error, msg=text):
+                differential_check(Lisp2Cpp(text, backend="constexpr"), self.compiler)
+
+    def test_differential_lexical_scope(self):
+        # x is resolved where f is defined, not where it is called
+        exp = "(let ((x 1)) (let ((f (lambda () x))) ((lambda (x) (f)) 2)))"
+
+        self.assertEqual(differential_check(Lisp2Cpp(exp), self.compiler), 1)
+
+
+class OptimizerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.temp_dir = TemporaryDirectory()
+        cls.compiler = temporary_compiler(cls.temp_dir.name)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.temp_dir.cleanup()
+
+    @staticmethod
+    def optimized(text, level=2):
+        return Lisp2Cpp(text, optimize=level)
+
+    def assertOptimizesTo(self, text, expected, level=2):
+        self.assertEqual(
+            self.optimized(text, level).codegen(), Lisp2Cpp(expected).codegen(), text
+        )
+
+    def test_folding(self):
+        self.assertOptimizesTo("(+ 1 (* 2 3))", "7", level=1)
+        self.assertOptimizesTo("(if (= 1 2) (car '()) '(1 2))", "'(1 2)", level=1)
+        self.assertOptimizesTo("(let ((x 2) (y (car '()))) (+ x 1))", "3", level=1)
+        self.assertOptimizesTo("(lambda (x) (+ x (- 3 1)))", "(lambda (x) (+ x 2))")
+
+    def test_errors_are_not_folded(self):
+        for text in ["(+ 1 #t)", "(if (+ 1 #t) 1 2)", "(* 65536 65536)"]:
+            optimized = self.optimized(text)
+            self.assertEqual(optimized.parse, optimized.unoptimized, text)
+
+    def test_inlining(self):
+        exp = "(let ((sq (lambda (n) (* n n)))) (+ (sq 3) (sq 4)))"
+
+        self.assertOptimizesTo(exp, "25")
+        optimizer = self.optimized(exp).optimizer
+        self.assertEqual(optimizer.counts["inlined"], 2)
+        self.assertNotEqual(self.optimized(exp, 1).codegen(), Lisp2Cpp("25").codegen())
+
+    def test_inlining_keeps_lexical_scope(self):
+        exp = "(let ((f (lambda (x) (+ x k))) (k 1)) (let ((k 5)) (f 2)))"
+
+        self.assertOptimizesTo(exp, "3")
+
+    def test_beta_reduction_keeps_errors(self):
+        # the application forces x, which the let binding it to y would not
+        exp = "(let ((x (car 5))) ((lambda (y) 7) x))"
+
+        for level in Optimizer.levels:
+            with self.assertRaises(Interpreter.Error, msg=level):
+                Interpreter(self.optimized(exp, level).parse).run()
+        # a lambda's parameters are already evaluated
+        self.assertOptimizesTo(
+            "(lambda (x) ((lambda (y) (+ y 1)) x))", "(lambda (x) (+ x 1))"
+        )
+
+    def test_recursion_is_kept(self):
+        with open(Path(__file__).parent / "examples" / "fact.scm") as f:
+            text = f.read()
+
+        self.assertEqual(
+            self.optimized(text).codegen(), Lisp2Cpp(text).codegen(), "fact.scm"
+        )
+
+    def test_programs(self):
+        programs = InterpreterTest.programs
+        for level in Optimizer.levels:
+            for text, expected in programs.items():
+                value = Interpreter(self.optimized(text, level).parse).run()
+                self.assertEqual(value, expected, text)
+                self.assertIs(type(value), type(expected), text)
+            for text in InterpreterTest.failing_programs:
+                with self.assertRaises(Interpreter.Error, msg=text):
+                    Interpreter(self.optimized(text, level).parse).run()
+
+    def test_differential(self):
+        for text in InterpreterTest.programs:
+            differential_check(self.optimized(text), self.compiler)
+        differential_check(
+            Lisp2Cpp("(map (lambda (x) (* x x)) '(1 2 3))", "constexpr", optimize=2),
+            self.compiler,
+        )
+
+    def test_deep_nesting(self):
+        self.assertOptimizesTo("(+ 1 " * 20000 + "0" + ")" * 20000, "20000")
+
+    def test_report(self):
+        exp = "(let ((sq (lambda (n) (* n n)))) (+ (sq 3) (sq 4)))"
+        lisp2cpp = self.optimized(exp)
+
+        report = lisp2cpp.optimizer.report(lisp2cpp.unoptimized, lisp2cpp.parse)
+        self.assertEqual(report["level"], 2)
+        self.assertEqual((report["forms_before"], report["forms_after"]), (15, 0))
+        self.assertLess(report["bytes_after"], report["bytes_before"])
+        self.assertLess(report["evaluations_after"], report["evaluations_before"])
+        failing = self.optimized("(car '())")
+        report = failing.optimizer.report(failing.unoptimized, failing.parse)
+        self.assertIsNone(report["evaluations_after"])
+
+    def test_levels(self):
+        self.assertIsNone(Lisp2Cpp("(+ 1 2)").optimizer)
+        with self.assertRaises(ValueError):
+            Optimizer(3)
 
 
 if __name__ == "__main__":
@@ -14,6 +14,12 @@
 template <class T, class U>
 inline constexpr bool is_same_v = std::is_same<T, U>::value;
 
+constexpr bool equal(const char *a, const char *b) {
+  while (*a && *a == *b)
+    ++a, ++b;
+  return *a == *b;
+}
+
 int main() {
   using Zero = Int<0>;
   using One = Int<1>;
@@ -224,6 +230,28 @@ int main() {
                      Env<Binding<LenVar, Len>, Binding<SomeVar, Bool<false>>>>,
                 Int<3>>);
 
+  // flat lists: a list has one spelling however it was built
+  static_assert(is_same_v<Eval<TestList, TestEnv>, IntList<1337, 404, 3>>);
+  static_assert(
+      is_same_v<Eval<Cons<Bool<true>, EmptyList>, EmptyEnv>, List<Bool<true>>>);
+  static_assert(
+      is_same_v<Eval<SExp<Op<OpCode::Cons>, Int<1>, IntList<2>>, EmptyEnv>,
+                IntList<1, 2>>);
+  static_assert(
+      is_same_v<Eval<SExp<Op<OpCode::Cons>, Bool<false>, IntList<2>>, EmptyEnv>,
+                List<Bool<false>, Int<2>>>);
+  static_assert(
+      is_same_v<
+          Eval<SExp<Op<OpCode::Cdr>, List<Bool<false>, Int<2>>>, EmptyEnv>,
+          IntList<2>>);
+  static_assert(
+      is_same_v<Eval<SExp<Op<OpCode::Cdr>, IntList<2>>, EmptyEnv>, EmptyList>);
+  static_assert(
+      is_same_v<Eval<SExp<Op<OpCode::Car>, IntList<7, 8>>, EmptyEnv>, Int<7>>);
+  static_assert(
+      is_same_v<Eval<SExp<Op<OpCode::Cons>, Int<1>, Int<2>>, EmptyEnv>,
+                Cons<Int<1>, Int<2>>>);
+
   /**********************
    Cond
   *********************/
@@ -276,9 +304,24 @@ int main() {
   using MappedList = Eval<Let<Env<Binding<MapCarVar, MapCarExp>>,
                               SExp<MapCarVar, Double, SomeList>>,
                           EmptyEnv>;
+  static_assert(is_same_v<MappedList, IntList<4, 8, 12>>);
+
+  // the same, and more, with the list builtins
+  static_assert(is_same_v<Eval<SExp<Op<OpCode::Map>, Double, SomeList>, EmptyEnv>,
+                          IntList<4, 8, 12>>);
+  static_assert(
+      is_same_v<Apply<Op<OpCode::Filter>, Op<OpCode::Not>, List<True, False>>,
+                List<False>>);
+  static_assert(is_same_v<Apply<Op<OpCode::Foldl>, Op<OpCode::Cons>, EmptyList,
+                                IntList<1, 2, 3>>,
+                          IntList<3, 2, 1>>);
   static_assert(
-      is_same_v<MappedList,
-                Cons<Int<4>, Cons<Int<8>, Cons<Int<12>, EmptyList>>>>);
+      is_same_v<Apply<Op<OpCode::Length>, List<True, Int<1>>>, Int<2>>);
+  static_assert(is_same_v<Apply<Op<OpCode::Append>, IntList<1>, EmptyList,
+                                List<True>>,
+                          List<Int<1>, True>>);
+  static_assert(is_same_v<Apply<Op<OpCode::Reverse>, IntList<1, 2, 3>>,
+                          IntList<3, 2, 1>>);
 
   using FactFun =
       Closure<SExp<FactVar, FactArg>, Env<Binding<FactVar, FactExp>>, FactArg>;
@@ -286,7 +329,59 @@ int main() {
   using MappedByFact = Eval<SExp<MapCarVar, FactFun, SomeList>,
                             Env<Binding<MapCarVar, MapCarExp>>>;
 
+  static_assert(is_same_v<MappedByFact, IntList<2, 24, 720>>);
+
+  // lexically addressed forms: a closure sees its parameters at depth 0 and
+  // its captures at depth 1
+  using Frames1 = Frames<Frame<Int<5>, Int<6>>>;
+  static_assert(is_same_v<Eval<Ref<0, 1>, Frames1>, Int<6>>);
+  static_assert(
+      is_same_v<Eval<SExp<Fn<1, SExp<Op<OpCode::Add>, Ref<0, 0>, Ref<1, 0>>,
+                             Ref<0, 0>>,
+                          Int<10>>,
+                     Frames1>,
+                Int<15>>);
+
+  // (letrec ((fib (lambda (n) (if (<= n 1) 1 (+ (fib (- n 1)) (fib (- n 2)))))))
+  //   (fib 10))
+  using FibBody =
+      If<SExp<Op<OpCode::Leq>, Ref<0, 0>, Int<1>>, Int<1>,
+         SExp<Op<OpCode::Add>,
+              SExp<Ref<1, 0>, SExp<Op<OpCode::Sub>, Ref<0, 0>, Int<1>>>,
+              SExp<Ref<1, 0>, SExp<Op<OpCode::Sub>, Ref<0, 0>, Int<2>>>>>;
+  static_assert(is_same_v<Eval<Letrec<SExp<Ref<0, 0>, Int<10>>,
+                                      Rec<Fn<1, FibBody, Ref<0, 0>>>>,
+                               EmptyFrames>,
+                          Int<89>>);
+
+  // a letrec keeps only what its bindings capture, so evaluating it where
+  // the unused Ref<0, 0> differs gives the very same closure
+  using AddB =
+      Letrec<Ref<0, 0>,
+             Rec<Fn<1, SExp<Op<OpCode::Add>, Ref<0, 0>, Ref<1, 0>>, Ref<1, 0>>>,
+             Ref<0, 1>>;
+  static_assert(is_same_v<Eval<AddB, Frames<Frame<Int<1>, Int<2>>>>,
+                          Eval<AddB, Frames<Frame<Int<7>, Int<2>>>>>);
+  static_assert(is_same_v<Apply<Eval<AddB, Frames1>, Int<1>>, Int<7>>);
+
+  // (letrec ((sum (lambda (n acc) (if (= n 0) acc (sum (- n 1) (+ acc n))))))
+  //   (sum 1000 0))
+  // the tail call is a Recur, so the 1000 iterations nest only logarithmically
+  using SumBody = If<SExp<Op<OpCode::Eq>, Ref<0, 0>, Int<0>>, Ref<0, 1>,
+                     Recur<SExp<Op<OpCode::Sub>, Ref<0, 0>, Int<1>>,
+                           SExp<Op<OpCode::Add>, Ref<0, 1>, Ref<0, 0>>>>;
+  static_assert(is_same_v<Eval<Letrec<SExp<Ref<0, 0>, Int<1000>, Int<0>>,
+                                      Rec<Fn<2, Loop<SumBody>>>>,
+                               EmptyFrames>,
+                          Int<500500>>);
+  static_assert(
+      is_same_v<Eval<Loop<SumBody>, Frames<Frame<Int<0>, Int<3>>>>, Int<3>>);
+
   static_assert(
-      is_same_v<MappedByFact,
-                Cons<Int<2>, Cons<Int<24>, Cons<Int<720>, EmptyList>>>>);
+      equal(Serialized<List<IntList<-10, 2>, Cons<True, EmptyList>,
+                            Cons<Op<OpCode::Car>, Int<0>>,
+                            FnClosure<1, Ref<0, 0>, Frames<>>>>{}
+                .text,
+            "tmp_lisp_json:[[-10,2],{\"car\":true,\"cdr\":[]},"
+            "{\"car\":{\"op\":\"Car\"},\"cdr\":0},{\"closure\":1}]"));
 }
@@ -8,6 +8,11 @@
 //  http://www.boost.org/LICENSE_1_0.txt)
 
 #pragma once
+#ifndef TMP_LISP_HPP
+#define TMP_LISP_HPP
+
+#include <cstddef>
+#include <utility>
 
 /*****************
    Syntax constructions
@@ -24,6 +29,14 @@ template <class Car, class Cdr> struct Cons {};
 
 struct EmptyList {};
 
+// Proper lists are flat, so that car, cdr and cons are one pack expansion
+// whatever their length. Every list has one spelling: EmptyList, IntList if
+// all its elements are Ints, List otherwise. Cons values are the remaining,
+// improper pairs; as expressions they build either.
+template <class... Ts> struct List {};
+
+template <int... Is> struct IntList {};
+
 template <class Operator, class... Operands> struct SExp {};
 
 template <class Body, class... Params> struct Lambda {};
@@ -46,7 +59,13 @@ enum class OpCode {
   Cons,
   Car,
   Cdr,
-  IsNull
+  IsNull,
+  Map,
+  Filter,
+  Foldl,
+  Length,
+  Append,
+  Reverse
 };
 
 template <OpCode> struct Op {};
@@ -120,6 +139,69 @@ template <class Variable, class Env>
 using Lookup_t =
     detail::Result_t<PushEnv<detail::Result_t<Lookup<Variable, Env>>, Env>>;
 
+/*****************
+  Lexical environments
+
+  lisp2cpp resolves every variable at transpile time to Ref<Depth, Index>:
+  slot Index of the frame Depth levels out from the innermost one. An
+  environment is a flat list of frames, so a lookup is two pack-indexing
+  steps rather than a walk over bindings.
+
+  A closure keeps only the variables its body uses: its body sees the call
+  arguments at depth 0 and the captured values at depth 1, so closures that
+  capture the same values are the same type wherever they were created.
+ *****************/
+
+template <int Depth, int Index> struct Ref {};
+
+template <int> struct Unbound {};
+
+// the arguments of a call, already evaluated
+template <class... Values> struct Frame {};
+
+// the bindings of a letrec, unevaluated, together with the Frame of values
+// they capture. A binding is evaluated in Frames<RecFrame, Captured>, so the
+// frame, and every closure it makes, depends on nothing else in scope.
+template <class Captured, class... Exps> struct RecFrame {};
+
+// a letrec binding captured by a closure. The binding may be the closure
+// itself, so it is only evaluated when looked up.
+template <class RecFrame, int Index> struct RecSlot {};
+
+// innermost frame first
+template <class... Fs> struct Frames {};
+
+using EmptyFrames = Frames<>;
+
+namespace detail {
+#if defined(__has_builtin)
+#if __has_builtin(__type_pack_element)
+#define TMP_LISP_HAS_TYPE_PACK_ELEMENT
+#endif
+#endif
+
+#ifdef TMP_LISP_HAS_TYPE_PACK_ELEMENT
+template <std::size_t I, class... Ts>
+using PackElement_t = __type_pack_element<I, Ts...>;
+#else
+// Without the builtin, pick the I-th type by overload resolution against a
+// class deriving from one IndexedType per element: no recursion either way.
+template <std::size_t I, class T> struct IndexedType { using type = T; };
+
+template <class Indices, class... Ts> struct Indexer;
+
+template <std::size_t... Is, class... Ts>
+struct Indexer<std::index_sequence<Is...>, Ts...> : IndexedType<Is, Ts>... {};
+
+template <std::size_t I, class T>
+IndexedType<I, T> SelectIndexed(IndexedType<I, T>);
+
+template <std::size_t I, class... Ts>
+using PackElement_t = typename decltype(SelectIndexed<I>(
+    Indexer<std::index_sequence_for<Ts...>, Ts...>{}))::type;
+#endif
+} // namespace detail
+
 /********************
 APPLY fwd definition
 *********************/
@@ -166,6 +248,17 @@ template <> struct ConvertToBool<False> { using type = False; };
 template <> struct ConvertToBool<Int<0>> { using type = False; };
 
 template <class Val> using ConvertToBool_t = Result_t<ConvertToBool<Val>>;
+
+// the list of Ts, spelled as described for List
+template <class... Ts> struct MakeList { using type = ::List<Ts...>; };
+
+template <> struct MakeList<> { using type = EmptyList; };
+
+template <int... Is> struct MakeList<Int<Is>...> {
+  using type = IntList<Is...>;
+};
+
+template <class... Ts> using MakeList_t = Result_t<MakeList<Ts...>>;
 } // namespace detail
 
 template <class Cond, class IfTrue, class IfFalse, class Env>
@@ -185,11 +278,19 @@ struct Eval_<Closure<Body, LambdaEnv, Params...>, Env> {
 };
 
 template <class Car, class Cdr, class Env> struct Eval_<Cons<Car, Cdr>, Env> {
-  using type = Cons<Eval<Car, Env>, Eval<Cdr, Env>>;
+  using type = Apply<Op<OpCode::Cons>, Eval<Car, Env>, Eval<Cdr, Env>>;
 };
 
 template <class _> struct Eval_<EmptyList, _> { using type = EmptyList; };
 
+template <class... Ts, class Env> struct Eval_<List<Ts...>, Env> {
+  using type = detail::MakeList_t<Eval<Ts, Env>...>;
+};
+
+template <int... Is, class _> struct Eval_<IntList<Is...>, _> {
+  using type = IntList<Is...>;
+};
+
 template <OpCode opcode, class _> struct Eval_<Op<opcode>, _> {
   using type = Op<opcode>;
 };
@@ -276,12 +377,188 @@ template <class Car, class Cdr> struct Apply_<Op<OpCode::Cdr>, Cons<Car, Cdr>> {
   using type = Cdr;
 };
 
+template <class Car> struct Apply_<Op<OpCode::Cons>, Car, EmptyList> {
+  using type = detail::MakeList_t<Car>;
+};
+
+template <class Car, class... Ts>
+struct Apply_<Op<OpCode::Cons>, Car, List<Ts...>> {
+  using type = List<Car, Ts...>;
+};
+
+template <class Car, int... Is>
+struct Apply_<Op<OpCode::Cons>, Car, IntList<Is...>> {
+  using type = List<Car, Int<Is>...>;
+};
+
+template <int I, int... Is>
+struct Apply_<Op<OpCode::Cons>, Int<I>, IntList<Is...>> {
+  using type = IntList<I, Is...>;
+};
+
+template <class T, class... Ts> struct Apply_<Op<OpCode::Car>, List<T, Ts...>> {
+  using type = T;
+};
+
+template <int I, int... Is> struct Apply_<Op<OpCode::Car>, IntList<I, Is...>> {
+  using type = Int<I>;
+};
+
+template <class T, class... Ts> struct Apply_<Op<OpCode::Cdr>, List<T, Ts...>> {
+  using type = detail::MakeList_t<Ts...>;
+};
+
+template <int I, int... Is> struct Apply_<Op<OpCode::Cdr>, IntList<I, Is...>> {
+  using type = detail::MakeList_t<Int<Is>...>;
+};
+
 template <class _> struct Apply_<Op<OpCode::IsNull>, _> {
   using type = False;
 };
 
 template <> struct Apply_<Op<OpCode::IsNull>, EmptyList> { using type = True; };
 
+/*****************
+  List builtins
+
+  map, filter, foldl, length, append and reverse work on a list's elements as
+  a pack, so their instantiation depth doesn't grow with its length: map and
+  filter apply the function to every element in one pack expansion, and
+  foldl and append are fold expressions over overloaded operators, whose
+  operands' types are worked out one after another rather than nested.
+******************/
+
+namespace detail {
+// the elements of a list, as a List pack
+template <class L> struct Elements;
+
+template <> struct Elements<EmptyList> { using type = List<>; };
+
+template <class... Ts> struct Elements<::List<Ts...>> {
+  using type = List<Ts...>;
+};
+
+template <int... Is> struct Elements<IntList<Is...>> {
+  using type = List<Int<Is>...>;
+};
+
+template <class L> using Elements_t = Result_t<Elements<L>>;
+
+template <class Pack> struct FromElements;
+
+template <class... Ts> struct FromElements<List<Ts...>> {
+  using type = MakeList_t<Ts...>;
+};
+
+template <class Pack> using FromElements_t = Result_t<FromElements<Pack>>;
+
+// only for decltype: the concatenation of two packs
+template <class... Ts, class... Us>
+List<Ts..., Us...> operator+(List<Ts...>, List<Us...>);
+
+template <class... Packs>
+using Join_t = decltype((List<>{} + ... + Packs{}));
+
+template <class Keep, class T> struct Kept { using type = List<>; };
+
+template <class T> struct Kept<True, T> { using type = List<T>; };
+
+template <class F, class Pack> struct Map;
+
+template <class F, class... Ts> struct Map<F, List<Ts...>> {
+  using type = MakeList_t<Apply<F, Ts>...>;
+};
+
+template <class F, class Pack> struct Filter;
+
+template <class F, class... Ts> struct Filter<F, List<Ts...>> {
+  using type = FromElements_t<
+      Join_t<Result_t<Kept<ConvertToBool_t<Apply<F, Ts>>, Ts>>...>>;
+};
+
+template <class F, class Acc> struct FoldState { using type = Acc; };
+
+template <class T> struct Item {};
+
+// only for decltype: one step of a left fold, calling F with the element and
+// the value so far
+template <class F, class Acc, class T>
+FoldState<F, Apply<F, T, Acc>> operator<<(FoldState<F, Acc>, Item<T>);
+
+template <class F, class Init, class Pack> struct Foldl;
+
+template <class F, class Init, class... Ts>
+struct Foldl<F, Init, List<Ts...>> {
+  using type =
+      Result_t<decltype((FoldState<F, Init>{} << ... << Item<Ts>{}))>;
+};
+
+template <class Pack> struct Length;
+
+template <class... Ts> struct Length<List<Ts...>> {
+  using type = Int<sizeof...(Ts)>;
+};
+
+// the elements of Pack at Indices, from the last
+template <class Pack, class Indices> struct ReverseAt;
+
+template <class... Ts, std::size_t... Is>
+struct ReverseAt<List<Ts...>, std::index_sequence<Is...>> {
+  using type = MakeList_t<PackElement_t<sizeof...(Ts) - 1 - Is, Ts...>...>;
+};
+
+// Ints are picked from an array instead, which needs no pack indexing
+template <int... Is> struct Ints { static constexpr int values[] = {Is..., 0}; };
+
+template <class Ints, class Indices> struct ReverseInts;
+
+template <class Ints, std::size_t... Js>
+struct ReverseInts<Ints, std::index_sequence<Js...>> {
+  using type = IntList<Ints::values[sizeof...(Js) - 1 - Js]...>;
+};
+
+template <class Pack> struct Reverse;
+
+template <class... Ts> struct Reverse<List<Ts...>> {
+  using type = Result_t<ReverseAt<List<Ts...>, std::index_sequence_for<Ts...>>>;
+};
+} // namespace detail
+
+template <class F, class L> struct Apply_<Op<OpCode::Map>, F, L> {
+  using type = detail::Result_t<detail::Map<F, detail::Elements_t<L>>>;
+};
+
+template <class F, class L> struct Apply_<Op<OpCode::Filter>, F, L> {
+  using type = detail::Result_t<detail::Filter<F, detail::Elements_t<L>>>;
+};
+
+template <class F, class Init, class L>
+struct Apply_<Op<OpCode::Foldl>, F, Init, L> {
+  using type = detail::Result_t<detail::Foldl<F, Init, detail::Elements_t<L>>>;
+};
+
+template <class L> struct Apply_<Op<OpCode::Length>, L> {
+  using type = detail::Result_t<detail::Length<detail::Elements_t<L>>>;
+};
+
+template <int... Is> struct Apply_<Op<OpCode::Length>, IntList<Is...>> {
+  using type = Int<sizeof...(Is)>;
+};
+
+template <class... Ls> struct Apply_<Op<OpCode::Append>, Ls...> {
+  using type =
+      detail::FromElements_t<detail::Join_t<detail::Elements_t<Ls>...>>;
+};
+
+template <class L> struct Apply_<Op<OpCode::Reverse>, L> {
+  using type = detail::Result_t<detail::Reverse<detail::Elements_t<L>>>;
+};
+
+template <int... Is> struct Apply_<Op<OpCode::Reverse>, IntList<Is...>> {
+  using type = detail::Result_t<detail::ReverseInts<
+      detail::Ints<Is...>, std::make_index_sequence<sizeof...(Is)>>>;
+};
+
 template <class Body, class Env, class... Params, class... Args>
 struct Apply_<Closure<Body, Env, Params...>, Args...> {
   static_assert(sizeof...(Params) == sizeof...(Args));
@@ -291,6 +568,170 @@ struct Apply_<Closure<Body, Env, Params...>, Args...> {
   using type = Eval<Body, ExtendedEnv>;
 };
 
+/*****************
+  Lexically addressed forms
+******************/
+
+// a lambda together with the addresses, where it is evaluated, of the
+// variables it captures
+template <int Arity, class Body, class... Captures> struct Fn {};
+
+// Captured is the Frame of captured values
+template <int Arity, class Body, class Captured> struct FnClosure {};
+
+// the binding expressions of a letrec
+template <class... Exps> struct Rec {};
+
+// letrec: every Exp sees all the bindings at depth 0 and the values listed in
+// Captures, like those of a Fn, at depth 1. Body sees the bindings at depth 0
+// and the enclosing frames after them.
+template <class Body, class Bindings, class... Captures> struct Letrec {};
+
+namespace detail {
+template <class Frame, int Index> struct LookupInFrame;
+
+template <class Value> struct Force { using type = Value; };
+
+template <class RecFrame, int Index> struct Force<RecSlot<RecFrame, Index>> {
+  using type = Result_t<LookupInFrame<RecFrame, Index>>;
+};
+
+template <class... Values, int Index>
+struct LookupInFrame<Frame<Values...>, Index> {
+  using type = Result_t<Force<PackElement_t<Index, Values...>>>;
+};
+
+template <class Captured, class... Exps, int Index>
+struct LookupInFrame<RecFrame<Captured, Exps...>, Index> {
+  using type = Eval<PackElement_t<Index, Exps...>,
+                    Frames<RecFrame<Captured, Exps...>, Captured>>;
+};
+
+template <class Frame, int Index> struct Capture;
+
+template <class... Values, int Index> struct Capture<Frame<Values...>, Index> {
+  using type = PackElement_t<Index, Values...>;
+};
+
+template <class Captured, class... Exps, int Index>
+struct Capture<RecFrame<Captured, Exps...>, Index> {
+  using type = RecSlot<RecFrame<Captured, Exps...>, Index>;
+};
+
+template <class Captures, class Env> struct CaptureFrame;
+
+template <int... Depths, int... Indices, class... Fs>
+struct CaptureFrame<List<Ref<Depths, Indices>...>, Frames<Fs...>> {
+  using type =
+      Frame<Result_t<Capture<PackElement_t<Depths, Fs...>, Indices>>...>;
+};
+
+template <class Captures, class Env>
+using CaptureFrame_t = Result_t<CaptureFrame<Captures, Env>>;
+} // namespace detail
+
+template <int Depth, int Index, class... Fs>
+struct Eval_<Ref<Depth, Index>, Frames<Fs...>> {
+  using type = detail::Result_t<
+      detail::LookupInFrame<detail::PackElement_t<Depth, Fs...>, Index>>;
+};
+
+template <int Arity, class Body, class... Captures, class Env>
+struct Eval_<Fn<Arity, Body, Captures...>, Env> {
+  using type =
+      FnClosure<Arity, Body,
+                detail::CaptureFrame_t<detail::List<Captures...>, Env>>;
+};
+
+template <int Arity, class Body, class Captured, class Env>
+struct Eval_<FnClosure<Arity, Body, Captured>, Env> {
+  using type = FnClosure<Arity, Body, Captured>;
+};
+
+template <class Body, class... Exps, class... Captures, class... Fs>
+struct Eval_<Letrec<Body, Rec<Exps...>, Captures...>, Frames<Fs...>> {
+  using Captured =
+      detail::CaptureFrame_t<detail::List<Captures...>, Frames<Fs...>>;
+  using type = Eval<Body, Frames<RecFrame<Captured, Exps...>, Fs...>>;
+};
+
+template <int Arity, class Body, class Captured, class... Args>
+struct Apply_<FnClosure<Arity, Body, Captured>, Args...> {
+  static_assert(Arity == sizeof...(Args));
+  using type = Eval<Body, Frames<Frame<Args...>, Captured>>;
+};
+
+/*****************
+  Loops
+
+  Loop<Body> runs Body with the innermost frame as the loop variables. Body
+  evaluates to either its result, or, through a Recur<Exps...> in tail
+  position, to the Frame of values for the next iteration. lisp2cpp wraps the
+  bodies of self tail-recursive letrec lambdas in Loop, turning the tail
+  calls into Recur.
+
+  Iterations run in blocks: a block of 2^K iterations is two blocks of
+  2^(K-1), and blocks of 1, 2, 4, ... are tried until the loop is done. A
+  loop of N iterations therefore needs O(log N) nested instantiations rather
+  than one Eval_/Apply_ pair per iteration.
+******************/
+
+template <class Body> struct Loop {};
+
+template <class... Exps> struct Recur {};
+
+namespace detail {
+template <class Value> struct Done {};
+
+template <class Value> struct Continue { using type = Done<Value>; };
+
+template <class... Values> struct Continue<Frame<Values...>> {
+  using type = Frame<Values...>;
+};
+
+// run up to 2^K iterations, starting from State
+template <int K, class Body, class Env, class State> struct Iterate;
+
+template <int K, class Body, class Env, class State>
+using Iterate_t = Result_t<Iterate<K, Body, Env, State>>;
+
+template <int K, class Body, class Env, class Value>
+struct Iterate<K, Body, Env, Done<Value>> {
+  using type = Done<Value>;
+};
+
+template <int K, class Body, class Env, class... Values>
+struct Iterate<K, Body, Env, Frame<Values...>> {
+  using type = Iterate_t<K - 1, Body, Env,
+                         Iterate_t<K - 1, Body, Env, Frame<Values...>>>;
+};
+
+template <class Body, class... Fs, class... Values>
+struct Iterate<0, Body, Frames<Fs...>, Frame<Values...>> {
+  using type = Result_t<Continue<Eval<Body, Frames<Frame<Values...>, Fs...>>>>;
+};
+
+template <int K, class Body, class Env, class State> struct RunLoop {
+  using type =
+      Result_t<RunLoop<K + 1, Body, Env, Iterate_t<K, Body, Env, State>>>;
+};
+
+template <int K, class Body, class Env, class Value>
+struct RunLoop<K, Body, Env, Done<Value>> {
+  using type = Value;
+};
+} // namespace detail
+
+template <class Body, class... Values, class... Fs>
+struct Eval_<Loop<Body>, Frames<Frame<Values...>, Fs...>> {
+  using type = detail::Result_t<
+      detail::RunLoop<0, Body, Frames<Fs...>, Frame<Values...>>>;
+};
+
+template <class... Exps, class Env> struct Eval_<Recur<Exps...>, Env> {
+  using type = Frame<Eval<Exps, Env>...>;
+};
+
 /*****************
   Compound forms
 ******************/
@@ -311,3 +752,622 @@ struct Cond_<DefaultExp, Cond, IfMatch, RemainingCases...> {
 
 template <class DefaultExp, class... Cases>
 using Cond = detail::Result_t<Cond_<DefaultExp, Cases...>>;
+
+/*****************
+  constexpr backend
+
+  lisp2cpp --backend constexpr evaluates the same programs with constexpr
+  functions instead of template instantiations. Values are small structs;
+  cons cells, closure captures and letrec frames live in the fixed-size
+  heap of a Machine, which is itself a constant once evaluation is done, so
+  the result can be spelled as the usual Int/Bool/List/EmptyList types.
+
+  The generated Program has one code function, switching on the code id of
+  every lambda and letrec binding (0 is the whole program). Code sees its
+  frames through pointers: f0 holds the arguments, or the letrec frame for a
+  binding, and f1 the captured values, as at depths 0 and 1 of the template
+  backend. Errors are throw expressions, which aren't constant expressions,
+  so the compiler reports the one evaluation reached.
+ *****************/
+
+namespace constexpr_lisp {
+enum class Tag {
+  Nil,
+  Int,
+  Bool,
+  Cons,
+  Op,
+  Fn,
+  // a letrec binding not evaluated yet, or being evaluated
+  Thunk,
+  Forcing,
+  // a letrec binding captured by a closure, at heap index a
+  RecSlot,
+  // the start of a letrec frame: the heap index of its captured values
+  Block,
+  // the next iteration of a loop
+  Recur
+};
+
+struct Value {
+  Tag tag = Tag::Nil;
+  int a = 0;
+  int b = 0;
+};
+
+constexpr Value integer(int i) { return {Tag::Int, i}; }
+
+constexpr Value boolean(bool b) { return {Tag::Bool, b}; }
+
+constexpr Value op(OpCode opcode) { return {Tag::Op, static_cast<int>(opcode)}; }
+
+// a closure in the Result of a constexpr program; Code is its code id
+template <int Code> struct Procedure {};
+
+template <class Program, std::size_t Cells> struct Machine {
+  Value heap[Cells] = {};
+  std::size_t size = 0;
+  Value result = {};
+
+  static constexpr Machine run() {
+    Machine m{};
+    m.result = Program::code(m, 0, 0, nullptr, nullptr);
+    return m;
+  }
+
+  constexpr std::size_t alloc(std::size_t n) {
+    if (size + n > Cells)
+      throw "heap exhausted";
+    size += n;
+    return size - n;
+  }
+
+  template <class... Vs> constexpr int block(Vs... vs) {
+    Value values[] = {vs..., Value{}};
+    auto start = alloc(sizeof...(vs));
+    for (std::size_t i = 0; i < sizeof...(vs); ++i)
+      heap[start + i] = values[i];
+    return static_cast<int>(start);
+  }
+
+  // a letrec frame of unevaluated bindings, preceded by a Block pointing to
+  // the values they capture
+  template <class... Codes>
+  constexpr const Value *letrec(int captured, Codes... codes) {
+    auto frame = static_cast<int>(alloc(1 + sizeof...(codes))) + 1;
+    heap[frame - 1] = {Tag::Block, captured};
+    int i = 0;
+    ((heap[frame + i++] = Value{Tag::Thunk, codes, frame}), ...);
+    return heap + frame;
+  }
+
+  constexpr Value get(const Value *slot) {
+    switch (slot->tag) {
+    case Tag::RecSlot:
+      return force(slot->a);
+    case Tag::Thunk:
+    case Tag::Forcing:
+      return force(static_cast<int>(slot - heap));
+    default:
+      return *slot;
+    }
+  }
+
+  constexpr Value force(int index) {
+    Value thunk = heap[index];
+    if (thunk.tag == Tag::Forcing)
+      throw "letrec binding depends on its own value";
+    if (thunk.tag != Tag::Thunk)
+      return thunk;
+    heap[index].tag = Tag::Forcing;
+    const Value *frame = heap + thunk.b;
+    Value res = Program::code(*this, thunk.a, 0, frame, heap + frame[-1].a);
+    heap[index] = res;
+    return res;
+  }
+
+  constexpr Value slot(const Value *slot) const {
+    return {Tag::RecSlot, static_cast<int>(slot - heap)};
+  }
+
+  template <class... Vs> constexpr Value closure(int code, Vs... captured) {
+    return {Tag::Fn, code, block(captured...)};
+  }
+
+  constexpr Value cons(Value car, Value cdr) {
+    return {Tag::Cons, block(car, cdr)};
+  }
+
+  template <class... Vs> constexpr Value list(Vs... vs) {
+    Value values[] = {vs..., Value{}};
+    Value res = {};
+    for (auto i = sizeof...(vs); i > 0; --i)
+      res = cons(values[i - 1], res);
+    return res;
+  }
+
+  static constexpr bool truthy(Value v) {
+    return !((v.tag == Tag::Bool || v.tag == Tag::Int) && v.a == 0);
+  }
+
+  static constexpr void check_arity(int n, int arity) {
+    if (n != arity)
+      throw "wrong number of arguments";
+  }
+
+  static constexpr Value unbound(int) {
+    throw "unbound variable";
+  }
+
+  template <class... Vs> constexpr Value call(Value f, Vs... args) {
+    Value values[] = {args..., Value{}};
+    if (f.tag == Tag::Fn)
+      return Program::code(*this, f.a, sizeof...(args), values, heap + f.b);
+    if (f.tag == Tag::Op)
+      return apply_op(static_cast<OpCode>(f.a), values, sizeof...(args));
+    throw "not a procedure";
+  }
+
+  template <OpCode opcode, class... Vs> constexpr Value prim(Vs... args) {
+    Value values[] = {args..., Value{}};
+    return apply_op(opcode, values, sizeof...(args));
+  }
+
+  // the common binary cases skip the generic apply_op
+  template <OpCode opcode> constexpr Value prim(Value lhs, Value rhs) {
+    if constexpr (opcode == OpCode::Add || opcode == OpCode::Sub ||
+                  opcode == OpCode::Mul || opcode == OpCode::Leq) {
+      if (lhs.tag != Tag::Int || rhs.tag != Tag::Int)
+        throw "expected integers";
+      if constexpr (opcode == OpCode::Add)
+        return integer(lhs.a + rhs.a);
+      else if constexpr (opcode == OpCode::Sub)
+        return integer(lhs.a - rhs.a);
+      else if constexpr (opcode == OpCode::Mul)
+        return integer(lhs.a * rhs.a);
+      else
+        return boolean(lhs.a <= rhs.a);
+    } else if constexpr (opcode == OpCode::Eq) {
+      return boolean(lhs.tag == rhs.tag &&
+                     (lhs.tag == Tag::Int || lhs.tag == Tag::Bool) &&
+                     lhs.a == rhs.a);
+    } else {
+      Value values[] = {lhs, rhs};
+      return apply_op(opcode, values, 2);
+    }
+  }
+
+  // runs Body with the loop variables until it evaluates to something other
+  // than a Recur, which has left the next values in its second argument
+  template <int Arity, class Body>
+  constexpr Value loop(const Value *args, Body body) {
+    Value vars[Arity + 1] = {}, next[Arity + 1] = {};
+    for (int i = 0; i < Arity; ++i)
+      vars[i] = args[i];
+    for (;;) {
+      Value res = body(static_cast<const Value *>(vars), next);
+      if (res.tag != Tag::Recur)
+        return res;
+      for (int i = 0; i < Arity; ++i)
+        vars[i] = next[i];
+    }
+  }
+
+  template <class... Vs> static constexpr Value recur(Value *next, Vs... vs) {
+    Value values[] = {vs..., Value{}};
+    for (std::size_t i = 0; i < sizeof...(vs); ++i)
+      next[i] = values[i];
+    return {Tag::Recur};
+  }
+
+private:
+  static constexpr bool all(const Value *args, int n, Tag tag) {
+    for (int i = 0; i < n; ++i)
+      if (args[i].tag != tag)
+        return false;
+    return true;
+  }
+
+  // whether a proper list has elements left from l
+  static constexpr bool more(Value l) {
+    if (l.tag != Tag::Nil && l.tag != Tag::Cons)
+      throw "expected a list";
+    return l.tag == Tag::Cons;
+  }
+
+  static constexpr void check_ints(const Value *args, int n) {
+    if (!all(args, n, Tag::Int))
+      throw "expected integers";
+  }
+
+  static constexpr void check_bools(const Value *args, int n) {
+    if (!all(args, n, Tag::Bool))
+      throw "expected booleans";
+  }
+
+  // the same semantics as the Apply_ specializations for Op<OpCode>
+  constexpr Value apply_op(OpCode opcode, const Value *args, int n) {
+    switch (opcode) {
+    case OpCode::Add: {
+      check_ints(args, n);
+      int res = 0;
+      for (int i = 0; i < n; ++i)
+        res += args[i].a;
+      return integer(res);
+    }
+    case OpCode::Sub: {
+      check_ints(args, n);
+      if (n == 0)
+        throw "- takes at least one argument";
+      if (n == 1)
+        return integer(-args[0].a);
+      int res = args[0].a;
+      for (int i = 1; i < n; ++i)
+        res -= args[i].a;
+      return integer(res);
+    }
+    case OpCode::Mul: {
+      check_ints(args, n);
+      int res = 1;
+      for (int i = 0; i < n; ++i)
+        res *= args[i].a;
+      return integer(res);
+    }
+    case OpCode::Eq: {
+      // a left fold of ==, like (... == is)
+      if (n == 0)
+        throw "= takes at least one argument";
+      if (!all(args, n, Tag::Int) && !all(args, n, Tag::Bool))
+        return boolean(false);
+      int res = args[0].a;
+      for (int i = 1; i < n; ++i)
+        res = res == args[i].a;
+      if (res != 0 && res != 1)
+        throw "narrowing to a bool";
+      return boolean(res);
+    }
+    case OpCode::Leq:
+      check_ints(args, n);
+      check_arity(n, 2);
+      return boolean(args[0].a <= args[1].a);
+    case OpCode::Or: {
+      check_bools(args, n);
+      bool res = false;
+      for (int i = 0; i < n; ++i)
+        res = res || args[i].a;
+      return boolean(res);
+    }
+    case OpCode::And: {
+      check_bools(args, n);
+      bool res = true;
+      for (int i = 0; i < n; ++i)
+        res = res && args[i].a;
+      return boolean(res);
+    }
+    case OpCode::Not:
+      check_bools(args, n);
+      check_arity(n, 1);
+      return boolean(!args[0].a);
+    case OpCode::Cons:
+      check_arity(n, 2);
+      return cons(args[0], args[1]);
+    case OpCode::Car:
+    case OpCode::Cdr:
+      check_arity(n, 1);
+      if (args[0].tag != Tag::Cons)
+        throw "car and cdr take a cons";
+      return heap[args[0].a + (opcode == OpCode::Cdr)];
+    case OpCode::IsNull:
+      check_arity(n, 1);
+      return boolean(args[0].tag == Tag::Nil);
+    case OpCode::Map: {
+      check_arity(n, 2);
+      Value res = {}, *last = &res;
+      for (Value l = args[1]; more(l); l = heap[l.a + 1]) {
+        *last = cons(call(args[0], heap[l.a]), Value{});
+        last = heap + last->a + 1;
+      }
+      return res;
+    }
+    case OpCode::Filter: {
+      check_arity(n, 2);
+      Value res = {}, *last = &res;
+      for (Value l = args[1]; more(l); l = heap[l.a + 1])
+        if (truthy(call(args[0], heap[l.a]))) {
+          *last = cons(heap[l.a], Value{});
+          last = heap + last->a + 1;
+        }
+      return res;
+    }
+    case OpCode::Foldl: {
+      check_arity(n, 3);
+      Value res = args[1];
+      for (Value l = args[2]; more(l); l = heap[l.a + 1])
+        res = call(args[0], heap[l.a], res);
+      return res;
+    }
+    case OpCode::Length: {
+      check_arity(n, 1);
+      int res = 0;
+      for (Value l = args[0]; more(l); l = heap[l.a + 1])
+        ++res;
+      return integer(res);
+    }
+    case OpCode::Append: {
+      Value res = {}, *last = &res;
+      for (int i = 0; i < n; ++i)
+        for (Value l = args[i]; more(l); l = heap[l.a + 1]) {
+          *last = cons(heap[l.a], Value{});
+          last = heap + last->a + 1;
+        }
+      return res;
+    }
+    case OpCode::Reverse: {
+      check_arity(n, 1);
+      Value res = {};
+      for (Value l = args[0]; more(l); l = heap[l.a + 1])
+        res = cons(heap[l.a], res);
+      return res;
+    }
+    default:
+      throw "unsupported operator";
+    }
+  }
+};
+
+namespace detail {
+template <class Run, Tag T, int A, int B> struct ToType;
+
+template <class Run, int A, int B> struct ToType<Run, Tag::Nil, A, B> {
+  using type = EmptyList;
+};
+
+template <class Run, int A, int B> struct ToType<Run, Tag::Int, A, B> {
+  using type = Int<A>;
+};
+
+template <class Run, int A, int B> struct ToType<Run, Tag::Bool, A, B> {
+  using type = Bool<A != 0>;
+};
+
+template <class Run, int A, int B> struct ToType<Run, Tag::Op, A, B> {
+  using type = Op<static_cast<OpCode>(A)>;
+};
+
+template <class Run, int A, int B> struct ToType<Run, Tag::Fn, A, B> {
+  using type = Procedure<A>;
+};
+
+// the length of the list whose first cons cell is at heap index cell, or -1
+// if it doesn't end in '()
+template <class Run> constexpr int list_length(int cell) {
+  int n = 1;
+  Value cdr = Run::machine.heap[cell + 1];
+  for (; cdr.tag == Tag::Cons; ++n)
+    cdr = Run::machine.heap[cdr.a + 1];
+  return cdr.tag == Tag::Nil ? n : -1;
+}
+
+// the N elements of a list, gathered in one pass
+template <class Run, int Cell, std::size_t N> struct Items {
+  Value values[N] = {};
+  bool ints = true;
+
+  constexpr Items() {
+    int cell = Cell;
+    for (std::size_t i = 0; i < N; ++i) {
+      values[i] = Run::machine.heap[cell];
+      ints = ints && values[i].tag == Tag::Int;
+      cell = Run::machine.heap[cell + 1].a;
+    }
+  }
+};
+
+// proper lists are spelled as a flat List or IntList, so spelling a long
+// one doesn't nest a ToType per element
+template <class Run, int Cell, class Indices> struct ListToType;
+
+template <class Run, int Cell, std::size_t... Is>
+struct ListToType<Run, Cell, std::index_sequence<Is...>> {
+  static constexpr Items<Run, Cell, sizeof...(Is)> items{};
+
+  template <bool Ints, class = void> struct Spell {
+    using type = List<typename ToType<Run, items.values[Is].tag,
+                                      items.values[Is].a,
+                                      items.values[Is].b>::type...>;
+  };
+
+  template <class _> struct Spell<true, _> {
+    using type = IntList<items.values[Is].a...>;
+  };
+
+  using type = typename Spell<items.ints>::type;
+};
+
+template <class Run, int A, int B> struct ToType<Run, Tag::Cons, A, B> {
+  static constexpr int length = list_length<Run>(A);
+
+  template <bool Proper, class = void> struct Spell {
+    static constexpr Value car = Run::machine.heap[A];
+    static constexpr Value cdr = Run::machine.heap[A + 1];
+    using type = Cons<typename ToType<Run, car.tag, car.a, car.b>::type,
+                      typename ToType<Run, cdr.tag, cdr.a, cdr.b>::type>;
+  };
+
+  template <class _> struct Spell<true, _> {
+    using type = typename ListToType<Run, A,
+                                     std::make_index_sequence<length>>::type;
+  };
+
+  using type = typename Spell<(length > 0)>::type;
+};
+} // namespace detail
+
+// the type spelling the result of a Run, whose static member machine is an
+// evaluated Machine
+template <class Run>
+using Result_t =
+    typename detail::ToType<Run, Run::machine.result.tag, Run::machine.result.a,
+                            Run::machine.result.b>::type;
+} // namespace constexpr_lisp
+
+/*****************
+  Serialization
+
+  Serialized<T>::text spells the value T as JSON, worked out by the compiler:
+  Ints are numbers, Bools true or false, proper lists arrays, other pairs
+  {"car": ..., "cdr": ...}, operators {"op": "Add"} and closures
+  {"closure": arity}, where the arity of a constexpr_lisp::Procedure is null.
+  The text starts with "tmp_lisp_json:", so a Serialized<Result> defined with
+  external linkage can be found in an object file, which is much cheaper for
+  a large Result than reading its type back from a compiler diagnostic.
+ *****************/
+
+namespace detail {
+// static constexpr std::size_t size, and static constexpr char *write(char
+// *out), which writes size characters from out and returns their end
+template <class T> struct Json;
+
+constexpr std::size_t digits(long long v) {
+  std::size_t n = 1;
+  for (; v >= 10; v /= 10)
+    ++n;
+  return n;
+}
+
+constexpr std::size_t int_size(int i) {
+  return i < 0 ? 1 + digits(-static_cast<long long>(i)) : digits(i);
+}
+
+constexpr char *write_int(int i, char *out) {
+  long long v = i;
+  if (v < 0) {
+    *out++ = '-';
+    v = -v;
+  }
+  char *end = out + digits(v);
+  for (char *p = end; p != out; v /= 10)
+    *--p = static_cast<char>('0' + v % 10);
+  return end;
+}
+
+constexpr std::size_t str_size(const char *s) {
+  std::size_t n = 0;
+  while (s[n])
+    ++n;
+  return n;
+}
+
+constexpr char *write_str(const char *s, char *out) {
+  while (*s)
+    *out++ = *s++;
+  return out;
+}
+
+constexpr const char *json_marker() { return "tmp_lisp_json:"; }
+
+constexpr const char *op_name(OpCode opcode) {
+  constexpr const char *names[] = {
+      "Add", "Sub",  "Mul", "Eq",  "Neq",    "Leq",    "Neg",
+      "Or",  "And",  "Not", "Cons", "Car",   "Cdr",    "IsNull",
+      "Map", "Filter", "Foldl", "Length", "Append", "Reverse"};
+  return names[static_cast<int>(opcode)];
+}
+
+template <int I> struct Json<Int<I>> {
+  static constexpr std::size_t size = int_size(I);
+  static constexpr char *write(char *out) { return write_int(I, out); }
+};
+
+template <bool B> struct Json<Bool<B>> {
+  static constexpr std::size_t size = B ? 4 : 5;
+  static constexpr char *write(char *out) {
+    return write_str(B ? "true" : "false", out);
+  }
+};
+
+template <> struct Json<EmptyList> {
+  static constexpr std::size_t size = 2;
+  static constexpr char *write(char *out) { return write_str("[]", out); }
+};
+
+// every element is written followed by a comma, and the last comma becomes
+// the closing bracket
+template <class... Ts> struct Json<::List<Ts...>> {
+  static constexpr std::size_t size =
+      (Json<Ts>::size + ... + 0) + sizeof...(Ts) + (sizeof...(Ts) ? 1 : 2);
+  static constexpr char *write(char *out) {
+    *out++ = '[';
+    ((out = Json<Ts>::write(out), *out++ = ','), ...);
+    if (sizeof...(Ts))
+      --out;
+    *out++ = ']';
+    return out;
+  }
+};
+
+template <int... Is> struct Json<IntList<Is...>> {
+  static constexpr std::size_t size =
+      (int_size(Is) + ... + 0) + sizeof...(Is) + (sizeof...(Is) ? 1 : 2);
+  static constexpr char *write(char *out) {
+    *out++ = '[';
+    ((out = write_int(Is, out), *out++ = ','), ...);
+    if (sizeof...(Is))
+      --out;
+    *out++ = ']';
+    return out;
+  }
+};
+
+template <class Car, class Cdr> struct Json<Cons<Car, Cdr>> {
+  static constexpr std::size_t size =
+      str_size("{\"car\":,\"cdr\":}") + Json<Car>::size + Json<Cdr>::size;
+  static constexpr char *write(char *out) {
+    out = Json<Car>::write(write_str("{\"car\":", out));
+    out = Json<Cdr>::write(write_str(",\"cdr\":", out));
+    return write_str("}", out);
+  }
+};
+
+template <OpCode opcode> struct Json<Op<opcode>> {
+  static constexpr std::size_t size =
+      str_size("{\"op\":\"\"}") + str_size(op_name(opcode));
+  static constexpr char *write(char *out) {
+    out = write_str(op_name(opcode), write_str("{\"op\":\"", out));
+    return write_str("\"}", out);
+  }
+};
+
+// a closure of the given arity, or of unknown arity if Arity is negative
+template <int Arity> struct ClosureJson {
+  static constexpr std::size_t size =
+      str_size("{\"closure\":}") + (Arity < 0 ? 4 : int_size(Arity));
+  static constexpr char *write(char *out) {
+    out = write_str("{\"closure\":", out);
+    out = Arity < 0 ? write_str("null", out) : write_int(Arity, out);
+    return write_str("}", out);
+  }
+};
+
+template <class Body, class Environment, class... Params>
+struct Json<Closure<Body, Environment, Params...>>
+    : ClosureJson<sizeof...(Params)> {};
+
+template <int Arity, class Body, class Captured>
+struct Json<FnClosure<Arity, Body, Captured>> : ClosureJson<Arity> {};
+
+template <int Code>
+struct Json<constexpr_lisp::Procedure<Code>> : ClosureJson<-1> {};
+} // namespace detail
+
+template <class T> struct Serialized {
+  char text[detail::str_size(detail::json_marker()) + detail::Json<T>::size +
+            1] = {};
+
+  constexpr Serialized() {
+    *detail::Json<T>::write(detail::write_str(detail::json_marker(), text)) =
+        '\0';
+  }
+};
+
+#endif // TMP_LISP_HPP
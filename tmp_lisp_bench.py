@@ -0,0 +1,594 @@
+#  Restricted Scheme-like Language using Template Metaprogramming
+#
+#  Copyright Thomas D Peters 2018-present
+#
+#  Use, modification and distribution is subject to the
+#  Boost Software License, Version 1.0. (See accompanying
+#  file LICENSE or copy at
+#  http://www.boost.org/LICENSE_1_0.txt)
+
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from tempfile import TemporaryDirectory
+
+from cppdriver import DEFAULT_FLAGS, HEADER_DIR, HEADER_PATH, Compiler, sha256
+from lisp2cpp import BACKENDS, Lisp2Cpp
+from lisp2cpp_profile import TRACE_FLAGS
+
+
+def static_assert_program(text, expected):
+    return (
+        "#include <type_traits>\n"
+        + Lisp2Cpp(text).codegen()
+        + f"\nstatic_assert(std::is_same<Result, {expected}>::value);\n"
+    )
+
+
+def with_environment(text, env_size):
+    """
+    Wrap text in a let binding env_size unrelated variables, so that every
+    lookup happens in a large environment.
+    """
+    if not env_size:
+        return text
+    bindings = " ".join(f"(unused{i} {i})" for i in range(env_size))
+    return f"(let ({bindings}) {text})"
+
+
+def fib_program(n):
+    return (
+        "(letrec ((fib (lambda (n)"
+        "                (if (<= n 0)"
+        "                    1"
+        "                    (+ (fib (- n 1)) (fib (- n 2)))))))"
+        f"  (fib {n}))"
+    )
+
+
+def mapcar_program(n):
+    values = " ".join(str(i) for i in range(n))
+    return (
+        "(letrec ((mapcar (lambda (f list)"
+        "                   (if (null? list)"
+        "                       '()"
+        "                       (cons (f (car list)) (mapcar f (cdr list)))))))"
+        f"  (mapcar (lambda (x) (* x 2)) '({values})))"
+    )
+
+
+def fib_identity_program(n):
+    # each call passes down a fresh (lambda (x) x): it uses no variables, so
+    # with free-variable closures every copy is the same type
+    return (
+        "(letrec ((fib (lambda (n k)"
+        "                (if (<= n 0)"
+        "                    (k 1)"
+        "                    (+ (fib (- n 1) (lambda (x) x))"
+        "                       (fib (- n 2) (lambda (x) x)))))))"
+        f"  (fib {n} (lambda (x) x)))"
+    )
+
+
+def counter_program(n):
+    # builds a chain of n closures, each capturing only the previous one
+    return (
+        "(letrec ((count (lambda (n acc)"
+        "                  (if (= n 0)"
+        "                      (acc 0)"
+        "                      (count (- n 1) (lambda (x) (acc (+ x 1))))))))"
+        f"  (count {n} (lambda (x) x)))"
+    )
+
+
+def scale_program(n):
+    values = " ".join(str(i) for i in range(n))
+    return (
+        "(letrec ((mapcar (lambda (f list)"
+        "                   (if (null? list)"
+        "                       '()"
+        "                       (cons (f (car list)) (mapcar f (cdr list))))))"
+        "         (scale (lambda (k list) (mapcar (lambda (x) (* k x)) list))))"
+        f"  (scale 3 '({values})))"
+    )
+
+
+def local_fib_program(n):
+    # the inner letrec uses nothing from go, so with letrecs that capture only
+    # their free variables every (fib 20) after the first is already known
+    return (
+        "(letrec ((go (lambda (i)"
+        "               (if (= i 0)"
+        "                   0"
+        "                   (+ (letrec ((fib (lambda (n)"
+        "                                      (if (<= n 1)"
+        "                                          n"
+        "                                          (+ (fib (- n 1)) (fib (- n 2)))))))"
+        "                        (fib 20))"
+        "                      (go (- i 1)))))))"
+        f"  (go {n}))"
+    )
+
+
+def loop_program(n):
+    # the self call is in tail position, so lisp2cpp turns it into a Loop
+    return f"(let loop ((i 0) (acc 0)) (if (= i {n}) acc (loop (+ i 1) (+ acc i))))"
+
+
+def recursion_program(n):
+    # the same sum, but the self call is not in tail position
+    return (
+        "(letrec ((sum (lambda (i)"
+        f"                (if (= i {n})"
+        "                    0"
+        "                    (+ i (sum (+ i 1)))))))"
+        "  (sum 0))"
+    )
+
+
+def fact_program(n):
+    # factorial's recursion, n calls deep; the factors past 12 are 1, so that
+    # the product stays an Int
+    return (
+        "(letrec ((fact (lambda (n)"
+        "                 (if (= n 0)"
+        "                     1"
+        "                     (* (if (<= n 12) n 1) (fact (- n 1)))))))"
+        f"  (fact {n}))"
+    )
+
+
+def nested_let_program(n):
+    # n lets, each binding a variable from the one before
+    lets = "".join(f"(let ((x{i} (+ x{i - 1} 1))) " for i in range(1, n + 1))
+    return f"(let ((x0 0)) {lets}x{n}{')' * (n + 1)}"
+
+
+def measure_compile(executable, code, extra_flags=(), header_dir=HEADER_DIR):
+    """
+    Compile code once, returning (seconds, max RSS in KiB, return code) for
+    the compiler process alone.
+    """
+    with TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "bench.cpp")
+        with open(path, "w") as f:
+            f.write(code)
+        cmd = [
+            executable,
+            *DEFAULT_FLAGS,
+            *extra_flags,
+            "-I",
+            header_dir,
+            "-fsyntax-only",
+            path,
+        ]
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        _, status, rusage = os.wait4(proc.pid, 0)
+        elapsed = time.perf_counter() - start
+    return elapsed, rusage.ru_maxrss, os.waitstatus_to_exitcode(status)
+
+
+def bench_lookup(executable, sizes, env_sizes):
+    """
+    Compile fib and mapcar inside ever larger environments. With lexically
+    addressed, pack-indexed frames the cost should not depend on env_size.
+    """
+    workloads = {"fib": fib_program, "mapcar": mapcar_program}
+    print(f"{'workload':<10}{'n':>6}{'env':>6}{'seconds':>10}{'max RSS MiB':>13}")
+    for name, program in workloads.items():
+        for n in sizes:
+            for env_size in env_sizes:
+                code = Lisp2Cpp(with_environment(program(n), env_size)).codegen()
+                elapsed, max_rss, returncode = measure_compile(
+                    executable, code, ["-ftemplate-depth=100000"]
+                )
+                status = "" if returncode == 0 else "  (failed)"
+                print(
+                    f"{name:<10}{n:>6}{env_size:>6}{elapsed:>10.3f}"
+                    f"{max_rss / 1024:>13.1f}{status}"
+                )
+
+
+def bench_closures(executable, sizes, repeat):
+    """
+    Compile recursive, closure-heavy programs. Reports the best of repeat
+    runs, since a single compile is short enough to be noisy.
+    """
+    workloads = {
+        "fib": lambda n: fib_program(n // 10),
+        "fib-k": lambda n: fib_identity_program(n // 10),
+        "mapcar": mapcar_program,
+        "counter": counter_program,
+        "scale": scale_program,
+        "local": local_fib_program,
+    }
+    print(f"{'workload':<10}{'n':>6}{'seconds':>10}{'max RSS MiB':>13}")
+    for name, program in workloads.items():
+        for n in sizes:
+            code = Lisp2Cpp(program(n)).codegen()
+            runs = [
+                measure_compile(executable, code, ["-ftemplate-depth=100000"])
+                for _ in range(repeat)
+            ]
+            elapsed = min(run[0] for run in runs)
+            max_rss = min(run[1] for run in runs)
+            status = "" if all(run[2] == 0 for run in runs) else "  (failed)"
+            print(f"{name:<10}{n:>6}{elapsed:>10.3f}{max_rss / 1024:>13.1f}{status}")
+
+
+def bench_loops(executable, sizes):
+    """
+    Compile loops of n iterations at the compiler's default template depth.
+    Tail calls iterate in blocks of logarithmic depth; the plain recursion
+    fails once n outgrows the depth limit.
+    """
+    workloads = {"loop": loop_program, "recursion": recursion_program}
+    print(f"{'workload':<10}{'n':>8}{'seconds':>10}{'max RSS MiB':>13}")
+    for name, program in workloads.items():
+        for n in sizes:
+            code = Lisp2Cpp(program(n)).codegen()
+            elapsed, max_rss, returncode = measure_compile(executable, code)
+            status = "" if returncode == 0 else "  (failed)"
+            print(f"{name:<10}{n:>8}{elapsed:>10.3f}{max_rss / 1024:>13.1f}{status}")
+
+
+def bench_backends(executable, sizes):
+    """
+    Compile the same programs with the template and the constexpr backends.
+    Each workload scales its size so that both backends stay within their
+    default limits for the smaller sizes.
+    """
+    workloads = {
+        "fib": lambda n: fib_program(n // 50),
+        "mapcar": lambda n: mapcar_program(n // 4),
+        "loop": loop_program,
+    }
+    print(f"{'workload':<10}{'backend':<11}{'n':>8}{'seconds':>10}{'max RSS MiB':>13}")
+    for name, program in workloads.items():
+        for n in sizes:
+            for backend in BACKENDS:
+                code = Lisp2Cpp(program(n), backend=backend).codegen()
+                elapsed, max_rss, returncode = measure_compile(executable, code)
+                status = "" if returncode == 0 else "  (failed)"
+                print(
+                    f"{name:<10}{backend:<11}{n:>8}{elapsed:>10.3f}"
+                    f"{max_rss / 1024:>13.1f}{status}"
+                )
+
+
+def bench_pch(executable, count):
+    """
+    Per-evaluation latency of small programs, compiled one at a time without
+    a result cache, with and without the precompiled header.
+    """
+    codes = [static_assert_program(f"(+ {i} 1)", f"Int<{i + 1}>") for i in range(count)]
+
+    with TemporaryDirectory() as pch_dir:
+        print(f"{'mode':<10}{'evals':>8}{'ms/eval':>12}")
+        for pch in [False, True]:
+            compiler = Compiler(executable, pch=pch, pch_dir=pch_dir)
+            if pch:
+                compiler.precompiled_header()
+            start = time.perf_counter()
+            for code in codes:
+                res = compiler.compile(code)
+                assert res.returncode == 0, res.stderr
+            elapsed = time.perf_counter() - start
+            mode = "pch" if pch else "no-pch"
+            print(f"{mode:<10}{count:>8}{1e3 * elapsed / count:>12.2f}")
+
+
+# name: (program of n, default sizes)
+SUITE = {
+    "fact": (fact_program, [10, 100, 400]),
+    "fib": (fib_program, [10, 15, 20]),
+    "mapcar": (mapcar_program, [10, 100, 400]),
+    "nested-let": (nested_let_program, [10, 100, 400]),
+    "environment": (lambda n: with_environment(fib_program(10), n), [0, 64, 512]),
+}
+
+SUITE_VERSION = 1
+
+SUITE_FLAGS = ("-ftemplate-depth=100000",)
+
+# what compare looks at, and whether it is exact or noisy
+SUITE_METRICS = {"seconds": False, "max_rss_kib": False, "instantiations": True}
+
+
+def find_compilers():
+    """
+    The C++ compilers on PATH: g++ and clang++, with or without a version
+    suffix, and c++, each real executable once, under the first name found.
+    """
+    names = ["c++", "g++", "clang++"]
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        try:
+            entries = sorted(os.listdir(directory))
+        except OSError:
+            continue
+        names.extend(e for e in entries if re.fullmatch(r"(g|clang)\+\+-[0-9.]+", e))
+    res = {}
+    for name in names:
+        path = shutil.which(name)
+        if path is not None:
+            res.setdefault(os.path.realpath(path), name)
+    return list(res.values())
+
+
+def count_instantiations(compiler, code, header_dir=HEADER_DIR):
+    """
+    How many class templates compiler instantiates for code, or None if it
+    can't tell: the InstantiateClass events of clang's -ftime-trace, or the
+    template classes g++ lays out, from its -fdump-lang-class.
+    """
+    with TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, "bench.cpp")
+        with open(path, "w") as f:
+            f.write(code)
+        if compiler.is_clang:
+            flags = [*TRACE_FLAGS, "-c", "-o", os.path.join(temp_dir, "bench.o")]
+            dump = os.path.join(temp_dir, "bench.json")
+        elif "gcc" in compiler.identity.lower() or "g++" in compiler.identity:
+            dump = os.path.join(temp_dir, "bench.class")
+            flags = ["-fsyntax-only", f"-fdump-lang-class={dump}"]
+        else:
+            return None
+        cmd = [
+            compiler.executable,
+            *DEFAULT_FLAGS,
+            *SUITE_FLAGS,
+            *flags,
+            "-I",
+            header_dir,
+            path,
+        ]
+        proc = subprocess.run(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd=temp_dir
+        )
+        if proc.returncode != 0 or not os.path.exists(dump):
+            return None
+        with open(dump, "r") as f:
+            if compiler.is_clang:
+                return trace_instantiations(json.load(f))
+            return class_dump_instantiations(f)
+
+
+def trace_instantiations(trace):
+    # the class template instantiations of a clang -ftime-trace
+    return sum(
+        1 for event in trace["traceEvents"] if event.get("name") == "InstantiateClass"
+    )
+
+
+def class_dump_instantiations(lines):
+    # the template classes laid out in a g++ -fdump-lang-class, which stand in
+    # for the instantiations: those only named, never completed, are missing
+    return sum(1 for line in lines if line.startswith("Class ") and "<" in line)
+
+
+def run_suite(executables, workloads, sizes=None, repeat=3, header=HEADER_PATH):
+    """
+    Compile every workload at every size with every compiler, and return the
+    results as a JSON-able dict. Times and max RSS are the best of repeat
+    compiles; instantiations don't count those of the header alone.
+    """
+    header_dir = os.path.dirname(os.path.abspath(header))
+    with open(header, "rb") as f:
+        header_sha = sha256(f.read())
+    res = dict(
+        version=SUITE_VERSION,
+        header=dict(path=os.path.abspath(header), sha256=header_sha),
+        flags=[*DEFAULT_FLAGS, *SUITE_FLAGS],
+        repeat=repeat,
+        results=[],
+    )
+    print(
+        f"{'compiler':<12}{'workload':<13}{'n':>6}{'seconds':>10}"
+        f"{'max RSS MiB':>13}{'instantiations':>16}",
+        file=sys.stderr,
+    )
+    for executable in executables:
+        compiler = Compiler(executable)
+        version = compiler.identity.splitlines()[1]
+        baseline = count_instantiations(compiler, Lisp2Cpp.include + "\n", header_dir)
+        for name in workloads:
+            program, default_sizes = SUITE[name]
+            for n in sizes or default_sizes:
+                code = Lisp2Cpp(program(n)).codegen()
+                runs = [
+                    measure_compile(executable, code, SUITE_FLAGS, header_dir)
+                    for _ in range(repeat)
+                ]
+                returncode = max(run[2] for run in runs)
+                count = count_instantiations(compiler, code, header_dir)
+                if count is not None and baseline is not None:
+                    count -= baseline
+                result = dict(
+                    compiler=executable,
+                    compiler_version=version,
+                    workload=name,
+                    n=n,
+                    seconds=min(run[0] for run in runs),
+                    max_rss_kib=min(run[1] for run in runs),
+                    instantiations=count,
+                    returncode=returncode,
+                )
+                res["results"].append(result)
+                status = "" if returncode == 0 else "  (failed)"
+                print(
+                    f"{executable:<12}{name:<13}{n:>6}{result['seconds']:>10.3f}"
+                    f"{result['max_rss_kib'] / 1024:>13.1f}"
+                    f"{'-' if count is None else count:>16}{status}",
+                    file=sys.stderr,
+                )
+    return res
+
+
+def compare_suites(old, new, threshold):
+    """
+    The regressions from the results old to those of new: for each compile
+    both ran, a (key, metric, old value, new value) per metric that grew by
+    more than threshold (a fraction) or, for exact metrics, at all, and per
+    compile that no longer succeeds. Compiles that failed in old have nothing
+    to compare against.
+    """
+
+    def key(result):
+        return result["compiler"], result["workload"], result["n"]
+
+    before = {key(result): result for result in old["results"]}
+    regressions = []
+    for result in new["results"]:
+        previous = before.get(key(result))
+        if previous is None:
+            continue
+        if result["returncode"] != 0:
+            if previous["returncode"] == 0:
+                regressions.append((key(result), "returncode", 0, result["returncode"]))
+            continue
+        if previous["returncode"] != 0:
+            continue
+        for metric, exact in SUITE_METRICS.items():
+            a, b = previous[metric], result[metric]
+            if a is None or b is None:
+                continue
+            if b > a if exact else b > a * (1 + threshold):
+                regressions.append((key(result), metric, a, b))
+    return regressions
+
+
+def bench_suite(executables, workloads, sizes, repeat, header, output):
+    res = run_suite(executables, workloads, sizes, repeat, header)
+    if output is None:
+        print(json.dumps(res, indent=1))
+        return
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(output)), suffix=".tmp"
+    )
+    with os.fdopen(fd, "w") as f:
+        json.dump(res, f, indent=1)
+    os.replace(tmp_path, output)
+
+
+def bench_compare(old_path, new_path, threshold):
+    with open(old_path, "r") as f:
+        old = json.load(f)
+    with open(new_path, "r") as f:
+        new = json.load(f)
+    regressions = compare_suites(old, new, threshold)
+    if old["header"]["sha256"] != new["header"]["sha256"]:
+        print(f"header {old['header']['path']} -> {new['header']['path']}")
+    for (compiler, workload, n), metric, a, b in regressions:
+        change = f"{b / a - 1:+.1%}" if a else ""
+        print(f"{compiler:<12}{workload:<13}{n:>6}  {metric}: {a} -> {b} {change}")
+    print(f"{len(regressions)} regressions")
+    if regressions:
+        sys.exit(1)
+
+
+def create_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--compiler", help="C++ compiler to run", default=None)
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    pch = subparsers.add_parser("pch", help="evaluation latency with/without PCH")
+    pch.add_argument("--count", type=int, default=50)
+
+    lookup = subparsers.add_parser(
+        "lookup", help="fib/mapcar compile cost versus environment size"
+    )
+    lookup.add_argument("--sizes", type=int, nargs="+", default=[10, 20])
+    lookup.add_argument("--env-sizes", type=int, nargs="+", default=[0, 64, 512])
+
+    closures = subparsers.add_parser(
+        "closures", help="compile cost of recursive, closure-heavy programs"
+    )
+    closures.add_argument("--sizes", type=int, nargs="+", default=[100, 200])
+    closures.add_argument("--repeat", type=int, default=3)
+
+    loops = subparsers.add_parser(
+        "loops", help="compile cost of loops at the default template depth"
+    )
+    loops.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 5000])
+
+    backends = subparsers.add_parser(
+        "backends", help="compile cost of the template and constexpr backends"
+    )
+    backends.add_argument("--sizes", type=int, nargs="+", default=[400, 1000])
+
+    suite = subparsers.add_parser(
+        "suite",
+        help="time, max RSS and instantiations of every workload with every "
+        "compiler, as JSON",
+    )
+    suite.add_argument(
+        "--compilers",
+        help="compilers to run (default: all found on PATH, or --compiler if given)",
+        nargs="+",
+        default=None,
+    )
+    suite.add_argument(
+        "--workloads", nargs="+", choices=list(SUITE), default=list(SUITE)
+    )
+    suite.add_argument(
+        "--sizes", help="sizes for every workload", type=int, nargs="+", default=None
+    )
+    suite.add_argument("--repeat", type=int, default=3)
+    suite.add_argument(
+        "--header",
+        help="the tmp_lisp.hpp to measure, e.g. an older version",
+        default=HEADER_PATH,
+    )
+    suite.add_argument(
+        "--output", "-o", help="write the JSON here instead of stdout", default=None
+    )
+
+    compare = subparsers.add_parser(
+        "compare", help="regressions between two suite results, e.g. two headers"
+    )
+    compare.add_argument("old", help="JSON of the baseline suite run")
+    compare.add_argument("new", help="JSON of the suite run to check")
+    compare.add_argument(
+        "--threshold",
+        help="how much slower or bigger counts as a regression (instantiation "
+        "counts are exact, so any increase does)",
+        type=float,
+        default=0.1,
+    )
+    return parser
+
+
+def main(args):
+    if args.bench == "suite":
+        compilers = args.compilers or (
+            [args.compiler] if args.compiler else find_compilers()
+        )
+        return bench_suite(
+            compilers, args.workloads, args.sizes, args.repeat, args.header, args.output
+        )
+    if args.bench == "compare":
+        return bench_compare(args.old, args.new, args.threshold)
+    args.compiler = args.compiler or "c++"
+    if args.bench == "pch":
+        bench_pch(args.compiler, args.count)
+    elif args.bench == "lookup":
+        bench_lookup(args.compiler, args.sizes, args.env_sizes)
+    elif args.bench == "closures":
+        bench_closures(args.compiler, args.sizes, args.repeat)
+    elif args.bench == "loops":
+        bench_loops(args.compiler, args.sizes)
+    elif args.bench == "backends":
+        bench_backends(args.compiler, args.sizes)
+
+
+if __name__ == "__main__":
+    main(create_parser().parse_args())
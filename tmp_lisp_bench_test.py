@@ -0,0 +1,106 @@
+import shutil
+import unittest
+
+from cppdriver import Compiler
+from lisp2cpp import Lisp2Cpp
+from tmp_lisp_bench import (
+    class_dump_instantiations,
+    compare_suites,
+    count_instantiations,
+    trace_instantiations,
+)
+
+
+class CompareSuitesTest(unittest.TestCase):
+    @staticmethod
+    def result(n=10, seconds=1.0, max_rss_kib=1000, instantiations=100, returncode=0):
+        return dict(
+            compiler="c++",
+            workload="fib",
+            n=n,
+            seconds=seconds,
+            max_rss_kib=max_rss_kib,
+            instantiations=instantiations,
+            returncode=returncode,
+        )
+
+    def compare(self, old, new, threshold=0.1):
+        return compare_suites(dict(results=old), dict(results=new), threshold)
+
+    def test_threshold(self):
+        old = [self.result()]
+
+        self.assertEqual(self.compare(old, [self.result(seconds=1.05)]), [])
+        self.assertEqual(self.compare(old, [self.result(max_rss_kib=900)]), [])
+        self.assertEqual(
+            self.compare(old, [self.result(seconds=1.2, max_rss_kib=1200)]),
+            [
+                (("c++", "fib", 10), "seconds", 1.0, 1.2),
+                (("c++", "fib", 10), "max_rss_kib", 1000, 1200),
+            ],
+        )
+        self.assertEqual(self.compare(old, [self.result(seconds=1.2)], 0.5), [])
+
+    def test_exact_metrics(self):
+        old = [self.result()]
+
+        self.assertEqual(
+            self.compare(old, [self.result(instantiations=101)]),
+            [(("c++", "fib", 10), "instantiations", 100, 101)],
+        )
+        self.assertEqual(self.compare(old, [self.result(instantiations=99)]), [])
+        self.assertEqual(self.compare(old, [self.result(instantiations=None)]), [])
+
+    def test_returncodes(self):
+        old = [self.result(), self.result(n=20, returncode=1)]
+        new = [self.result(returncode=1, seconds=0.1), self.result(n=20, seconds=9)]
+
+        # only the compile that stopped working counts, and its metrics don't
+        self.assertEqual(
+            self.compare(old, new), [(("c++", "fib", 10), "returncode", 0, 1)]
+        )
+        # nor does one failing in both
+        self.assertEqual(self.compare(old, [self.result(n=20, returncode=2)]), [])
+
+    def test_unmatched_results(self):
+        self.assertEqual(self.compare([self.result()], [self.result(n=20)]), [])
+
+
+class InstantiationsTest(unittest.TestCase):
+    def test_trace(self):
+        trace = dict(
+            traceEvents=[
+                dict(ph="X", name="InstantiateClass", args=dict(detail="Int<1>")),
+                dict(ph="X", name="InstantiateFunction"),
+                dict(ph="X", name="InstantiateClass", args=dict(detail="Int<2>")),
+                dict(ph="M", args=dict(name="clang")),
+            ]
+        )
+
+        self.assertEqual(trace_instantiations(trace), 2)
+
+    def test_class_dump(self):
+        lines = [
+            "Class Int<1>\n",
+            "   size=1 align=1\n",
+            "Class std::integral_constant<bool, true>\n",
+            "Class Plain\n",
+            "Vtable for Base<int>\n",
+        ]
+
+        self.assertEqual(class_dump_instantiations(lines), 2)
+
+    @unittest.skipIf(shutil.which("c++") is None, "needs a C++ compiler")
+    def test_count(self):
+        compiler = Compiler("c++")
+        header = count_instantiations(compiler, Lisp2Cpp.include + "\n")
+        program = count_instantiations(compiler, Lisp2Cpp("(+ 1 (* 2 3))").codegen())
+
+        if header is None:
+            self.skipTest(f"can't count the instantiations of {compiler.identity}")
+        self.assertGreater(program, header)
+        self.assertIsNone(count_instantiations(compiler, "int main() {"))
+
+
+if __name__ == "__main__":
+    unittest.main()